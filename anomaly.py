@@ -0,0 +1,88 @@
+"""
+Index of the largest and smallest R-R intervals of a whole recording.
+
+The intervals of every segment are calculated once and the TOP_K largest and smallest are
+selected with np.argpartition and ranked, so stepping to the next interval in either list only
+reads the next position. Intervals are only calculated between peaks in the same segment. After
+an edit only the intervals of the edited segment are recalculated before the lists are ranked again.
+"""
+import numpy as np
+import processor as p
+
+TOP_K = 50
+
+LARGEST = 1
+SMALLEST = -1
+
+
+class IntervalIndex:
+    """
+    This class ranks the R-R intervals of every segment and steps through the largest or smallest.
+
+    Args:
+        r_peaks_list (np.array): The sorted sample indices of the R Peaks
+        segments (list): The (start, end) sample indices of each segment
+        sr (int): The sampling rate of the data
+        k (int, optional): The number of intervals in each list. Defaults to TOP_K.
+    """
+    def __init__(self, r_peaks_list, segments, sr, k=TOP_K):
+        self.segments = segments
+        self.sr = sr
+        self.k = k
+        segment_ids = p.label_segments(r_peaks_list, segments)
+        keep = segment_ids >= 0
+        segment_ids, times = segment_ids[keep], r_peaks_list[keep] / sr
+        same_segment = segment_ids[1:] == segment_ids[:-1]
+        self.intervals = np.diff(times)[same_segment]
+        self.interval_times = times[:-1][same_segment]
+        self.interval_segments = segment_ids[1:][same_segment]
+        self.positions = {LARGEST: -1, SMALLEST: -1}
+        self._rank()
+
+    def _rank(self):
+        k = min(self.k, len(self.intervals))
+        self.ranked = {LARGEST: np.empty(0, dtype=np.int64), SMALLEST: np.empty(0, dtype=np.int64)}
+        if k == 0:
+            return
+        for kind in (LARGEST, SMALLEST):
+            keys = -kind * self.intervals
+            top = np.argpartition(keys, k - 1)[:k]
+            self.ranked[kind] = top[np.argsort(keys[top], kind='stable')]
+        for kind in self.positions:
+            self.positions[kind] = min(self.positions[kind], len(self.ranked[kind]) - 1)
+
+    def step(self, kind):
+        """
+        Moves to the next interval in the list of the largest or smallest intervals, starting
+        again from the first after the last.
+
+        Args:
+            kind (int): LARGEST or SMALLEST
+
+        Returns:
+            tuple: The segment index, the time of the first R Peak, the length of the interval
+            and its rank (0 is the most extreme), or None if there are no intervals
+        """
+        ranked = self.ranked[kind]
+        if len(ranked) == 0:
+            return None
+        self.positions[kind] = (self.positions[kind] + 1) % len(ranked)
+        i = ranked[self.positions[kind]]
+        return int(self.interval_segments[i]), self.interval_times[i], self.intervals[i], self.positions[kind]
+
+    def update_segment(self, r_peaks_list, segment_idx):
+        """
+        Recalculates the intervals of one segment after its peaks are edited and ranks the lists again.
+
+        Args:
+            r_peaks_list (np.array): The sorted sample indices of the R Peaks
+            segment_idx (int): The index of the edited segment
+        """
+        times = p.peak_range(r_peaks_list, *self.segments[segment_idx]) / self.sr
+        first, last = np.searchsorted(self.interval_segments, [segment_idx, segment_idx + 1])
+        intervals = np.diff(times)
+        self.intervals = np.concatenate((self.intervals[:first], intervals, self.intervals[last:]))
+        self.interval_times = np.concatenate((self.interval_times[:first], times[:-1], self.interval_times[last:]))
+        self.interval_segments = np.concatenate((self.interval_segments[:first], np.full(len(intervals), segment_idx),
+                                                 self.interval_segments[last:]))
+        self._rank()
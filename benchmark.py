@@ -0,0 +1,489 @@
+"""
+Benchmarks for the ECG R-R Detector.
+
+The GUI benchmark drives a MainWindow headlessly using the offscreen Qt platform and
+synthetic ECG recordings, and reports percentile latencies for the interactions that
+reviewers use the most. Run it with:
+
+    python benchmark.py gui --minutes 5 30 120
+
+The pipeline benchmark writes a synthetic recording to a text file, drops it from the page
+cache, and compares the time of each stage of pipeline.py run one after another with the total
+time of the stages run concurrently:
+
+    python benchmark.py pipeline --minutes 1200 --filter
+
+The leads benchmark compares filtering and detecting every lead of a multi-lead recording one
+at a time with the batched multi-lead detection:
+
+    python benchmark.py leads --minutes 60 --leads 12
+
+The window benchmark compares parsing the whole of a recording with reading a window of it
+through the row index, when the index is first built and when it is loaded from next to the file:
+
+    python benchmark.py window --minutes 1440 --window 5
+
+The service benchmark starts the analysis service of service.py with its worker pool, and times
+the requests of several stand-in clients, each asking for every one of a few recordings twice,
+against running pipeline.py in a new Python process:
+
+    python benchmark.py service --files 4 --clients 8
+"""
+import os
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+os.environ.setdefault("ECG_CACHE_DIR", "")
+os.environ.setdefault("ECG_SESSION_DIR", "")
+
+import argparse
+import socket
+import tempfile
+import time
+import numpy as np
+import scipy.signal
+from PyQt5.QtWidgets import QApplication
+from matplotlib.backend_bases import MouseEvent
+import instrumentation
+
+
+def synthetic_recording(minutes, sr=1000, segment_seconds=60, seed=0):
+    """
+    Generates a synthetic ECG recording in the same layout as the output of processor.file_opener.
+
+    Args:
+        minutes (float): The length of the recording in minutes
+        sr (int, optional): The sampling rate of the recording. Defaults to 1000.
+        segment_seconds (int, optional): The length of each pulse block in seconds. Defaults to 60.
+        seed (int, optional): The seed of the random number generator. Defaults to 0.
+
+    Returns:
+        np.array: The recording with columns time, ECG and pulse
+    """
+    rng = np.random.default_rng(seed)
+    n = int(minutes * 60 * sr)
+    time_array = np.arange(n) / sr
+
+    rr = rng.normal(0.8, 0.05, size=int(minutes * 60 / 0.6) + 2)
+    beats = np.cumsum(rr)
+    beats = (beats[beats < n / sr] * sr).astype(int)
+    impulses = np.zeros(n)
+    impulses[beats] = 1.0
+
+    kernel_t = np.arange(-int(0.1 * sr), int(0.4 * sr)) / sr
+    kernel = np.exp(-(kernel_t / 0.01) ** 2) + 0.3 * np.exp(-((kernel_t - 0.25) / 0.04) ** 2)
+    ecg = scipy.signal.fftconvolve(impulses, kernel, mode="full")[int(0.1 * sr):int(0.1 * sr) + n]
+    ecg += 0.1 * np.sin(2 * np.pi * 0.2 * time_array) + rng.normal(0, 0.05, size=n)
+
+    pulse = np.where((time_array // segment_seconds) % 2 == 1, 5.0, 0.0)
+    return np.column_stack((time_array, ecg, pulse))
+
+
+def load_recording(window, data, sr, pulse=True, filtering=True):
+    """
+    Loads a recording into a MainWindow without going through the file and settings dialogs.
+
+    Args:
+        window (MainWindow): The window to load the data into
+        data (np.array): The recording, as returned by synthetic_recording
+        sr (int): The sampling rate of the recording
+        pulse (bool, optional): Whether the segments are defined by the pulse column. Defaults to True.
+        filtering (bool, optional): Whether R Peaks are detected on the filtered signal. Defaults to True.
+    """
+    import pulse_handler as pul
+    import no_pulse_handler as nopul
+
+    window.initialise_variables()
+    window.file_path = "synthetic.txt"
+    window.file_name = "synthetic"
+    window.file_data = data
+    window.file_length, window.file_width = data.shape
+    window.sr = sr
+    window.selected_filtering = filtering
+    window.is_filtered = filtering
+    window.ecg_column = 1
+    window.title = "R Peaks Detected From a Fourier Transform of the Orignal Signal"
+    if pulse:
+        window.pulse_column = 2
+        window.add_segment_buttons()
+        pul.run_data_analysis(window)
+    else:
+        window.analyse_whole_dataset = True
+        window.start_time = 0
+        window.end_time = window.file_length / (60 * sr)
+        nopul.run_data_analysis(window)
+
+
+def click(window, x, y, button):
+    """
+    Sends a mouse click at the data coordinates (x, y) to the window's figure canvas.
+    """
+    canvas = window.figure.canvas
+    px, py = window.ax.transData.transform((x, y))
+    event = MouseEvent("button_press_event", canvas, px, py, button=button)
+    canvas.callbacks.process("button_press_event", event)
+
+
+def measure(app, action, repeats):
+    """
+    Times an action, including the processing of any Qt events it queued.
+
+    Args:
+        app (QApplication): The running application
+        action (function): Called with the repeat number on every repeat
+        repeats (int): The number of times to run the action
+
+    Returns:
+        np.array: The latency of every repeat in milliseconds
+    """
+    latencies = np.empty(repeats)
+    for i in range(repeats):
+        start = time.perf_counter()
+        action(i)
+        app.processEvents()
+        latencies[i] = (time.perf_counter() - start) * 1000
+    return latencies
+
+
+def gui_benchmark(app, minutes, sr, repeats, pulse):
+    """
+    Runs every interaction benchmark on a recording of the given length.
+
+    Returns:
+        dict: The latencies in milliseconds for every interaction
+    """
+    import main
+
+    window = main.MainWindow()
+    data = synthetic_recording(minutes, sr)
+    instrumentation.reset()
+    load_recording(window, data, sr, pulse=pulse)
+    app.processEvents()
+    if instrumentation.enabled:
+        print(instrumentation.format_report())
+    rng = np.random.default_rng(1)
+    results = {}
+
+    def add_click(i):
+        x0, x1 = window.ax.get_xlim()
+        x = rng.uniform(x0, x1)
+        idx = min(np.searchsorted(window.curr_primary_chunk[:, 0], x), len(window.curr_primary_chunk) - 1)
+        click(window, window.curr_primary_chunk[idx, 0], window.curr_primary_chunk[idx, 1], 1)
+
+    def remove_click(i):
+        x0, x1 = window.ax.get_xlim()
+        points = window.r_peak_points(window.curr_r_peaks_chunk)
+        visible = points[(points[:, 0] >= x0) & (points[:, 0] <= x1)]
+        if len(visible) > 2:
+            peak = visible[rng.integers(len(visible))]
+            click(window, peak[0], peak[1], 3)
+
+    results["add click"] = measure(app, add_click, repeats)
+    results["remove click"] = measure(app, remove_click, repeats)
+
+    def slider_move(i):
+        window.slider.setValue(int(rng.integers(window.slider.minimum(), window.slider.maximum() + 1)))
+
+    results["slider move"] = measure(app, slider_move, repeats)
+
+    zoom_levels = [1, 2, 3, 5, 10]
+    results["zoom"] = measure(app, lambda i: window.set_zoom(zoom_levels[i % len(zoom_levels)]), repeats)
+    window.set_zoom(1)
+
+    results["histogram toggle"] = measure(app, lambda i: window.graph_toggler(), repeats)
+    if window.showing_hist:
+        window.graph_toggler()
+
+    if pulse and window.num_segments > 1:
+        def navigate(i):
+            if window.curr_segment_idx == window.num_segments - 1:
+                window.prev_button_clicked()
+            elif window.curr_segment_idx == 0 or i % 2 == 0:
+                window.next_button_clicked()
+            else:
+                window.prev_button_clicked()
+
+        results["segment navigation"] = measure(app, navigate, repeats)
+
+    window.close()
+    return results
+
+
+def write_recording(file_path, minutes, sr, piece_minutes=10):
+    """
+    Writes a synthetic recording to a tab-separated text file a few minutes at a time, so
+    recordings larger than memory can be written.
+    """
+    with open(file_path, "w") as f:
+        f.write("Time\tECG\tPulse\n")
+        for i, start in enumerate(np.arange(0, minutes, piece_minutes)):
+            data = synthetic_recording(min(piece_minutes, minutes - start), sr, seed=i)
+            data[:, 0] += start * 60
+            np.savetxt(f, data, fmt="%.6f", delimiter="\t")
+
+
+def drop_from_page_cache(file_path):
+    """
+    Asks the OS to drop a file from the page cache, so the next read of it comes from the disk.
+    """
+    if hasattr(os, "posix_fadvise"):
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def timed(blocks, totals, name):
+    """
+    Adds the time spent producing each block of a pipeline stage, including the stages before it, to totals[name].
+    """
+    blocks = iter(blocks)
+    while True:
+        start = time.perf_counter()
+        block = next(blocks, None)
+        totals[name] = totals.get(name, 0) + time.perf_counter() - start
+        if block is None:
+            return
+        yield block
+
+
+def pipeline_benchmark(file_path, sr, filtering, block_rows):
+    """
+    Times the parse, filter and detect stages of pipeline.py one after another, then all
+    of them running concurrently, reading the file from the disk both times.
+
+    Returns:
+        dict: The time in seconds of every stage, their sum and the concurrent total
+    """
+    import pipeline
+
+    column = -1 if filtering else 1
+    drop_from_page_cache(file_path)
+    totals = {}
+    start = time.perf_counter()
+    blocks = timed(pipeline.parse_blocks(file_path, sr, [1, 2], block_rows), totals, "parse")
+    if filtering:
+        blocks = timed(pipeline.filter_blocks(blocks, sr), totals, "filter")
+    for _ in pipeline.detect_blocks(blocks, sr, column):
+        pass
+    sequential = time.perf_counter() - start
+
+    results = {"parse": totals["parse"]}
+    if filtering:
+        results["filter"] = totals["filter"] - totals["parse"]
+    results["detect"] = sequential - totals.get("filter", totals["parse"])
+    results["sequential total"] = sequential
+
+    drop_from_page_cache(file_path)
+    start = time.perf_counter()
+    for _ in pipeline.detect_blocks(pipeline.stream_blocks(file_path, sr, [1, 2], filtering, block_rows, concurrent=True), sr, column):
+        pass
+    results["concurrent total"] = time.perf_counter() - start
+    return results
+
+
+def synthetic_leads(minutes, sr, num_leads, seed=0):
+    """
+    Generates the times and leads of a synthetic multi-lead recording. Every lead is the ECG of
+    synthetic_recording with its own gain and noise.
+    """
+    rng = np.random.default_rng(seed)
+    data = synthetic_recording(minutes, sr, seed=seed)
+    gains = rng.uniform(0.5, 1.5, size=num_leads)
+    leads = data[:, 1:2] * gains + rng.normal(0, 0.05, size=(len(data), num_leads))
+    return data[:, 0], leads
+
+
+def leads_benchmark(minutes, sr, num_leads, filtering):
+    """
+    Times filtering and detecting the R Peaks of every lead independently with processor.filter and
+    processor.find_r_peaks, then the batched detection of multilead.
+
+    Returns:
+        dict: The time in seconds of both and the number of consensus R Peaks
+    """
+    import processor as p
+    import multilead
+
+    times, leads = synthetic_leads(minutes, sr, num_leads)
+    start = time.perf_counter()
+    for lead in range(num_leads):
+        timeseries = np.column_stack((times, leads[:, lead]))
+        if filtering:
+            timeseries = p.filter(timeseries, sr)
+        p.find_r_peaks(timeseries, sr)
+    independent = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched_leads = multilead.filter_leads(leads, sr) if filtering else leads
+    r_peaks_list, _ = multilead.find_r_peaks(times, batched_leads, sr)
+    batched = time.perf_counter() - start
+    return {"independent": independent, "batched": batched, "consensus peaks": len(r_peaks_list)}
+
+
+def window_benchmark(file_path, sr, start_minutes, window_minutes):
+    """
+    Times parsing the whole recording with processor.file_opener, then building the row index and
+    reading a window through it, then loading the saved index and reading the window again.
+
+    Returns:
+        dict: The time in seconds of each
+    """
+    import processor as p
+
+    results = {}
+    start = time.perf_counter()
+    p.file_opener(file_path, sr)
+    results["full parse"] = time.perf_counter() - start
+
+    start_row, end_row = int(start_minutes*60*sr), int((start_minutes + window_minutes)*60*sr)
+    for name in ("build index", "load index"):
+        start = time.perf_counter()
+        index = p.row_index(file_path)
+        results[name] = time.perf_counter() - start
+        start = time.perf_counter()
+        p.read_rows(file_path, sr, start_row, end_row, index)
+        results[f"read window ({name.split()[0]})"] = time.perf_counter() - start
+    return results
+
+
+def service_benchmark(minutes, sr, num_files, num_clients, workers):
+    """
+    Times the requests of stand-in clients to the analysis service, each client on its own thread with
+    its own connection. Every client asks for every recording twice, starting from a different one, so
+    requests for a recording which is being analysed are batched and the second requests are cached.
+    Analysing a recording with pipeline.py in a new Python process is timed for comparison.
+
+    Returns:
+        dict: The latencies in milliseconds of the requests answered in each way and of the new process
+    """
+    import subprocess
+    import sys
+    import threading
+    import cache
+    import service
+    import service_client
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache.cache_dir = os.path.join(directory, "cache")
+        paths = [os.path.join(directory, f"synthetic_{i}.txt") for i in range(num_files)]
+        for path in paths:
+            write_recording(path, minutes, sr)
+
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "pipeline.py"), paths[0],
+                        "--sr", str(sr), "--pulse-column", "2"], check=True, stdout=subprocess.DEVNULL)
+        latencies = {"new process": [(time.perf_counter() - start) * 1000]}
+
+        analysis_service = service.AnalysisService(workers)
+        address = os.path.join(directory, "service.sock") if hasattr(socket, "AF_UNIX") else "127.0.0.1:0"
+        server = service.create_server(analysis_service, address)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        lock = threading.Lock()
+
+        def client(first):
+            with service_client.Client(server.address) as connection:
+                for i in range(2 * num_files):
+                    start = time.perf_counter()
+                    status = connection.analyse(paths[(first + i) % num_files], sr, pulse_column=2)["status"]
+                    with lock:
+                        latencies.setdefault(status, []).append((time.perf_counter() - start) * 1000)
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(num_clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        server.shutdown()
+        server.server_close()
+        analysis_service.close()
+    return {name: np.array(values) for name, values in latencies.items()}
+
+
+def report(title, results):
+    print(title)
+    print(f"  {'interaction':<20}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, latencies in results.items():
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        print(f"  {name:<20}{p50:>10.1f}{p90:>10.1f}{p99:>10.1f}{latencies.max():>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the ECG R-R Detector")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    gui_parser = subparsers.add_parser("gui", help="GUI interaction latency")
+    gui_parser.add_argument("--minutes", type=float, nargs="+", default=[5, 30, 120], help="Recording lengths in minutes")
+    gui_parser.add_argument("--sr", type=int, default=1000, help="Sampling rate in Hz")
+    gui_parser.add_argument("--repeats", type=int, default=50, help="Repeats of every interaction")
+    gui_parser.add_argument("--mode", choices=["pulse", "whole"], nargs="+", default=["pulse", "whole"],
+                            help="Pulse segments and/or the whole dataset")
+    pipeline_parser = subparsers.add_parser("pipeline", help="Sequential and concurrent streaming analysis of a large file")
+    pipeline_parser.add_argument("--minutes", type=float, default=600, help="Length of the synthetic recording in minutes")
+    pipeline_parser.add_argument("--sr", type=int, default=1000, help="Sampling rate in Hz")
+    pipeline_parser.add_argument("--file", default=None, help="Use this recording (time, ECG and pulse columns) instead of a synthetic one")
+    pipeline_parser.add_argument("--filter", action="store_true", help="Include the filter stage")
+    pipeline_parser.add_argument("--block-rows", type=int, default=2**20, help="Rows in each block")
+    leads_parser = subparsers.add_parser("leads", help="Independent and batched multi-lead detection")
+    leads_parser.add_argument("--minutes", type=float, default=60, help="Length of the synthetic recording in minutes")
+    leads_parser.add_argument("--sr", type=int, default=1000, help="Sampling rate in Hz")
+    leads_parser.add_argument("--leads", type=int, default=12, help="Number of leads")
+    leads_parser.add_argument("--filter", action="store_true", help="Include the filter stage")
+    window_parser = subparsers.add_parser("window", help="Reading a window of a recording through the row index")
+    window_parser.add_argument("--minutes", type=float, default=1440, help="Length of the synthetic recording in minutes")
+    window_parser.add_argument("--sr", type=int, default=1000, help="Sampling rate in Hz")
+    window_parser.add_argument("--file", default=None, help="Use this recording instead of a synthetic one")
+    window_parser.add_argument("--start", type=float, default=None, help="Start of the window in minutes. Defaults to the middle of the recording")
+    window_parser.add_argument("--window", type=float, default=5, help="Length of the window in minutes")
+    service_parser = subparsers.add_parser("service", help="Requests to the analysis service from concurrent clients")
+    service_parser.add_argument("--minutes", type=float, default=10, help="Length of each synthetic recording in minutes")
+    service_parser.add_argument("--sr", type=int, default=1000, help="Sampling rate in Hz")
+    service_parser.add_argument("--files", type=int, default=4, help="Number of recordings")
+    service_parser.add_argument("--clients", type=int, default=8, help="Number of concurrent clients")
+    service_parser.add_argument("--workers", type=int, default=None, help="Worker processes. Defaults to one per CPU")
+    parser.add_argument("--instrument", action="store_true", help="Print the stage timings recorded while loading each recording")
+
+    args = parser.parse_args()
+    if args.instrument:
+        instrumentation.enable()
+    if args.benchmark == "gui":
+        app = QApplication.instance() or QApplication([])
+        for minutes in args.minutes:
+            for mode in args.mode:
+                results = gui_benchmark(app, minutes, args.sr, args.repeats, pulse=(mode == "pulse"))
+                report(f"{minutes:g} minute recording, {mode} mode, {args.sr} Hz", results)
+    elif args.benchmark == "pipeline":
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = args.file
+            if file_path is None:
+                file_path = os.path.join(directory, "synthetic.txt")
+                write_recording(file_path, args.minutes, args.sr)
+            results = pipeline_benchmark(file_path, args.sr, args.filter, args.block_rows)
+        print(f"{os.path.getsize(file_path) / 2**30:.2f} GB recording, {os.cpu_count()} CPUs" if args.file else
+              f"{args.minutes:g} minute synthetic recording, {os.cpu_count()} CPUs")
+        for name, seconds in results.items():
+            print(f"  {name:<20}{seconds:>10.2f} s")
+    elif args.benchmark == "leads":
+        results = leads_benchmark(args.minutes, args.sr, args.leads, args.filter)
+        print(f"{args.minutes:g} minute synthetic recording, {args.leads} leads, {args.sr} Hz")
+        print(f"  {'independent':<20}{results['independent']:>10.2f} s")
+        print(f"  {'batched':<20}{results['batched']:>10.2f} s")
+        print(f"  {'consensus peaks':<20}{results['consensus peaks']:>10}")
+    elif args.benchmark == "window":
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = args.file
+            if file_path is None:
+                file_path = os.path.join(directory, "synthetic.txt")
+                write_recording(file_path, args.minutes, args.sr)
+            start = args.start if args.start is not None else max(0, args.minutes/2 - args.window/2)
+            results = window_benchmark(file_path, args.sr, start, args.window)
+        print(f"{args.window:g} minute window of a {args.minutes:g} minute recording, {args.sr} Hz")
+        for name, seconds in results.items():
+            print(f"  {name:<24}{seconds:>10.2f} s")
+    elif args.benchmark == "service":
+        results = service_benchmark(args.minutes, args.sr, args.files, args.clients, args.workers)
+        report(f"{args.clients} clients, {args.files} {args.minutes:g} minute recordings, {args.sr} Hz, {os.cpu_count()} CPUs", results)
+
+
+if __name__ == "__main__":
+    main()
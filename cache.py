@@ -0,0 +1,179 @@
+"""
+Persistent on-disk cache of analysis results.
+
+Entries are keyed by a hash of the contents of the analysed channels together with every
+parameter that affects the analysis, including the current defaults of the processor
+functions, so any change to the data or the settings produces a different key. Entries are
+stored as .npz files and the least recently used entries are evicted when the cache grows
+beyond its size limit. Analyses of whole files by the analysis service are keyed by the path,
+size and modification time of the file instead, with file_key.
+
+The cache lives in ~/.ecg_rr_detector/cache unless ECG_CACHE_DIR is set, and its size limit
+can be changed with ECG_CACHE_MAX_BYTES. Setting ECG_CACHE_DIR to an empty string disables it.
+"""
+import hashlib
+import inspect
+import json
+import os
+import numpy as np
+import processor as p
+import signal_quality as sq
+
+CACHE_VERSION = 6
+DEFAULT_MAX_BYTES = 512 * 2**20
+HASH_BLOCK_ROWS = 2**20
+
+cache_dir = os.environ.get("ECG_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".ecg_rr_detector", "cache"))
+max_bytes = int(os.environ.get("ECG_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+
+
+def _defaults(function):
+    return {name: param.default for name, param in inspect.signature(function).parameters.items()
+            if param.default is not inspect.Parameter.empty}
+
+
+def analysis_key(channels, **params):
+    """
+    Computes the cache key of an analysis.
+
+    Args:
+        channels (list): The np.array columns the analysis reads, such as the ECG and pulse channels
+        **params: Every setting of the analysis, such as sr and whether the data is filtered
+
+    Returns:
+        str: The hex digest identifying the analysis
+    """
+    return analysis_keys(channels, **params)[0]
+
+
+def analysis_keys(channels, **params):
+    """
+    Computes the cache key of an analysis and its content key, reading the channels once. The content
+    key only depends on the channels and params, not on CACHE_VERSION or the defaults of the processor
+    functions, so it stays the same when the detector or the cache changes. The manual edits of a
+    recording are kept under it (see session.py).
+
+    Args:
+        channels (list): The np.array columns the analysis reads, as in analysis_key
+        **params: Every setting of the analysis, as in analysis_key
+
+    Returns:
+        str: The cache key, as from analysis_key
+        str: The content key
+    """
+    h = hashlib.blake2b(digest_size=20)
+    content = hashlib.blake2b(digest_size=20)
+    for channel in channels:
+        # Hashed a block at a time, so a strided column such as the pulse is not copied as a whole
+        shape = str(np.shape(channel)).encode()
+        h.update(shape)
+        content.update(shape)
+        for start in range(0, len(channel), HASH_BLOCK_ROWS):
+            block = np.ascontiguousarray(channel[start:start + HASH_BLOCK_ROWS], dtype=float).data
+            h.update(block)
+            content.update(block)
+    settings = {
+        "version": CACHE_VERSION,
+        "filter": _defaults(p.filter),
+        "find_r_peaks": _defaults(p.find_r_peaks),
+        "find_r_peaks_multirate": _defaults(p.find_r_peaks_multirate),
+        "find_missed_r_peaks": _defaults(p.find_missed_r_peaks),
+        "quality_window_seconds": sq.WINDOW_SECONDS,
+        "segments_from_edges": _defaults(p.segments_from_edges),
+        **params,
+    }
+    h.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    content.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest(), content.hexdigest()
+
+
+def file_key(file_path, **params):
+    """
+    Computes the cache key of an analysis of a whole file from its path, size and modification time
+    rather than its contents, so a cached analysis is found without reading the file.
+
+    Args:
+        file_path (str): The path to the file
+        **params: Every setting of the analysis, as in analysis_key
+
+    Returns:
+        str: The hex digest identifying the analysis
+    """
+    stat = os.stat(file_path)
+    return analysis_key([], file=os.path.abspath(file_path), size=stat.st_size, mtime_ns=stat.st_mtime_ns, **params)
+
+
+def _entry_path(key):
+    return os.path.join(cache_dir, f"{key}.npz")
+
+
+def load(key):
+    """
+    Loads a cached analysis.
+
+    Args:
+        key (str): The key from analysis_key
+
+    Returns:
+        dict: The cached arrays, or None if the analysis is not cached
+    """
+    if not cache_dir:
+        return None
+    path = _entry_path(key)
+    try:
+        with np.load(path) as entry:
+            arrays = {name: entry[name] for name in entry.files}
+        os.utime(path)
+        return arrays
+    except (OSError, ValueError):
+        return None
+
+
+def store(key, **arrays):
+    """
+    Stores the arrays of an analysis and evicts the least recently used entries if the cache is
+    larger than max_bytes. Failing to write the cache is not an error.
+
+    Args:
+        key (str): The key from analysis_key
+        **arrays (np.array): The results of the analysis
+    """
+    if not cache_dir:
+        return
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        path = _entry_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+        evict()
+    except OSError:
+        pass
+
+
+def evict():
+    """
+    Removes the least recently used entries until the cache is no larger than max_bytes.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".npz"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def clear():
+    if cache_dir and os.path.isdir(cache_dir):
+        for entry in os.scandir(cache_dir):
+            if entry.name.endswith(".npz"):
+                os.remove(entry.path)
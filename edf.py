@@ -0,0 +1,218 @@
+"""
+Memory-mapped reader for EDF and EDF+ recordings.
+
+Only the header is read when a file is opened. The data records are memory-mapped as 16-bit
+integers, and every signal is a Channel: a view of its samples in the records, which converts them
+to physical units only for the records a read touches. EDFData holds the signals recorded at the
+sampling rate of the file with a time column, and is indexed like the array returned by
+processor.file_opener, so the rest of the program uses it unchanged. The file is only read for
+the rows and columns that are used.
+"""
+import os
+import numpy as np
+
+ANNOTATIONS_LABEL = "EDF Annotations"
+
+
+def read_header(file_path):
+    """
+    Reads the header of an EDF or EDF+ file.
+
+    Args:
+        file_path (string): The path to the file
+
+    Raises:
+        ValueError: If the file is not an EDF file, or is a discontinuous EDF+ file.
+
+    Returns:
+        dict: The header bytes, number of data records, record duration in seconds and, for every
+        signal, its label, samples per record, gain and offset from digital to physical units
+    """
+    with open(file_path, 'rb') as f:
+        fixed = f.read(256)
+        if len(fixed) < 256 or fixed[:8].strip() != b"0":
+            raise ValueError("The file is not an EDF file.")
+        header_bytes = int(fixed[184:192])
+        if fixed[192:197] == b"EDF+D":
+            raise ValueError("Discontinuous EDF+ files are not supported.")
+        num_records = int(fixed[236:244])
+        record_duration = float(fixed[244:252])
+        num_signals = int(fixed[252:256])
+        signal_header = f.read(256*num_signals)
+    if len(signal_header) < 256*num_signals:
+        raise ValueError("The EDF header is incomplete.")
+
+    def fields(offset, width):
+        start = offset*num_signals
+        return [signal_header[start + i*width:start + (i + 1)*width].decode('ascii', 'replace').strip() for i in range(num_signals)]
+
+    labels = fields(0, 16)
+    physical_min = np.array(fields(104, 8), dtype=float)
+    physical_max = np.array(fields(112, 8), dtype=float)
+    digital_min = np.array(fields(120, 8), dtype=float)
+    digital_max = np.array(fields(128, 8), dtype=float)
+    samples_per_record = np.array(fields(216, 8), dtype=np.int64)
+
+    # The number of records is -1 while a recording is being written, and the last record can be incomplete
+    record_bytes = 2*int(samples_per_record.sum())
+    available = (os.path.getsize(file_path) - header_bytes) // record_bytes if record_bytes else 0
+    num_records = available if num_records < 0 else min(num_records, available)
+
+    gain = (physical_max - physical_min) / (digital_max - digital_min)
+    return {"header_bytes": header_bytes, "num_records": num_records, "record_duration": record_duration,
+            "labels": labels, "samples_per_record": samples_per_record,
+            "gain": gain, "offset": physical_min - digital_min*gain}
+
+
+def signal_columns(header):
+    """
+    Chooses the signals which are analysed: the signals recorded at the sampling rate shared by most
+    of the signals (the highest if there is a tie), without the EDF+ annotations.
+
+    Returns:
+        list: The indices of the signals in the header
+    """
+    signals = [i for i, label in enumerate(header["labels"]) if label != ANNOTATIONS_LABEL]
+    if not signals:
+        return []
+    rates, counts = np.unique(header["samples_per_record"][signals], return_counts=True)
+    rate = rates[counts == counts.max()].max()
+    return [i for i in signals if header["samples_per_record"][i] == rate]
+
+
+def sampling_rate(header):
+    """
+    Returns the sampling rate in Hz of the signals chosen by signal_columns, as an int if it is whole.
+    """
+    signals = signal_columns(header)
+    if not signals:
+        raise ValueError("The EDF file has no signals.")
+    rate = header["samples_per_record"][signals[0]] / header["record_duration"]
+    return int(rate) if rate == int(rate) else rate
+
+
+class Channel:
+    """
+    This class is one signal of an EDF file. Its samples are a view of the memory-mapped data records,
+    and reading a range of them converts only the records it touches to physical units.
+
+    Args:
+        records (np.memmap): The data records, one row per record
+        start (int): The position of the signal's first sample in each record
+        samples_per_record (int): The number of samples of the signal in each record
+        gain (float): The scale from digital to physical units
+        offset (float): The physical value of a digital 0
+    """
+    def __init__(self, records, start, samples_per_record, gain, offset):
+        self.samples = records[:, start:start + samples_per_record]
+        self.samples_per_record = samples_per_record
+        self.gain = gain
+        self.offset = offset
+
+    def __len__(self):
+        return self.samples.shape[0] * self.samples_per_record
+
+    def __getitem__(self, index):
+        n = self.samples_per_record
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step < 0 or stop <= start:
+                return self[np.arange(start, stop, step)]
+            first, last = start // n, -(-stop // n)
+            block = self.samples[first:last].reshape(-1) * self.gain + self.offset
+            return block[start - first*n:stop - first*n:step]
+        index = np.asarray(index)
+        index = np.where(index < 0, index + len(self), index)
+        return self.samples[index // n, index % n] * self.gain + self.offset
+
+
+class EDFData:
+    """
+    This class holds the signals of an EDF file which are analysed, with a time column in column 0,
+    and is read like the array returned by processor.file_opener. A range of rows can be taken without
+    reading the file with rows().
+
+    Args:
+        channels (list): The Channel of every signal, in the order of the columns
+        sr (float): The sampling rate of the signals
+        start (int, optional): The first sample of the signals in the data. Defaults to 0.
+        stop (int, optional): The sample after the last in the data. Defaults to the end of the signals.
+    """
+    def __init__(self, channels, sr, start=0, stop=None):
+        self.channels = channels
+        self.sr = sr
+        length = len(channels[0]) if channels else 0
+        self.start = start
+        self.stop = length if stop is None else min(stop, length)
+        self.shape = (max(0, self.stop - self.start), len(channels) + 1)
+        self.ndim = 2
+        self.dtype = np.dtype(float)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def rows(self, start, stop):
+        """
+        Returns the rows from start to stop as EDFData, keeping the times of the rows in the file.
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        return EDFData(self.channels, self.sr, self.start + start, self.start + max(start, stop))
+
+    def column(self, column, rows=slice(None)):
+        """
+        Reads some rows of one column, converting only those samples to physical units.
+        """
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(len(self))
+            samples = slice(self.start + start, self.start + stop, step) if step > 0 else np.arange(start, stop, step) + self.start
+        else:
+            rows = np.asarray(rows)
+            samples = np.where(rows < 0, rows + len(self), rows) + self.start
+        if column == 0:
+            if isinstance(samples, slice):
+                samples = np.arange(samples.start, max(samples.start, samples.stop), samples.step)
+            return samples * (1/self.sr)
+        return self.channels[column - 1][samples]
+
+    def __getitem__(self, key):
+        rows, columns = key if isinstance(key, tuple) else (key, slice(None))
+        if isinstance(columns, (int, np.integer)):
+            return self.column(int(columns), rows)
+        columns = range(self.shape[1])[columns] if isinstance(columns, slice) else columns
+        return np.column_stack([self.column(int(column), rows) for column in columns])
+
+    def __array__(self, dtype=None):
+        data = self[:, :]
+        return data if dtype is None else data.astype(dtype)
+
+
+def file_opener(file_path, sr=None):
+    """
+    Opens an EDF or EDF+ file without reading its samples. The signals recorded at the most common
+    sampling rate are columns 1 onwards, in the order of the header, after the time column.
+
+    Args:
+        file_path (string): The path to the file
+        sr (float, optional): The expected sampling rate. Defaults to None, the rate in the header.
+
+    Raises:
+        ValueError: If the file is not an EDF file or sr is not the sampling rate in the header.
+
+    Returns:
+        EDFData: The signals of the file
+        int: The number of rows in the data
+        int: The number of columns in the data
+        int: The number of NaN values changed to 0s, always 0 as EDF samples are integers
+    """
+    header = read_header(file_path)
+    rate = sampling_rate(header)
+    if sr is not None and sr != rate:
+        raise ValueError(f"The sampling rate in the file is {rate:g} Hz, not {sr:g} Hz.")
+    samples_per_record = header["samples_per_record"]
+    records = np.memmap(file_path, dtype='<i2', mode='r', offset=header["header_bytes"],
+                        shape=(header["num_records"], int(samples_per_record.sum())))
+    starts = np.concatenate(([0], np.cumsum(samples_per_record)[:-1]))
+    channels = [Channel(records, int(starts[i]), int(samples_per_record[i]), header["gain"][i], header["offset"][i])
+                for i in signal_columns(header)]
+    data = EDFData(channels, rate)
+    return data, data.shape[0], data.shape[1], 0
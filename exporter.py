@@ -0,0 +1,106 @@
+"""
+Writers for exporting R-peaks and R-R intervals.
+
+write_text formats a whole block of rows with a single string formatting operation instead of
+formatting row by row like np.savetxt, while producing the same output. bulk_export writes the
+peaks and intervals of every segment in one pass, as text tables, per-segment text files in the
+same format as the single segment export, and/or a columnar .npz file.
+"""
+import os
+import numpy as np
+import processor as p
+
+TEXT_TABLES = "txt"
+SEGMENT_FILES = "segments"
+NPZ = "npz"
+
+ROWS_PER_BLOCK = 100000
+
+
+def write_text(file_path, columns, fmt='%.18e', delimiter='\t', header=''):
+    """
+    Writes columns of numbers to a text file, in the same format as np.savetxt.
+
+    Args:
+        file_path (str): The path of the file to write
+        columns (np.array): A 1-D array, or a 2-D array with one row per line
+        fmt (str or list, optional): The format of every column, or a list with one format per column. Defaults to '%.18e'.
+        delimiter (str, optional): The column separator. Defaults to '\\t'.
+        header (str, optional): A line written before the data, prefixed with '# '. Defaults to ''.
+    """
+    columns = np.asarray(columns)
+    if columns.ndim == 1:
+        columns = columns.reshape(-1, 1)
+    fmts = fmt if isinstance(fmt, (list, tuple)) else [fmt] * columns.shape[1]
+    with open(file_path, 'w') as f:
+        if header:
+            f.write(f"# {header}\n")
+        _write_rows(f, columns, delimiter.join(fmts) + '\n')
+
+
+def bulk_export(directory, file_name, r_peaks_list, timeseries, segments, sr, formats):
+    """
+    Exports the R-peaks and R-R intervals of every segment. Intervals are only calculated
+    between peaks in the same segment.
+
+    Args:
+        directory (str): The folder to write to
+        file_name (str): The name of the recording, used as the prefix of every file
+        r_peaks_list (np.array): The sorted sample indices of the R Peaks
+        timeseries (np.array): The timeseries the R Peaks were detected in, which gives their times and voltages
+        segments (list): The (start, end) sample indices of each segment. One segment covering
+        the whole recording exports the whole file.
+        sr (int): The sampling rate of the data
+        formats (list): Any of TEXT_TABLES, SEGMENT_FILES and NPZ
+
+    Returns:
+        list: The paths of the written files
+    """
+    segment_ids = p.label_segments(r_peaks_list, segments)
+    keep = segment_ids >= 0
+    samples, segment_ids = r_peaks_list[keep], segment_ids[keep]
+    peaks = timeseries[samples]
+
+    same_segment = segment_ids[1:] == segment_ids[:-1]
+    intervals = np.diff(peaks[:, 0])[same_segment]
+    interval_segments = segment_ids[1:][same_segment]
+    interval_samples = samples[1:][same_segment]
+
+    written = []
+    if TEXT_TABLES in formats:
+        file_path = os.path.join(directory, f"{file_name}_R-Peaks_All_Segments.txt")
+        with open(file_path, 'w') as f:
+            f.write("segment\tsample\ttime\tvoltage\n")
+            _write_rows(f, np.column_stack((segment_ids + 1, samples, peaks)), '%d\t%d\t%.18e\t%.18e\n')
+        written.append(file_path)
+
+        file_path = os.path.join(directory, f"{file_name}_R-R_Intervals_All_Segments.txt")
+        with open(file_path, 'w') as f:
+            f.write("segment\tsample\tinterval\n")
+            _write_rows(f, np.column_stack((interval_segments + 1, interval_samples, intervals)), '%d\t%d\t%.18e\n')
+        written.append(file_path)
+
+    if SEGMENT_FILES in formats:
+        peak_bounds = np.searchsorted(segment_ids, np.arange(len(segments) + 1))
+        interval_bounds = np.searchsorted(interval_segments, np.arange(len(segments) + 1))
+        for i in range(len(segments)):
+            file_path = os.path.join(directory, f"{file_name}_R-Peaks_Segment_{i+1}.txt")
+            write_text(file_path, peaks[peak_bounds[i]:peak_bounds[i+1]])
+            written.append(file_path)
+            file_path = os.path.join(directory, f"{file_name}_R-R_Intervals_Segment_{i+1}.txt")
+            write_text(file_path, intervals[interval_bounds[i]:interval_bounds[i+1]])
+            written.append(file_path)
+
+    if NPZ in formats:
+        file_path = os.path.join(directory, f"{file_name}_R-Peaks.npz")
+        np.savez(file_path, sr=sr, segments=np.asarray(segments, dtype=np.int64).reshape(-1, 2),
+                 peak_segment=segment_ids + 1, peak_sample=samples, peak_time=peaks[:, 0], peak_voltage=peaks[:, 1],
+                 interval_segment=interval_segments + 1, interval_sample=interval_samples, interval=intervals)
+        written.append(file_path)
+    return written
+
+
+def _write_rows(f, columns, row_format):
+    for start in range(0, len(columns), ROWS_PER_BLOCK):
+        block = columns[start:start + ROWS_PER_BLOCK]
+        f.write((row_format * len(block)) % tuple(block.ravel().tolist()))
@@ -1,12 +1,21 @@
-from PyQt5.QtWidgets import QWidget, QVBoxLayout, QSlider,QMessageBox, QApplication
-from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QSlider,QMessageBox, QApplication, QDialog, QPlainTextEdit, QPushButton, QCheckBox, QDialogButtonBox, QLabel, QTableWidget, QTableWidgetItem, QFileDialog, QAbstractItemView, QDoubleSpinBox, QFormLayout
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
+from PyQt5.QtGui import QFontDatabase
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 import numpy as np
+import instrumentation
+import processor as p
+import session
+import exporter
+import hrv
+import os
 
 class InteractivePoints:
     """
     This class is used for creating interactive points on the graph display. It contains functions
-    for adding/ subtracting datapoints from the main classes curr_r_peaks_chunk. 
+    for adding/ subtracting datapoints from the main classes curr_r_peaks_chunk. Only the points 
+    within the click radius of the mouse along the time axis are searched, and only the marker of the
+    edited R Peak is changed.
     """
     def __init__(self, main_window, scatter):
         self.main_window = main_window
@@ -16,43 +25,68 @@ class InteractivePoints:
 
     def __call__(self, event):
         if event.inaxes != self.scatter.axes: return
+        main_window = self.main_window
+        edit = None
 
         # Left click to add a point
         if event.button == 1:  
             self.get_scaled_distances(event)
-            if self.main_window.overlay_on == True and self.main_window.curr_raw_chunk is not None and self.main_window.curr_filtered_chunk is not None:
-                raw_distances = np.sqrt(((self.main_window.curr_raw_chunk[:,0] / self.x_range) - self.x_data_scaled)**2 + ((self.main_window.curr_raw_chunk[:,1] / self.y_range) - self.y_data_scaled)**2)
-                filtered_distances = np.sqrt(((self.main_window.curr_filtered_chunk[:,0] / self.x_range) - self.x_data_scaled)**2 + ((self.main_window.curr_filtered_chunk[:,1] / self.y_range) - self.y_data_scaled)**2)
-
-                nearest_raw_point_index = raw_distances.argmin()
-                nearest_filtered_point_index = filtered_distances.argmin()
-
-                if raw_distances[nearest_raw_point_index] <= filtered_distances[nearest_filtered_point_index]:
-                    new_point = self.main_window.curr_raw_chunk[nearest_raw_point_index]
-                else:
-                    new_point = self.main_window.curr_filtered_chunk[nearest_filtered_point_index]
-
-                self.main_window.curr_r_peaks_chunk = np.vstack([self.main_window.curr_r_peaks_chunk, new_point])
+            if main_window.overlay_on == True and main_window.curr_raw_chunk is not None and main_window.curr_filtered_chunk is not None:
+                raw_index, raw_distance = self.nearest_point(main_window.curr_raw_chunk, exact=True)
+                filtered_index, filtered_distance = self.nearest_point(main_window.curr_filtered_chunk, exact=True)
+                nearest_point_index = raw_index if raw_distance <= filtered_distance else filtered_index
             else:
-                distances = np.sqrt(((self.main_window.curr_primary_chunk[:,0] / self.x_range) - self.x_data_scaled)**2 + ((self.main_window.curr_primary_chunk[:,1] / self.y_range) - self.y_data_scaled)**2)
-                nearest_point_index = distances.argmin()
-
-                if distances[nearest_point_index] <= 0.01:
-                    new_point = self.main_window.curr_primary_chunk[nearest_point_index]
-                    self.main_window.curr_r_peaks_chunk = np.vstack([self.main_window.curr_r_peaks_chunk, new_point])
+                nearest_point_index, distance = self.nearest_point(main_window.curr_primary_chunk)
+                if distance > 0.01:
+                    nearest_point_index = None
+            if nearest_point_index is not None:
+                sample = main_window.curr_chunk_start + nearest_point_index
+                position = np.searchsorted(main_window.curr_r_peaks_chunk, sample)
+                if position == len(main_window.curr_r_peaks_chunk) or main_window.curr_r_peaks_chunk[position] != sample:
+                    main_window.curr_r_peaks_chunk = np.insert(main_window.curr_r_peaks_chunk, position, sample)
+                    edit = (session.ADD, sample, position)
         
         # Right click to remove a point
         elif event.button == 3:  
-            if len(self.main_window.curr_r_peaks_chunk) == 0: return  # empty, nothing to remove
+            if len(main_window.curr_r_peaks_chunk) == 0: return  # empty, nothing to remove
 
             self.get_scaled_distances(event)
+            lo, hi = main_window.visible_peaks
+            nearest_point_index, distance = self.nearest_point(main_window.r_peak_points(main_window.curr_r_peaks_chunk[lo:hi]))
 
-            distances = np.sqrt(((self.main_window.curr_r_peaks_chunk[:,0] / self.x_range) - self.x_data_scaled)**2 + ((self.main_window.curr_r_peaks_chunk[:,1] / self.y_range) - self.y_data_scaled)**2)
-            nearest_point_index = distances.argmin()
+            if distance <= 0.01:
+                position = lo + nearest_point_index
+                edit = (session.REMOVE, main_window.curr_r_peaks_chunk[position], position)
+                main_window.curr_r_peaks_chunk = np.delete(main_window.curr_r_peaks_chunk, position)
+        if edit is not None:
+            op, sample, position = edit
+            main_window.handle_updated_r_peaks(edit=(op, position))
+            main_window.record_edit(op, sample)
+
+    def nearest_point(self, points, exact=False):
+        """
+        Finds the point nearest to the mouse click, in coordinates scaled by the size of the axes. Points 
+        further than 0.01 from the click along the time axis are only searched if exact is set and no 
+        point within that distance is found.
+
+        Args:
+            points (np.array): The times and voltages of the points, sorted by time
+            exact (bool, optional): Whether to find the nearest point however far away it is. Defaults to False.
+
+        Returns:
+            int: The index of the nearest point, or None if there is none
+            float: The scaled distance to the point, or inf if there is none
+        """
+        lo, hi = np.searchsorted(points[:,0], ((self.x_data_scaled - 0.01)*self.x_range, (self.x_data_scaled + 0.01)*self.x_range))
+        nearby = points[lo:hi]
+        distances = np.sqrt(((nearby[:,0] / self.x_range) - self.x_data_scaled)**2 + ((nearby[:,1] / self.y_range) - self.y_data_scaled)**2)
+        if len(distances) and distances.min() <= 0.01:
+            return lo + distances.argmin(), distances.min()
+        if not exact or len(points) == 0:
+            return None, np.inf
+        distances = np.sqrt(((points[:,0] / self.x_range) - self.x_data_scaled)**2 + ((points[:,1] / self.y_range) - self.y_data_scaled)**2)
+        return distances.argmin(), distances.min()
 
-            if distances[nearest_point_index] <= 0.01:
-                self.main_window.curr_r_peaks_chunk = np.delete(self.main_window.curr_r_peaks_chunk, nearest_point_index, 0)
-        self.main_window.handle_updated_r_peaks()
     def get_scaled_distances(self,event):
         """Scales the x and y values of the mouse click according to the length of the axes.
 
@@ -146,3 +180,243 @@ class SliderHandler(QSlider):
         self.setEnabled(False)  # Disabling the slider
         self.setValue(self.minimum())  # Resetting the slider to its minimum value
 
+class DebugPanel(QDialog):
+    """This class inherits from the QDialog class and is used for displaying the stage timing and 
+    memory report recorded by the instrumentation module. Recording can be switched on and off from 
+    the panel, and the report can be refreshed or cleared.
+
+    Args:
+        QDialog (QDialog): Inherits from the QDialog class.
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Stage Timings")
+        self.resize(900, 500)
+
+        self.enable_checkbox = QCheckBox("Record stage timings and memory")
+        self.enable_checkbox.setChecked(instrumentation.enabled)
+        self.enable_checkbox.toggled.connect(self.enable_toggled)
+
+        self.report_text = QPlainTextEdit()
+        self.report_text.setReadOnly(True)
+        self.report_text.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+
+        refresh_button = QPushButton("Refresh")
+        refresh_button.clicked.connect(self.refresh)
+        clear_button = QPushButton("Clear")
+        clear_button.clicked.connect(self.clear)
+
+        button_layout = QHBoxLayout()
+        button_layout.addWidget(refresh_button)
+        button_layout.addWidget(clear_button)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.enable_checkbox)
+        layout.addWidget(self.report_text)
+        layout.addLayout(button_layout)
+        self.setLayout(layout)
+        self.refresh()
+
+    def enable_toggled(self, checked):
+        if checked:
+            instrumentation.enable(instrumentation.log_path)
+        else:
+            instrumentation.disable()
+        self.refresh()
+
+    def refresh(self):
+        if instrumentation.enabled or instrumentation.records:
+            self.report_text.setPlainText(instrumentation.format_report())
+        else:
+            self.report_text.setPlainText("Stage timings are not being recorded. Tick the box above, or start the program with ECG_INSTRUMENT=1.")
+
+    def clear(self):
+        instrumentation.reset()
+        self.refresh()
+
+class BulkExportDialog(QDialog):
+    """This class inherits from the QDialog class and lets the user choose the formats to write when 
+    exporting the R Peaks and R-R Intervals of every segment at once and, when the data is divided
+    into segments, whether to export the whole file as a single segment instead.
+
+    Args:
+        QDialog (QDialog): Inherits from the QDialog class.
+    """
+    def __init__(self, has_segments, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Export All Segments")
+
+        self.text_tables_checkbox = QCheckBox("Text tables with segment and sample columns (.txt)")
+        self.text_tables_checkbox.setChecked(True)
+        self.segment_files_checkbox = QCheckBox("One text file per segment, as exported individually (.txt)")
+        self.npz_checkbox = QCheckBox("Columnar NumPy arrays (.npz)")
+        # Without segments the analysed range is exported as it is, so there is no choice to offer
+        self.whole_file_checkbox = QCheckBox("Export the whole file as one segment")
+        self.whole_file_checkbox.setVisible(has_segments)
+
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        button_box.accepted.connect(self.accept)
+        button_box.rejected.connect(self.reject)
+
+        layout = QVBoxLayout()
+        layout.addWidget(QLabel("Formats"))
+        layout.addWidget(self.text_tables_checkbox)
+        layout.addWidget(self.segment_files_checkbox)
+        layout.addWidget(self.npz_checkbox)
+        layout.addWidget(self.whole_file_checkbox)
+        layout.addWidget(button_box)
+        self.setLayout(layout)
+
+    def get_values(self):
+        formats = []
+        if self.text_tables_checkbox.isChecked():
+            formats.append(exporter.TEXT_TABLES)
+        if self.segment_files_checkbox.isChecked():
+            formats.append(exporter.SEGMENT_FILES)
+        if self.npz_checkbox.isChecked():
+            formats.append(exporter.NPZ)
+        return formats, self.whole_file_checkbox.isChecked()
+
+class RedetectDialog(QDialog):
+    """This class inherits from the QDialog class and lets the user choose the span of the current chunk
+    in which to detect the R Peaks again, defaulting to the visible part of the graph, and the thresholds
+    and margin to detect them with.
+
+    Args:
+        QDialog (QDialog): Inherits from the QDialog class.
+    """
+    DEFAULTS = {"max_mult": 0.8, "mean_mult": 0.8, "sample_length_mult": 1.0, "margin_seconds": p.REDETECT_MARGIN_SECONDS}
+
+    def __init__(self, start_time, end_time, minimum_time, maximum_time, settings=None, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Re-detect R Peaks")
+        settings = {**self.DEFAULTS, **(settings or {})}
+
+        self.start_edit = self.spin_box(minimum_time, maximum_time, 0.1, start_time, 3)
+        self.end_edit = self.spin_box(minimum_time, maximum_time, 0.1, end_time, 3)
+        self.max_mult_edit = self.spin_box(0.05, 1, 0.05, settings["max_mult"], 2)
+        self.max_mult_edit.setToolTip("The fraction of the largest voltage in each window that its tallest peaks must reach")
+        self.mean_mult_edit = self.spin_box(0.05, 2, 0.05, settings["mean_mult"], 2)
+        self.mean_mult_edit.setToolTip("The fraction of the mean of the tallest peaks that an R Peak must reach")
+        self.window_edit = self.spin_box(0.2, 10, 0.1, settings["sample_length_mult"], 1)
+        self.window_edit.setToolTip("The length of the windows the thresholds are calculated in")
+        self.margin_edit = self.spin_box(0, 60, 1, settings["margin_seconds"], 1)
+        self.margin_edit.setToolTip("The time either side of the span which is also searched, so the ends of the span are detected as in the whole recording")
+
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        button_box.accepted.connect(self.accept_check)
+        button_box.rejected.connect(self.reject)
+
+        layout = QFormLayout()
+        layout.addRow("Start (s)", self.start_edit)
+        layout.addRow("End (s)", self.end_edit)
+        layout.addRow("Window maximum fraction", self.max_mult_edit)
+        layout.addRow("Peak mean fraction", self.mean_mult_edit)
+        layout.addRow("Window length (s)", self.window_edit)
+        layout.addRow("Margin (s)", self.margin_edit)
+        layout.addRow(button_box)
+        self.setLayout(layout)
+
+    def spin_box(self, minimum, maximum, step, value, decimals):
+        spin_box = QDoubleSpinBox()
+        spin_box.setDecimals(decimals)
+        spin_box.setRange(minimum, maximum)
+        spin_box.setSingleStep(step)
+        spin_box.setValue(value)
+        return spin_box
+
+    def accept_check(self):
+        if self.end_edit.value() <= self.start_edit.value():
+            QMessageBox.warning(self, "Invalid Span", "The end of the span must be after its start.")
+            return
+        self.accept()
+
+    def get_values(self):
+        settings = {
+            "max_mult": self.max_mult_edit.value(),
+            "mean_mult": self.mean_mult_edit.value(),
+            "sample_length_mult": self.window_edit.value(),
+            "margin_seconds": self.margin_edit.value(),
+        }
+        return self.start_edit.value(), self.end_edit.value(), settings
+
+class ExportWorker(QThread):
+    """This class inherits from the QThread class and runs exporter.bulk_export on a background 
+    thread, so the window stays responsive while every segment is written.
+
+    Args:
+        QThread (QThread): Inherits from the QThread class.
+    """
+    finished_export = pyqtSignal(list)
+    failed = pyqtSignal(str)
+
+    def __init__(self, directory, file_name, r_peaks_list, timeseries, segments, sr, formats):
+        super().__init__()
+        self.args = (directory, file_name, r_peaks_list.copy(), timeseries, list(segments), sr, formats)
+
+    def run(self):
+        try:
+            self.finished_export.emit(exporter.bulk_export(*self.args))
+        except Exception as e:
+            self.failed.emit(str(e))
+
+class StatisticsDialog(QDialog):
+    """This class inherits from the QDialog class and shows a table of the R-R interval statistics of 
+    every segment. Rows are updated individually as peaks are edited, double-clicking a row displays 
+    that segment, and the table can be exported to a text file.
+
+    Args:
+        QDialog (QDialog): Inherits from the QDialog class.
+    """
+    def __init__(self, main_window):
+        super().__init__(main_window)
+        self.main_window = main_window
+        self.table = None
+        self.setWindowTitle("Segment Statistics")
+        self.resize(1100, 500)
+
+        self.table_widget = QTableWidget(0, len(hrv.COLUMN_TITLES))
+        self.table_widget.setHorizontalHeaderLabels(hrv.COLUMN_TITLES)
+        self.table_widget.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table_widget.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table_widget.verticalHeader().setVisible(False)
+        self.table_widget.cellDoubleClicked.connect(self.row_double_clicked)
+
+        export_button = QPushButton("Export Table")
+        export_button.clicked.connect(self.export_table)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.table_widget)
+        layout.addWidget(export_button)
+        self.setLayout(layout)
+
+    def set_table(self, table):
+        self.table = table
+        self.table_widget.setRowCount(len(table))
+        for i in range(len(table)):
+            self.update_row(i)
+
+    def update_row(self, i):
+        row = self.table[i]
+        for j, name in enumerate(hrv.STATS_DTYPE.names):
+            value = row[name]
+            if name in ('segment', 'beats'):
+                text = f"{int(value)}"
+            elif np.isnan(value):
+                text = ""
+            else:
+                text = f"{value:.1f}" if name in ('start_time', 'end_time', 'pnn50') else f"{value:.3f}"
+            self.table_widget.setItem(i, j, QTableWidgetItem(text))
+
+    def row_double_clicked(self, row, column):
+        self.main_window.go_to_segment(row)
+
+    def export_table(self):
+        file_directory = QFileDialog.getExistingDirectory(self, 'Save File', self.main_window.desktop_path)
+        if not file_directory:
+            return
+        file_path = os.path.join(file_directory, f"{self.main_window.file_name}_Segment_Statistics.txt")
+        try:
+            hrv.export_statistics(file_path, self.table)
+        except OSError as e:
+            QMessageBox.warning(self, "Export Failed", f"An error occurred while exporting the table: {e}")
@@ -0,0 +1,209 @@
+"""
+Per-segment heart rate variability statistics.
+
+segment_statistics computes the statistics of every segment at once from the full sorted list
+of R-peaks, using grouped NumPy reductions over the R-R intervals rather than a loop over the
+segments. update_segment recalculates the row of a single segment after its peaks are edited.
+Intervals are only calculated between peaks in the same segment.
+
+The R-R interval histogram is kept as bin counts per segment in the same way. interval_histograms
+counts every segment at once, and edit_histogram adjusts the counts of one segment for the peaks
+added or removed by hand, recounting only the intervals next to them. The histogram of the whole
+recording is the sum of the rows.
+"""
+import numpy as np
+import processor as p
+import exporter
+
+STATS_DTYPE = np.dtype([
+    ('segment', 'i8'),
+    ('start_time', 'f8'),
+    ('end_time', 'f8'),
+    ('beats', 'i8'),
+    ('mean_rr', 'f8'),
+    ('sdnn', 'f8'),
+    ('rmssd', 'f8'),
+    ('pnn50', 'f8'),
+    ('min_rr', 'f8'),
+    ('min_rr_time', 'f8'),
+    ('max_rr', 'f8'),
+    ('max_rr_time', 'f8'),
+])
+
+HISTOGRAM_BINS = np.arange(0, 2, 0.1)
+
+COLUMN_TITLES = ["Segment", "Start (s)", "End (s)", "Beats", "Mean RR (s)", "SDNN (s)", "RMSSD (s)",
+                 "pNN50 (%)", "Min RR (s)", "Min RR at (s)", "Max RR (s)", "Max RR at (s)"]
+
+
+def segment_statistics(r_peaks_list, segments, sr, first_sample=0):
+    """
+    Calculates the beat count, mean R-R interval, SDNN, RMSSD, pNN50 and the smallest and largest
+    R-R intervals with their positions for every segment.
+
+    Args:
+        r_peaks_list (np.array): The sorted sample indices of the R Peaks
+        segments (list): The (start, end) sample indices of each segment
+        sr (int): The sampling rate of the data
+        first_sample (int, optional): The row of the file the sample indices start at, when only part 
+        of the file is loaded. The times in the table are times in the file. Defaults to 0.
+
+    Returns:
+        np.array: A structured array of STATS_DTYPE with one row per segment. Statistics
+        which need more beats than the segment has are NaN.
+    """
+    num_segments = len(segments)
+    bounds = np.asarray(segments, dtype=np.int64).reshape(-1, 2)
+    table = np.zeros(num_segments, dtype=STATS_DTYPE)
+    table['segment'] = np.arange(1, num_segments + 1)
+    table['start_time'] = (bounds[:, 0] + first_sample) / sr
+    table['end_time'] = (bounds[:, 1] + first_sample) / sr
+
+    segment_ids = p.label_segments(r_peaks_list, segments)
+    keep = segment_ids >= 0
+    segment_ids, times = segment_ids[keep], (r_peaks_list[keep] + first_sample) / sr
+    table['beats'] = np.bincount(segment_ids, minlength=num_segments)
+
+    same_segment = segment_ids[1:] == segment_ids[:-1]
+    rr = np.diff(times)[same_segment]
+    rr_segments = segment_ids[1:][same_segment]
+    rr_times = times[:-1][same_segment]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        counts = np.bincount(rr_segments, minlength=num_segments)
+        mean = np.bincount(rr_segments, weights=rr, minlength=num_segments) / counts
+        squares = np.bincount(rr_segments, weights=(rr - mean[rr_segments])**2, minlength=num_segments)
+        table['mean_rr'] = mean
+        table['sdnn'] = np.where(counts > 1, np.sqrt(squares / np.maximum(counts - 1, 1)), np.nan)
+
+        consecutive = rr_segments[1:] == rr_segments[:-1]
+        successive = np.diff(rr)[consecutive]
+        successive_segments = rr_segments[1:][consecutive]
+        successive_counts = np.bincount(successive_segments, minlength=num_segments)
+        table['rmssd'] = np.sqrt(np.bincount(successive_segments, weights=successive**2, minlength=num_segments) / successive_counts)
+        table['pnn50'] = 100 * np.bincount(successive_segments, weights=np.abs(successive) > 0.05, minlength=num_segments) / successive_counts
+
+    table['min_rr'] = table['min_rr_time'] = table['max_rr'] = table['max_rr_time'] = np.nan
+    has_rr = counts > 0
+    # The first interval of each segment after sorting by (segment, rr) is its smallest
+    group_starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[has_rr]
+    order = np.lexsort((rr, rr_segments))
+    table['min_rr'][has_rr] = rr[order[group_starts]]
+    table['min_rr_time'][has_rr] = rr_times[order[group_starts]]
+    order = np.lexsort((-rr, rr_segments))
+    table['max_rr'][has_rr] = rr[order[group_starts]]
+    table['max_rr_time'][has_rr] = rr_times[order[group_starts]]
+    return table
+
+
+def update_segment(table, r_peaks_list, segments, sr, segment_idx, first_sample=0):
+    """
+    Recalculates the statistics of one segment in place, touching only the peaks in that segment.
+
+    Args:
+        table (np.array): The table returned by segment_statistics
+        r_peaks_list (np.array): The sorted sample indices of the R Peaks
+        segments (list): The (start, end) sample indices of each segment
+        sr (int): The sampling rate of the data
+        segment_idx (int): The index of the edited segment
+        first_sample (int, optional): The row of the file the sample indices start at. Defaults to 0.
+    """
+    start_sample, end_sample = segments[segment_idx]
+    row = segment_statistics(p.peak_range(r_peaks_list, start_sample, end_sample), [(start_sample, end_sample)], sr, first_sample)[0]
+    row['segment'] = table[segment_idx]['segment']
+    table[segment_idx] = row
+
+
+def interval_counts(r_peaks_list, sr, bin_edges=HISTOGRAM_BINS):
+    """
+    Counts the R-R intervals between consecutive R Peaks in each bin, as np.histogram does. Intervals 
+    outside the bins are not counted.
+
+    Args:
+        r_peaks_list (np.array): The sorted sample indices of the R Peaks
+        sr (int): The sampling rate of the data
+        bin_edges (np.array, optional): The edges of the bins in seconds. Defaults to HISTOGRAM_BINS.
+
+    Returns:
+        np.array: The number of intervals in each bin
+    """
+    return np.histogram(np.diff(r_peaks_list) / sr, bins=bin_edges)[0]
+
+
+def interval_histograms(r_peaks_list, segments, sr, bin_edges=HISTOGRAM_BINS):
+    """
+    Counts the R-R intervals of every segment in each bin of the histogram.
+
+    Args:
+        r_peaks_list (np.array): The sorted sample indices of the R Peaks
+        segments (list): The (start, end) sample indices of each segment
+        sr (int): The sampling rate of the data
+        bin_edges (np.array, optional): The edges of the bins in seconds. Defaults to HISTOGRAM_BINS.
+
+    Returns:
+        np.array: The counts with one row per segment and one column per bin
+    """
+    num_bins = len(bin_edges) - 1
+    segment_ids = p.label_segments(r_peaks_list, segments)
+    keep = segment_ids >= 0
+    segment_ids, samples = segment_ids[keep], r_peaks_list[keep]
+    same_segment = segment_ids[1:] == segment_ids[:-1]
+    rr = (np.diff(samples) / sr)[same_segment]
+    rr_segments = segment_ids[1:][same_segment]
+    bins = np.searchsorted(bin_edges, rr, side='right') - 1
+    # The last bin includes its right edge, as in np.histogram
+    bins[rr == bin_edges[-1]] = num_bins - 1
+    inside = (bins >= 0) & (bins < num_bins)
+    counts = np.bincount(rr_segments[inside]*num_bins + bins[inside], minlength=len(segments)*num_bins)
+    return counts.reshape(len(segments), num_bins)
+
+
+def update_histogram(counts, r_peaks_list, segments, sr, segment_idx, bin_edges=HISTOGRAM_BINS):
+    """
+    Recounts the R-R intervals of one segment in place, touching only the peaks in that segment.
+
+    Args:
+        counts (np.array): The counts returned by interval_histograms
+        r_peaks_list (np.array): The sorted sample indices of the R Peaks
+        segments (list): The (start, end) sample indices of each segment
+        sr (int): The sampling rate of the data
+        segment_idx (int): The index of the edited segment
+        bin_edges (np.array, optional): The edges of the bins in seconds. Defaults to HISTOGRAM_BINS.
+    """
+    start_sample, end_sample = segments[segment_idx]
+    counts[segment_idx] = interval_counts(p.peak_range(r_peaks_list, start_sample, end_sample), sr, bin_edges)
+
+
+def edit_histogram(counts, r_peaks_list, segments, sr, segment_idx, added=(), removed=(), bin_edges=HISTOGRAM_BINS):
+    """
+    Adjusts the counts of one segment in place for R Peaks added or removed by hand. Only the intervals
+    between the peaks either side of the edited peaks change, so only their bins are recounted.
+
+    Args:
+        counts (np.array): The counts returned by interval_histograms
+        r_peaks_list (np.array): The sorted sample indices of the R Peaks after the edit
+        segments (list): The (start, end) sample indices of each segment
+        sr (int): The sampling rate of the data
+        segment_idx (int): The index of the edited segment
+        added (np.array, optional): The sample indices of the added R Peaks. Defaults to ().
+        removed (np.array, optional): The sample indices of the removed R Peaks. Defaults to ().
+        bin_edges (np.array, optional): The edges of the bins in seconds. Defaults to HISTOGRAM_BINS.
+    """
+    edited = np.concatenate((np.asarray(added, dtype=np.int64), np.asarray(removed, dtype=np.int64)))
+    if len(edited) == 0:
+        return
+    start_sample, end_sample = segments[segment_idx]
+    lo = max(np.searchsorted(r_peaks_list, edited.min()) - 1, np.searchsorted(r_peaks_list, start_sample))
+    hi = min(np.searchsorted(r_peaks_list, edited.max(), side='right') + 1, np.searchsorted(r_peaks_list, end_sample))
+    after = r_peaks_list[lo:hi]
+    before = np.union1d(np.setdiff1d(after, added), removed)
+    counts[segment_idx] += interval_counts(after, sr, bin_edges) - interval_counts(before, sr, bin_edges)
+
+
+def export_statistics(file_path, table):
+    """
+    Writes the statistics table to a tab-separated text file with a header line.
+    """
+    columns = np.column_stack([table[name].astype(float) for name in STATS_DTYPE.names])
+    fmts = ['%d', '%.3f', '%.3f', '%d'] + ['%.6f'] * (len(STATS_DTYPE.names) - 4)
+    exporter.write_text(file_path, columns, fmt=fmts, header='\t'.join(COLUMN_TITLES))
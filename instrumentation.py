@@ -0,0 +1,145 @@
+"""
+Timing and memory instrumentation for the stages of the analysis pipeline.
+
+Instrumentation is disabled by default, in which case stage() returns a shared no-op
+context manager and nothing is measured. It is enabled by calling enable(), or by setting
+the ECG_INSTRUMENT environment variable (ECG_INSTRUMENT_LOG=path also appends every
+record to a JSON lines log file).
+
+    with instrumentation.stage("filter", samples=len(timeseries)) as s:
+        ...
+        s.count(peaks=len(peaks))
+"""
+import json
+import os
+import time
+import tracemalloc
+
+enabled = False
+log_path = None
+records = []
+_stack = []
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def count(self, **counts):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """
+    Records the wall time, CPU time, peak allocated bytes and item counts of one stage.
+    """
+    def __init__(self, name, counts):
+        self.name = name
+        self.counts = counts
+
+    def __enter__(self):
+        current, peak = tracemalloc.get_traced_memory()
+        if _stack:
+            parent = _stack[-1]
+            parent.peak = max(parent.peak, peak)
+        tracemalloc.reset_peak()
+        self.start_bytes = current
+        self.peak = current
+        self.record = {"stage": self.name, "depth": len(_stack)}
+        records.append(self.record)
+        _stack.append(self)
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start_wall
+        cpu = time.process_time() - self.start_cpu
+        _, peak = tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, peak)
+        _stack.pop()
+        if _stack:
+            _stack[-1].peak = max(_stack[-1].peak, self.peak)
+        record = self.record
+        record.update(wall_s=wall, cpu_s=cpu, peak_bytes=self.peak - self.start_bytes, **self.counts)
+        if log_path:
+            with open(log_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        return False
+
+    def count(self, **counts):
+        self.counts.update({k: int(v) for k, v in counts.items()})
+
+
+def stage(name, **counts):
+    """
+    Returns a context manager which measures the enclosed stage when instrumentation is enabled.
+
+    Args:
+        name (str): The name of the stage
+        **counts (int): Item counts of the stage, such as samples, peaks or segments
+
+    Returns:
+        context manager: Has a count(**counts) method to add counts known only at the end of the stage
+    """
+    if not enabled:
+        return _NULL_STAGE
+    return _Stage(name, {k: int(v) for k, v in counts.items()})
+
+
+def enable(log_file=None):
+    """
+    Enables instrumentation and starts tracing memory allocations.
+
+    Args:
+        log_file (str, optional): A JSON lines file that every record is appended to. Defaults to None.
+    """
+    global enabled, log_path
+    enabled = True
+    log_path = log_file
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    global enabled, log_path
+    enabled = False
+    log_path = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def reset():
+    records.clear()
+
+
+def report():
+    """
+    Returns the finished stages in the order they started.
+
+    Returns:
+        list: One dict per stage with the stage name, nesting depth, wall_s, cpu_s, peak_bytes and counts
+    """
+    return [dict(record) for record in records if "wall_s" in record]
+
+
+def format_report():
+    """
+    Formats the recorded stages as a text table, with nested stages indented.
+    """
+    lines = [f"{'stage':<32}{'wall ms':>10}{'cpu ms':>10}{'peak MB':>10}  counts"]
+    for record in report():
+        counts = ", ".join(f"{k}={v}" for k, v in record.items() if k not in ("stage", "depth", "wall_s", "cpu_s", "peak_bytes"))
+        name = "  " * record["depth"] + record["stage"]
+        lines.append(f"{name:<32}{record['wall_s']*1000:>10.1f}{record['cpu_s']*1000:>10.1f}{record['peak_bytes']/2**20:>10.1f}  {counts}")
+    return "\n".join(lines)
+
+
+if os.environ.get("ECG_INSTRUMENT") or os.environ.get("ECG_INSTRUMENT_LOG"):
+    enable(os.environ.get("ECG_INSTRUMENT_LOG"))
@@ -1,6 +1,6 @@
 import sys
 import os
-from PyQt5.QtWidgets import QApplication, QMainWindow, QFileDialog, QGridLayout, QPushButton, QWidget, QLabel, QSlider,QButtonGroup, QMessageBox, QInputDialog, QHBoxLayout
+from PyQt5.QtWidgets import QApplication, QMainWindow, QFileDialog, QGridLayout, QPushButton, QWidget, QLabel, QSlider,QButtonGroup, QMessageBox, QInputDialog, QHBoxLayout, QDialog, QComboBox, QCheckBox
 from PyQt5.QtCore import Qt, QDir
 from matplotlib.figure import Figure
 import numpy as np
@@ -8,12 +8,23 @@ import processor as p
 import no_pulse_handler as nopul
 import pulse_handler as pul
 import gui as gui
+import instrumentation
+import session
+import exporter
+import hrv
+import anomaly
+import signal_quality as sq
+import workspace
+import multilead
+import edf
             
 
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
         
+        self.workspace = workspace.Workspace()
+        self.redetect_settings = None
         self.initialise_variables()
         self.setup_ui()
     
@@ -27,22 +38,41 @@ class MainWindow(QMainWindow):
         self.file_data = None
         self.file_width = 0 
         self.file_length = 0
+        self.row_index = None
+        self.opened_data = None
+        self.first_sample = 0
         
         self.raw_timeseries = np.empty((0,0))
         self.filtered_timeseries = np.empty((0,0))
         self.primary_timeseries = np.empty((0,0))
         
-        self.r_peaks_list = np.empty((0,0))
+        self.r_peaks_list = np.empty(0, dtype=np.int64)
         self.snr = 0
+        self.session = None
+        self.segment_stats = None
+        self.interval_index = None
+        self.rr_histogram = None
+        self.quality_window = 0
+        self.quality_signal_energy = np.empty(0)
+        self.quality_noise_energy = np.empty(0)
+        self.quality_snr = np.empty(0)
+        self.noisy_windows = np.empty(0, dtype=np.int64)
+        self.chunk_snr = {}
         
-        self.pulse_timeseries = np.empty((0,0))
+        self.pulse_edges = np.empty(0, dtype=p.EDGE_DTYPE)
+        self.lead_columns = []
+        self.leads = None
+        self.lead_peaks = None
+        self.lead_markers = []
         self.segments = None
         self.num_segments = 0
         self.curr_segment_idx = 0
         self.curr_raw_chunk = np.empty((0,0))
         self.curr_filtered_chunk = np.empty((0,0))
         self.curr_primary_chunk = np.empty((0,0))
-        self.curr_r_peaks_chunk = np.empty((0,2))
+        self.curr_r_peaks_chunk = np.empty(0, dtype=np.int64)
+        self.curr_chunk_start = 0
+        self.visible_peaks = (0, 0)
         
         self.start_time = 0 
         self.end_time = 1
@@ -56,6 +86,7 @@ class MainWindow(QMainWindow):
         self.overlay_on = False
         self.plot2 = None
         self.selected_filtering = None
+        self.reduced_rate_detection = False
         self.max_interval_pos = 0
         self.min_interval_pos = 0
         self.average_interval = 0
@@ -63,6 +94,9 @@ class MainWindow(QMainWindow):
         self.desktop_path = QDir.homePath() + "/Desktop"
         self.analyse_whole_dataset = False
         self.showing_hist = False
+        self.debug_panel = None
+        self.stats_dialog = None
+        self.recording_key = None
         
     def setup_ui(self):
         """
@@ -79,9 +113,9 @@ class MainWindow(QMainWindow):
         self.info_label = QLabel("")
         
         self.max_interval_button = QPushButton('Max Interval (Q)')
-        self.max_interval_button.clicked.connect(self.to_max_interval)
+        self.max_interval_button.clicked.connect(lambda: self.to_ranked_interval(anomaly.LARGEST))
         self.min_interval_button = QPushButton('Min Interval (W)')
-        self.min_interval_button.clicked.connect(self.to_min_interval)
+        self.min_interval_button.clicked.connect(lambda: self.to_ranked_interval(anomaly.SMALLEST))
         
         interval_button_layout = QGridLayout()
         interval_button_layout.addWidget(self.max_interval_button,0,0)
@@ -95,10 +129,42 @@ class MainWindow(QMainWindow):
         self.graph_toggle_button = QPushButton("Display R-R Interval Histogram")
         self.graph_toggle_button.clicked.connect(self.graph_toggler)
         self.graph_toggle_button.setEnabled(False)
+
+        self.whole_histogram_checkbox = QCheckBox("Whole Recording")
+        self.whole_histogram_checkbox.setToolTip("Show the R-R intervals of every segment in the histogram")
+        self.whole_histogram_checkbox.toggled.connect(lambda: self.showing_hist and self.plot_r_r_histogram())
+        self.whole_histogram_checkbox.setEnabled(False)
+
+        graph_toggle_layout = QGridLayout()
+        graph_toggle_layout.addWidget(self.graph_toggle_button,0,0)
+        graph_toggle_layout.addWidget(self.whole_histogram_checkbox,0,1)
+
+        self.statistics_button = QPushButton("Segment Statistics")
+        self.statistics_button.clicked.connect(self.show_statistics)
+        self.statistics_button.setEnabled(False)
         
         self.figure = Figure(figsize=(10,5))
-        self.ax = self.figure.add_subplot(111)
-        self.scatter = self.ax.scatter(self.curr_r_peaks_chunk[:,0],self.curr_r_peaks_chunk[:,1], color = 'red',zorder=3)
+        grid_spec = self.figure.add_gridspec(2, 1, height_ratios=[12, 1], hspace=0.05)
+        self.ax = self.figure.add_subplot(grid_spec[0])
+        self.quality_ax = self.figure.add_subplot(grid_spec[1], sharex=self.ax)
+        self.quality_ax.set_yticks([])
+        self.quality_ax.set_ylabel("SNR", rotation=0, ha='right', va='center')
+        self.quality_image = None
+        self.plot, = self.ax.plot([], [], zorder=2)
+        self.scatter = self.ax.scatter([], [], color = 'red',zorder=3)
+        self.interactive_points = gui.InteractivePoints(self, self.scatter)
+        # Only the R Peaks inside the x limits have markers, so they are moved whenever the graph is panned or zoomed
+        self.ax.callbacks.connect('xlim_changed', self.update_visible_r_peaks)
+
+        # The histogram has its own axes in place of the ECG graph, so toggling only changes which is visible
+        self.hist_ax = self.figure.add_subplot(grid_spec[:, 0])
+        self.hist_ax.set_visible(False)
+        bin_edges = hrv.HISTOGRAM_BINS
+        self.hist_bars = self.hist_ax.bar(bin_edges[:-1], np.zeros(len(bin_edges) - 1), width=np.diff(bin_edges), align='edge', edgecolor='black')
+        self.hist_labels = []
+        for position, text in ((0.6, '600 ms'), (1.2, '1200 ms')):
+            self.hist_ax.axvline(position, color='r', linestyle='--')
+            self.hist_labels.append(self.hist_ax.text(position, 0, text, color='r', ha='center'))
         
         self.slider = gui.SliderHandler(self)
         
@@ -142,20 +208,32 @@ class MainWindow(QMainWindow):
         self.export_rr_intervals_button.clicked.connect(lambda: self.export_function(False))
         self.export_rr_intervals_button.setEnabled(False)
         self.export_r_peaks_button.setEnabled(False)
+        self.export_all_button = QPushButton('Export All Segments')
+        self.export_all_button.clicked.connect(self.bulk_export_function)
+        self.export_all_button.setEnabled(False)
+        self.export_worker = None
+
+        self.recording_selector = QComboBox()
+        self.recording_selector.setToolTip("Switch to another opened recording")
+        self.recording_selector.activated.connect(self.switch_recording)
+        self.recording_selector.setEnabled(False)
         
         export_button_layout = QGridLayout()
         export_button_layout.addWidget(self.export_r_peaks_button,0,0)
         export_button_layout.addWidget(self.export_rr_intervals_button,0,1)
+        export_button_layout.addWidget(self.export_all_button,0,2)
         
         self.grid_layout = QGridLayout()
         self.grid_layout.addWidget(self.select_file_button, 0,1,1,2)
         self.grid_layout.addWidget(self.info_label,0,0)
         self.grid_layout.addWidget(self.overlay_toggle_button, 0, 3)
         self.grid_layout.addLayout(interval_button_layout, 1,0)
-        self.grid_layout.addWidget(self.graph_toggle_button,1,1,1,2)
+        self.grid_layout.addLayout(graph_toggle_layout,1,1,1,2)
+        self.grid_layout.addWidget(self.statistics_button,1,3)
         self.grid_layout.addWidget(self.scrollable_window, 2, 0, 5 ,4)
         self.grid_layout.addWidget(self.re_run_analysis_button,7,0)
         self.grid_layout.addLayout(export_button_layout,7,1,1,2)
+        self.grid_layout.addWidget(self.recording_selector,7,3)
         self.grid_layout.addWidget(self.slider,9,0,1,4)
         self.grid_layout.addWidget(self.zoom_buttons_label, 10, 0)
         self.grid_layout.addLayout(zoom_button_layout, 10, 1,1,2)
@@ -172,6 +250,9 @@ class MainWindow(QMainWindow):
         Args:
             event (QKeyEvent): The key press event.
         """
+        if event.key() == Qt.Key_F12:
+            self.show_debug_panel()
+            return
         if not self.showing_hist:
             key = event.key()
             if key in [Qt.Key_1, Qt.Key_2, Qt.Key_3, Qt.Key_4, Qt.Key_5]:
@@ -182,27 +263,56 @@ class MainWindow(QMainWindow):
                     zoom_level = 10
                 self.set_zoom(zoom_level)
             elif key == Qt.Key_Q:
-                self.to_max_interval()
+                self.to_ranked_interval(anomaly.LARGEST)
             elif key == Qt.Key_W:
-                self.to_min_interval()
+                self.to_ranked_interval(anomaly.SMALLEST)
+            elif key == Qt.Key_N:
+                self.to_noisy_region(1)
+            elif key == Qt.Key_B:
+                self.to_noisy_region(-1)
+
+    def show_debug_panel(self):
+        """
+        This function opens the panel showing the recorded stage timings and memory use.
+        """
+        if self.debug_panel is None:
+            self.debug_panel = gui.DebugPanel(self)
+        self.debug_panel.refresh()
+        self.debug_panel.show()
+        self.debug_panel.raise_()
 
     def select_file(self):
         """
         This function opens a file dialog to select a file.
 
         """
+        self.save_session()
+        self.store_recording()
         self.initialise_variables()
+        self.max_interval_button.setText('Max Interval (Q)')
+        self.min_interval_button.setText('Min Interval (W)')
         self.file_path, ok = QFileDialog.getOpenFileName(self, 'Open File', self.desktop_path)
         if ok: 
             if not os.path.isfile(self.file_path):
                 choice = gui.ErrorMessage("You have not selected a valid file. Would you like to try again or quit the application?", self.select_file, self.file_path)
                 return choice
-            elif not self.file_path.lower().endswith('.txt') and not self.file_path.lower().endswith('.rtf') :
-                choice = gui.ErrorMessage("The selected file is not a .txt or .rtf file. Would you like to try again or quit the application?", self.select_file, self.file_path)
+            # Text exports can also be compressed, and are decompressed while they are read
+            text_path = os.path.splitext(self.file_path)[0] if p.is_compressed(self.file_path) else self.file_path
+            if not text_path.lower().endswith(('.txt', '.rtf')) and not self.file_path.lower().endswith('.edf'):
+                choice = gui.ErrorMessage("The selected file is not a .txt, .rtf or .edf file (the text files can be compressed with gzip, bzip2 or xz). Would you like to try again or quit the application?", self.select_file, self.file_path)
                 return choice
-            self.file_name = os.path.basename(self.file_path)
+            self.file_name = os.path.basename(text_path)
             self.file_name, _ = os.path.splitext(self.file_name)  # this line removes the extension from the filename
-            self.prompt_sr()
+            if self.file_path.lower().endswith('.edf'):
+                # EDF files record their sampling rate in the header
+                try:
+                    self.sr = edf.sampling_rate(edf.read_header(self.file_path))
+                except (OSError, ValueError) as e:
+                    choice = gui.ErrorMessage(f"Error opening file: {str(e)}", self.select_file, self.file_path)
+                    return choice
+                self.open_file_handler()
+            else:
+                self.prompt_sr()
 
     def prompt_sr(self):
         """
@@ -225,17 +335,68 @@ class MainWindow(QMainWindow):
             Calls self.has_pulse_button() if the file is opened successfully.
         """
         try:
-            self.file_data, self.file_length, self.file_width, self.num_rows_removed = p.file_opener(self.file_path, self.sr)
-            self.percentage_removed = round((self.num_rows_removed/(self.num_rows_removed+self.file_length))*100,2)
+            if self.file_path.lower().endswith('.edf'):
+                self.opened_data, self.file_length, self.file_width, _ = edf.file_opener(self.file_path, self.sr)
+            elif p.is_compressed(self.file_path):
+                # A compressed file cannot be read from an offset, so it is parsed in full once
+                self.opened_data, self.file_length, self.file_width, self.num_rows_removed = p.file_opener(self.file_path, self.sr)
+                self.show_rows_removed(self.num_rows_removed, self.file_length)
+            else:
+                self.row_index = p.row_index(self.file_path)
+                self.file_length, self.file_width = self.row_index["num_rows"], self.row_index["num_columns"]
         except Exception as e:
             choice = gui.ErrorMessage(f"Error opening file: {str(e)}", self.open_file_handler, self.file_path)
             return choice
-        if (self.file_data is None or self.file_length <= 0 or self.file_width <= 1):
+        if (self.file_length <= 0 or self.file_width <= 1):
             choice = gui.ErrorMessage("Data could not be imported",self.select_file, self.file_path)
             return choice
-        QMessageBox.information(self, "Data Rows Removed", f"{self.num_rows_removed} rows of invalid data were removed,\nrepresenting {self.percentage_removed}% of the original data.")
         self.has_pulse_button()
 
+    def load_file_data(self, start_row=0, end_row=None):
+        """
+        This function parses the rows of the file which are analysed. The whole file is parsed unless a
+        range of rows is given, which is read through the row index without parsing the rows before it.
+        EDF files are memory-mapped, and compressed files were parsed when they were opened, so only the 
+        rows are taken from them.
+
+        Args:
+            start_row (int, optional): The first row to load. Defaults to 0.
+            end_row (int, optional): The row after the last row to load. Defaults to None, the end of the file.
+
+        Returns:
+            bool: True if the data was loaded
+        """
+        try:
+            if self.opened_data is not None:
+                self.first_sample = max(0, start_row)
+                end_row = self.file_length if end_row is None else end_row
+                if isinstance(self.opened_data, edf.EDFData):
+                    self.file_data = self.opened_data.rows(self.first_sample, end_row)
+                else:
+                    self.file_data = self.opened_data[self.first_sample:end_row]
+            elif start_row <= 0 and (end_row is None or end_row >= self.file_length):
+                self.file_data, self.file_length, self.file_width, self.num_rows_removed = p.file_opener(self.file_path, self.sr)
+                self.first_sample = 0
+            else:
+                self.file_data, _, self.file_width, self.num_rows_removed = p.read_rows(self.file_path, self.sr, start_row, end_row, self.row_index)
+                self.first_sample = max(0, start_row)
+        except Exception as e:
+            gui.ErrorMessage(f"Error opening file: {str(e)}", self.open_file_handler, self.file_path)
+            return False
+        if len(self.file_data) == 0:
+            gui.ErrorMessage("Data could not be imported",self.select_file, self.file_path)
+            return False
+        if self.opened_data is None:
+            self.show_rows_removed(self.num_rows_removed, len(self.file_data))
+        return True
+
+    def show_rows_removed(self, num_rows_removed, num_rows):
+        """
+        This function tells the user how many values of invalid data were changed to 0s.
+        """
+        self.percentage_removed = round((num_rows_removed/(num_rows_removed+num_rows))*100,2)
+        QMessageBox.information(self, "Data Rows Removed", f"{num_rows_removed} rows of invalid data were removed,\nrepresenting {self.percentage_removed}% of the original data.")
+
     def has_pulse_button(self):
         """
         This function asks the user if the segments are defined by a pulse.
@@ -250,17 +411,22 @@ class MainWindow(QMainWindow):
             if self.file_width < 3: 
                 QMessageBox.warning(self, "Invalid File", "The selected file does not have enough columns to be divided by a pulse. Please select a different file.")
                 self.has_pulse_button()
-            self.prev_button = QPushButton("Previous Segment")
-            self.grid_layout.addWidget(self.prev_button, 8,1,1,1)
-            self.prev_button.clicked.connect(self.prev_button_clicked)
-            self.prev_button.setEnabled(False)
-            self.next_button = QPushButton("Next Segment")
-            self.grid_layout.addWidget(self.next_button, 8,2,1,1)
-            self.next_button.clicked.connect(self.next_button_clicked)
-            
+            self.add_segment_buttons()
             pul.pulse_settings_pane(self)
         else: nopul.no_pulse_settings_pane(self)
     
+    def add_segment_buttons(self):
+        """
+        This function adds the previous and next segment buttons used to navigate pulse segments.
+        """
+        self.prev_button = QPushButton("Previous Segment")
+        self.grid_layout.addWidget(self.prev_button, 8,1,1,1)
+        self.prev_button.clicked.connect(self.prev_button_clicked)
+        self.prev_button.setEnabled(False)
+        self.next_button = QPushButton("Next Segment")
+        self.grid_layout.addWidget(self.next_button, 8,2,1,1)
+        self.next_button.clicked.connect(self.next_button_clicked)
+
     def handle_data_analysis_result(self):
         """
         This function handles the result of the data analysis.
@@ -284,58 +450,136 @@ class MainWindow(QMainWindow):
         """
         This function plots the ECG data on the graph.
         """
-        self.ax.clear()
-        self.graph_toggle_button.setText("Display R-R Interval Histogram")
-
-        self.plot, = self.ax.plot(self.curr_primary_chunk[:,0],self.curr_primary_chunk[:,1],zorder=2)
-        self.scatter = self.ax.scatter(self.curr_r_peaks_chunk[:,0],self.curr_r_peaks_chunk[:,1], color = 'red',zorder=3)
-        self.interactive_points = gui.InteractivePoints(self, self.scatter)
+        with instrumentation.stage("plot ecg", samples=len(self.curr_primary_chunk), peaks=len(self.curr_r_peaks_chunk)):
+            self.clear_chunk_artists()
+            self.plot.set_data(self.curr_primary_chunk[:,0],self.curr_primary_chunk[:,1])
+            self.plot_leads()
+            self.ax.relim()
+            self.ax.autoscale_view(scalex=False)
+            self.showing_hist = False
         
-        self.ax.set_xlim(self.curr_primary_chunk[0,0], self.curr_primary_chunk[0,0]+self.x_width)
-
-        self.slider.setMinimum(self.minimum_x)
-        self.slider.setMaximum(int((self.minimum_x+ (len(self.curr_primary_chunk[:,0])/(self.sr)))-self.x_width))
-        self.slider.setEnabled(True)
-        self.export_r_peaks_button.setEnabled(True)
-        self.export_rr_intervals_button.setEnabled(True)
-        self.re_run_analysis_button.setEnabled(True)
-        self.overlay_toggle_button.setEnabled(True)
-        self.max_interval_button.setEnabled(True)
-        self.min_interval_button.setEnabled(True)
-        self.graph_toggle_button.setEnabled(True)
-        self.re_run_analysis_button.setEnabled(True)
-        self.showing_hist = False
-        self.ax.figure.canvas.draw()
+            self.ax.set_xlim(self.curr_primary_chunk[0,0], self.curr_primary_chunk[0,0]+self.x_width)
+            self.plot_quality_strip()
+
+            self.slider.setMinimum(self.minimum_x)
+            self.slider.setMaximum(int((self.minimum_x+ (len(self.curr_primary_chunk[:,0])/(self.sr)))-self.x_width))
+            self.show_ecg_graph()
+
+    def show_ecg_graph(self):
+        """
+        This function shows the ECG graph in place of the R-R Interval histogram, as it was when the histogram was shown.
+        """
+        with instrumentation.stage("show ecg", peaks=len(self.curr_r_peaks_chunk)):
+            self.hist_ax.set_visible(False)
+            self.ax.set_visible(True)
+            self.quality_ax.set_visible(True)
+            self.graph_toggle_button.setText("Display R-R Interval Histogram")
+            self.whole_histogram_checkbox.setEnabled(False)
+            self.showing_hist = False
+            self.update_visible_r_peaks()
+
+            self.slider.setEnabled(True)
+            self.export_r_peaks_button.setEnabled(True)
+            self.export_rr_intervals_button.setEnabled(True)
+            self.export_all_button.setEnabled(True)
+            self.statistics_button.setEnabled(True)
+            self.re_run_analysis_button.setEnabled(True)
+            self.overlay_toggle_button.setEnabled(True)
+            self.max_interval_button.setEnabled(True)
+            self.min_interval_button.setEnabled(True)
+            self.graph_toggle_button.setEnabled(True)
+            self.re_run_analysis_button.setEnabled(True)
+            self.ax.figure.canvas.draw()
+
+    def clear_chunk_artists(self):
+        """
+        This function removes the lines, labels and markers drawn for the previous chunk from the graph, 
+        keeping the ECG line and the R Peak markers, which are reused.
+        """
+        for artist in [*self.ax.lines, *self.ax.texts, *self.ax.collections]:
+            if artist is not self.plot and artist is not self.scatter:
+                artist.remove()
+        self.plot2 = None
+        self.lead_markers = []
+
+    def plot_leads(self):
+        """
+        This function draws the other leads of a multi-lead recording stacked under the displayed lead. Each 
+        lead is marked with a dot at the R Peaks it agrees with and a cross at those it does not.
+        """
+        self.lead_markers = []
+        if self.leads is None:
+            return
+        chunk = self.leads[self.curr_chunk_start:self.curr_chunk_start+len(self.curr_primary_chunk)]
+        spacing = 1.2*np.ptp(chunk, axis=0).max()
+        for lead in range(1, chunk.shape[1]):
+            offset = -lead*spacing
+            self.ax.plot(self.curr_primary_chunk[:len(chunk),0], chunk[:,lead]+offset, color='grey', linewidth=0.8, zorder=1)
+            self.ax.annotate(f"Column {self.lead_columns[lead]}", xy=(0.005, offset), xycoords=('axes fraction', 'data'), color='grey')
+            agreed = self.ax.scatter([], [], color='green', s=12, zorder=3)
+            missing = self.ax.scatter([], [], color='orange', marker='x', zorder=3)
+            self.lead_markers.append((lead, offset, agreed, missing))
+
+    def update_lead_markers(self):
+        """
+        This function moves the agreement marks of the stacked leads to the R Peaks inside the x limits.
+        """
+        if not self.lead_markers:
+            return
+        lo, hi = self.visible_peaks
+        r_peaks = self.curr_r_peaks_chunk[lo:hi]
+        agreement = multilead.agreement(r_peaks, self.lead_peaks, self.sr)
+        times = self.primary_timeseries[r_peaks, 0]
+        for lead, offset, agreed, missing in self.lead_markers:
+            points = np.column_stack((times, self.leads[r_peaks, lead]+offset))
+            agreed.set_offsets(points[agreement[:,lead]].reshape(-1, 2))
+            missing.set_offsets(points[~agreement[:,lead]].reshape(-1, 2))
 
     def plot_r_r_histogram(self):
         """
-        This function plots a histogram of the R-R Intervals on the graph.
+        This function shows a histogram of the R-R Intervals of the current segment, or of the whole recording, 
+        in place of the ECG graph. The bars are only resized to the interval counts kept for every segment.
         """
-        self.ax.clear()
-        self.graph_toggle_button.setText("Display ECG Graph")
-        bin_edges = np.arange(0, 2, 0.1)
+        with instrumentation.stage("plot histogram", peaks=len(self.curr_r_peaks_chunk)):
+            self.ax.set_visible(False)
+            self.quality_ax.set_visible(False)
+            self.hist_ax.set_visible(True)
+            self.graph_toggle_button.setText("Display ECG Graph")
+            self.whole_histogram_checkbox.setEnabled(self.num_segments > 1)
 
-        diffs = np.diff(self.curr_r_peaks_chunk[:, 0])
-        n, bins, patches = self.ax.hist(diffs, bins=bin_edges, edgecolor='black')
+            counts = self.interval_histogram()
+            for bar, count in zip(self.hist_bars, counts):
+                bar.set_height(count)
 
-        self.ax.axvline(0.6, color='r', linestyle='--')
-        self.ax.axvline(1.2, color='r', linestyle='--')
+            ymax = max(counts.max(), 1)
+            ytext = ymax + ymax*0.05 
+            self.hist_ax.set_ylim(0, ymax*1.12)
+            for label in self.hist_labels:
+                label.set_y(ytext)
 
-        ymax = max(n)  
-        ytext = ymax + ymax*0.05 
-        self.ax.text(0.6, ytext, '600 ms', color='r', ha='center')
-        self.ax.text(1.2, ytext, '1200 ms', color='r', ha='center')
+            self.slider.setEnabled(False)
+            self.export_r_peaks_button.setEnabled(False)
+            self.export_rr_intervals_button.setEnabled(False)
+            self.export_all_button.setEnabled(False)
+            self.re_run_analysis_button.setEnabled(False)
+            self.overlay_toggle_button.setEnabled(False)
+            self.max_interval_button.setEnabled(False)
+            self.min_interval_button.setEnabled(False)
+            self.graph_toggle_button.setEnabled(True)
+            self.showing_hist = True
+            self.ax.figure.canvas.draw()
 
-        self.slider.setEnabled(False)
-        self.export_r_peaks_button.setEnabled(False)
-        self.export_rr_intervals_button.setEnabled(False)
-        self.re_run_analysis_button.setEnabled(False)
-        self.overlay_toggle_button.setEnabled(False)
-        self.max_interval_button.setEnabled(False)
-        self.min_interval_button.setEnabled(False)
-        self.graph_toggle_button.setEnabled(True)
-        self.showing_hist = True
-        self.ax.figure.canvas.draw()
+    def interval_histogram(self):
+        """
+        This function returns the R-R interval counts of the current segment, or the sum of the counts of 
+        every segment when the whole recording is selected. The counts of every segment are calculated 
+        the first time the histogram is shown and then kept up to date as R Peaks are edited.
+        """
+        if self.rr_histogram is None:
+            self.rr_histogram = hrv.interval_histograms(self.r_peaks_list, self.analysis_segments(), self.sr)
+        if self.whole_histogram_checkbox.isChecked():
+            return self.rr_histogram.sum(axis=0)
+        return self.rr_histogram[self.curr_segment_idx if self.num_segments != 0 else 0]
 
     def slider_moved(self, value):
         """
@@ -391,7 +635,7 @@ class MainWindow(QMainWindow):
         """
         if len(self.curr_r_peaks_chunk) > 0:
             if self.showing_hist:
-                self.plot_ecg_data()
+                self.show_ecg_graph()
             else:
                 self.plot_r_r_histogram()
     
@@ -405,7 +649,7 @@ class MainWindow(QMainWindow):
                 if self.selected_filtering: 
                     self.plot2, = self.ax.plot(self.curr_raw_chunk[:,0],self.curr_raw_chunk[:,1],color='black',zorder=1)
                 else:
-                    self.snr = p.signal_to_noise(self.curr_filtered_chunk,self.curr_raw_chunk)
+                    self.snr = self.current_chunk_snr()
                     self.plot2, = self.ax.plot(self.curr_filtered_chunk[:,0],self.curr_filtered_chunk[:,1],color='black',zorder=4)  
         else:
             if not self.selected_filtering:
@@ -416,82 +660,407 @@ class MainWindow(QMainWindow):
         self.info_label.setText(f'Signal to Noise Ratio: {round(self.snr, 1) if isinstance(self.snr, (float, int)) else self.snr}\nAverage Interval: {round(self.average_interval, 3)}s\nLargest Interval: {round(self.max_interval, 3)}s\nSmallest Interval: {round(self.min_interval, 3)}s')
         self.ax.figure.canvas.draw()
     
-    def handle_updated_r_peaks(self):
+    def handle_updated_r_peaks(self, edit=None):
         """
         This function handles the updated R Peaks.
-        """
-        indices = np.argsort(self.curr_r_peaks_chunk[:,0])
 
-        self.curr_r_peaks_chunk[:] = self.curr_r_peaks_chunk[indices]
+        Args:
+            edit (tuple, optional): The op and the position in curr_r_peaks_chunk of a single R Peak added or 
+            removed by hand, so only its marker is changed. Defaults to None, which moves every marker.
+        """
+        with instrumentation.stage("update r peaks", peaks=len(self.curr_r_peaks_chunk)):
+            times = self.primary_timeseries[self.curr_r_peaks_chunk, 0]
 
-        differences = np.diff(self.curr_r_peaks_chunk[:,0])
-        self.average_interval = np.mean(differences)
+            differences = np.diff(times)
+            self.average_interval = np.mean(differences)
         
-        max_index = np.argmax(differences)
-        self.max_interval = differences[max_index]
-        self.max_interval_pos = self.curr_r_peaks_chunk[max_index, 0]
+            max_index = np.argmax(differences)
+            self.max_interval = differences[max_index]
+            self.max_interval_pos = times[max_index]
         
-        min_index = np.argmin(differences)
-        self.min_interval = differences[min_index]
-        self.min_interval_pos = self.curr_r_peaks_chunk[min_index, 0]
-        self.info_label.setText(f'Signal to Noise Ratio: {round(self.snr, 1) if isinstance(self.snr, (float, int)) else self.snr}\nAverage Interval: {round(self.average_interval, 3)}s\nLargest Interval: {round(self.max_interval, 3)}s\nSmallest Interval: {round(self.min_interval, 3)}s')
+            min_index = np.argmin(differences)
+            self.min_interval = differences[min_index]
+            self.min_interval_pos = times[min_index]
+            self.info_label.setText(f'Signal to Noise Ratio: {round(self.snr, 1) if isinstance(self.snr, (float, int)) else self.snr}\nAverage Interval: {round(self.average_interval, 3)}s\nLargest Interval: {round(self.max_interval, 3)}s\nSmallest Interval: {round(self.min_interval, 3)}s')
         
-        self.scatter.set_offsets(self.curr_r_peaks_chunk)
-        self.scatter.figure.canvas.draw()
+            if edit is None:
+                self.update_visible_r_peaks()
+            else:
+                self.update_r_peak_marker(*edit)
+            self.scatter.figure.canvas.draw()
+
+    def visible_r_peaks(self):
+        """
+        This function returns the range of curr_r_peaks_chunk which lies inside the x limits of the graph.
+
+        Returns:
+            tuple: The first and one past the last position of the visible R Peaks in curr_r_peaks_chunk
+        """
+        first, last = np.searchsorted(self.curr_primary_chunk[:,0], self.ax.get_xlim())
+        lo, hi = np.searchsorted(self.curr_r_peaks_chunk, (self.curr_chunk_start+first, self.curr_chunk_start+last))
+        return int(lo), int(hi)
+
+    def update_visible_r_peaks(self, ax=None):
+        """
+        This function moves the R Peak markers to the R Peaks inside the x limits of the graph. It is 
+        called whenever the x limits change.
+
+        Args:
+            ax (Axes, optional): The axes whose limits changed. Defaults to None.
+        """
+        if self.showing_hist:
+            return
+        self.visible_peaks = self.visible_r_peaks()
+        lo, hi = self.visible_peaks
+        self.scatter.set_offsets(self.r_peak_points(self.curr_r_peaks_chunk[lo:hi]).reshape(-1, 2))
+        self.update_lead_markers()
+
+    def update_r_peak_marker(self, op, position):
+        """
+        This function adds or removes the marker of one R Peak edited by hand, leaving the other markers as they are.
+
+        Args:
+            op (int): session.ADD or session.REMOVE
+            position (int): The position of the R Peak in curr_r_peaks_chunk, before it was removed or after it was added
+        """
+        old_lo, old_hi = self.visible_peaks
+        self.visible_peaks = self.visible_r_peaks()
+        lo, hi = self.visible_peaks
+        offsets = np.asarray(self.scatter.get_offsets()).reshape(-1, 2)
+        if op == session.ADD and lo <= position < hi:
+            offsets = np.insert(offsets, position - lo, self.r_peak_points(self.curr_r_peaks_chunk[position]), axis=0)
+        elif op == session.REMOVE and old_lo <= position < old_hi:
+            offsets = np.delete(offsets, position - old_lo, axis=0)
+        else:
+            return
+        self.scatter.set_offsets(offsets)
+        self.update_lead_markers()
+
+    def r_peak_points(self, r_peaks):
+        """
+        This function returns the times and voltages of R Peaks on the displayed signal.
+
+        Args:
+            r_peaks (np.array): The sample indices of the R Peaks
+        """
+        return self.primary_timeseries[r_peaks]
+
+    def record_edit(self, op, sample):
+        """
+        This function writes a manual edit of the current chunk back into the full list of R Peaks
+        and appends it to the session journal, so the edit persists across segments and reopening the file.
+
+        Args:
+            op (int): session.ADD or session.REMOVE
+            sample (int): The sample index of the added or removed R Peak
+        """
+        start = self.curr_chunk_start
+        end = start + len(self.curr_primary_chunk)
+        self.r_peaks_list = p.replace_r_peaks(self.r_peaks_list, start, end, self.curr_r_peaks_chunk)
+        missed = self.r_peaks_list[:0]
+        if op == session.ADD:
+            # Adding a peak can leave a gap next to it which still has beats missing
+            missed = p.find_missed_r_peaks(self.r_peaks_list, self.primary_timeseries, self.sr, start_sample=sample, end_sample=sample)
+            missed = missed[(missed >= start) & (missed < end)]
+            self.r_peaks_list = p.insert_r_peaks(self.r_peaks_list, missed)
+            self.curr_r_peaks_chunk = p.insert_r_peaks(self.curr_r_peaks_chunk, missed)
+        if self.analyse_whole_dataset:
+            self.curr_r_peaks_chunk = self.r_peaks_list
+        if len(missed):
+            self.handle_updated_r_peaks()
+        if self.session is not None:
+            self.session.record(op, sample, start, end)
+            for missed_sample in missed:
+                self.session.record(session.ADD, missed_sample, start, end)
+            self.session.snapshot(self.r_peaks_list, only_due=True)
+        added, removed = (np.append(missed, sample), missed[:0]) if op == session.ADD else (missed, np.array([sample]))
+        self.update_segment_results(added, removed)
+
+    def update_segment_results(self, added, removed):
+        """
+        This function updates the interval ranking, histogram and statistics of the current segment after 
+        R Peaks are added to or removed from it.
+
+        Args:
+            added (np.array): The sample indices of the added R Peaks
+            removed (np.array): The sample indices of the removed R Peaks
+        """
+        segment_idx = self.curr_segment_idx if self.num_segments != 0 else 0
+        if self.interval_index is not None:
+            self.interval_index.update_segment(self.r_peaks_list, segment_idx)
+        if self.rr_histogram is not None:
+            hrv.edit_histogram(self.rr_histogram, self.r_peaks_list, self.analysis_segments(), self.sr, segment_idx, added, removed)
+        if self.segment_stats is not None:
+            hrv.update_segment(self.segment_stats, self.r_peaks_list, self.analysis_segments(), self.sr, segment_idx, self.first_sample)
+            if self.stats_dialog is not None:
+                self.stats_dialog.update_row(segment_idx)
+
+    def save_session(self):
+        """
+        This function snapshots every segment with unsaved edits.
+        """
+        if self.session is not None:
+            self.session.snapshot(self.r_peaks_list)
+
+    def closeEvent(self, event):
+        self.save_session()
+        self.workspace.clear()
+        super().closeEvent(event)
+
+    def store_recording(self):
+        """
+        This function saves the analysed recording, with its edits and view, in the workspace so it can 
+        be switched back to without opening and analysing the file again.
+        """
+        if self.recording_key is None:
+            return
+        self.workspace.store(self.recording_key, self)
+        if self.recording_selector.findData(self.recording_key) == -1:
+            self.recording_selector.addItem(self.file_name, self.recording_key)
+        self.recording_selector.setCurrentIndex(self.recording_selector.findData(self.recording_key))
+        self.recording_selector.setEnabled(len(self.workspace) > 1)
+
+    def add_recording(self):
+        """
+        This function adds the recording which has just been analysed to the workspace.
+        """
+        self.recording_key = self.file_path
+        self.store_recording()
+
+    def switch_recording(self, index):
+        """
+        This function displays another recording from the workspace, restoring its analysis, edits, 
+        segment and view as they were when it was last displayed.
+
+        Args:
+            index (int): The index of the recording in the recording selector.
+        """
+        key = self.recording_selector.itemData(index)
+        if key == self.recording_key or key not in self.workspace:
+            return
+        self.overlay_toggle_button.setChecked(False)
+        self.save_session()
+        self.store_recording()
+        view = self.workspace.restore(key, self)
+        self.recording_key = key
+        self.primary_timeseries = self.filtered_timeseries if self.selected_filtering else self.raw_timeseries
+        self.max_interval_button.setText('Max Interval (Q)')
+        self.min_interval_button.setText('Min Interval (W)')
+        self.overlay_toggle_button.setText(view["overlay_text"])
+        if self.num_segments != 0:
+            if not hasattr(self, "prev_button"):
+                self.add_segment_buttons()
+            self.prev_button.setEnabled(self.curr_segment_idx > 0)
+            self.next_button.setEnabled(self.curr_segment_idx < self.num_segments-1)
+            pul.chunk_from_segment(self)
+        else:
+            if hasattr(self, "prev_button"):
+                self.prev_button.setEnabled(False)
+                self.next_button.setEnabled(False)
+            nopul.carve_timeseries(self)
+            self.scrollable_window.canvas.figure.suptitle(f"File: {self.file_name}\n{self.title}")
+        self.handle_data_analysis_result()
+        self.set_zoom(view["zoom_factor"])
+        self.centre_view(np.mean(view["xlim"]))
+        if view["showing_hist"]:
+            self.plot_r_r_histogram()
+        if self.stats_dialog is not None and self.stats_dialog.isVisible():
+            self.show_statistics()
+        self.store_recording()
 
     def re_run_analysis_handler(self):
         """
-        This function handles the re-running of the R Peaks analysis.
+        This function detects the R Peaks again in the visible part of the graph, or in a span of the 
+        current chunk chosen by the user, with the thresholds chosen in gui.RedetectDialog. The R Peaks 
+        outside the span, including manual edits, are kept, and the change is saved in the session.
+        """
+        chunk_times = self.curr_primary_chunk[:,0]
+        left, right = self.ax.get_xlim()
+        dialog = gui.RedetectDialog(max(left, chunk_times[0]), min(right, chunk_times[-1]), chunk_times[0], chunk_times[-1],
+                                    self.redetect_settings, self)
+        if dialog.exec_() != QDialog.Accepted:
+            return
+        start_time, end_time, self.redetect_settings = dialog.get_values()
+        self.redetect_span(start_time, end_time, **self.redetect_settings)
+
+    def redetect_span(self, start_time, end_time, margin_seconds=p.REDETECT_MARGIN_SECONDS, sample_length_mult=1, **thresholds):
+        """
+        This function detects the R Peaks again between two times of the current chunk and splices them 
+        into the R Peaks of the whole recording.
+
+        Args:
+            start_time (float): The start of the span in seconds
+            end_time (float): The end of the span in seconds
+            margin_seconds (float, optional): The time either side of the span which is also searched. Defaults to p.REDETECT_MARGIN_SECONDS.
+            sample_length_mult (float, optional): The length of the detection windows in seconds. Defaults to 1.
+            **thresholds: The max_mult and mean_mult of p.find_r_peaks
         """
-        self.curr_r_peaks_chunk = p.r_peaks_filter(self.curr_r_peaks_chunk,self.curr_raw_chunk,self.curr_filtered_chunk)
-        self.handle_updated_r_peaks()
+        chunk_start = self.curr_chunk_start
+        chunk_end = chunk_start + len(self.curr_primary_chunk)
+        first, last = np.searchsorted(self.curr_primary_chunk[:,0], (start_time, end_time))
+        with instrumentation.stage("redetect span", samples=int(last - first)) as stage:
+            self.r_peaks_list, removed, added = p.redetect_r_peaks(self.r_peaks_list, self.primary_timeseries, chunk_start + first, chunk_start + last,
+                                                                   self.sr, margin_seconds, sample_length_mult=sample_length_mult,
+                                                                   step_length_mult=sample_length_mult/2, **thresholds)
+            stage.count(removed=len(removed), added=len(added))
+        if self.analyse_whole_dataset:
+            self.curr_r_peaks_chunk = self.r_peaks_list
+        else:
+            self.curr_r_peaks_chunk = p.peak_range(self.r_peaks_list, chunk_start, chunk_end)
+        if self.session is not None:
+            self.session.record_span(removed, added, chunk_start, chunk_end)
+            self.session.snapshot(self.r_peaks_list, only_due=True)
+        self.update_segment_results(added, removed)
+        if len(self.curr_r_peaks_chunk) > 1:
+            self.handle_updated_r_peaks()
+        else:
+            self.update_visible_r_peaks()
+            self.ax.figure.canvas.draw()
         
-    def to_max_interval(self):
+    def set_quality_track(self, signal_energy, noise_energy):
         """
-        This function moves the graph to the maximum interval between R Peaks.
+        This function stores the windowed signal quality of the whole recording, and sets the 
+        signal to noise ratio of the whole file from it when the data is filtered.
+
+        Args:
+            signal_energy (np.array): The energy of the filtered signal in each window
+            noise_energy (np.array): The energy of the noise in each window
         """
-        centre = self.max_interval_pos+self.max_interval/2
-        self.slider.setValue(int(centre-self.x_width/2))
-        self.ax.set_xlim(centre-self.x_width/2, centre+self.x_width/2)
-        self.ax.figure.canvas.draw()
- 
-    def to_min_interval(self):
+        self.quality_window = int(self.sr*sq.WINDOW_SECONDS)
+        self.quality_signal_energy = signal_energy
+        self.quality_noise_energy = noise_energy
+        self.quality_snr = sq.snr_db(signal_energy, noise_energy)
+        self.noisy_windows = sq.noisy_windows(self.quality_snr)
+        self.chunk_snr = {}
+        self.snr = float(sq.snr_db(signal_energy.sum(), noise_energy.sum())) if self.selected_filtering else "N/A"
+
+    def current_chunk_snr(self):
+        """
+        This function returns the signal to noise ratio of the displayed chunk, calculating it from 
+        the signal quality track the first time each chunk is displayed.
+        """
+        if self.num_segments != 0:
+            start, end = self.segments[self.curr_segment_idx]
+        else:
+            start, end = self.analysis_segments()[0]
+        if (start, end) not in self.chunk_snr:
+            self.chunk_snr[(start, end)] = sq.range_snr(self.quality_signal_energy, self.quality_noise_energy, self.quality_window,
+                                                        self.raw_timeseries[:,1], self.filtered_timeseries[:,1], start, end)
+        return self.chunk_snr[(start, end)]
+
+    def plot_quality_strip(self):
         """
-        This function moves the graph to the minimum interval between R Peaks.
+        This function draws the signal quality of the displayed chunk as a coloured strip under the graph.
+        """
+        self.quality_ax.set_visible(True)
+        if self.quality_image is not None:
+            self.quality_image.remove()
+            self.quality_image = None
+        if len(self.quality_snr) == 0:
+            return
+        window_seconds = self.quality_window/self.sr
+        origin = self.first_sample/self.sr
+        first = self.curr_chunk_start // self.quality_window
+        last = (self.curr_chunk_start + len(self.curr_primary_chunk) - 1) // self.quality_window + 1
+        finite = self.quality_snr[np.isfinite(self.quality_snr)]
+        vmin, vmax = (np.percentile(finite, [5, 95]) if len(finite) else (0, 1))
+        self.quality_image = self.quality_ax.imshow(self.quality_snr[None, first:last], aspect='auto', cmap='RdYlGn',
+                                                    vmin=vmin, vmax=vmax, interpolation='nearest',
+                                                    extent=(origin + first*window_seconds, origin + last*window_seconds, 0, 1))
+
+    def centre_view(self, centre):
+        """
+        This function moves the graph so that it is centred on the given time.
+
+        Args:
+            centre (float): The time in seconds to centre on.
         """
-        centre = self.min_interval_pos+self.min_interval/2
-        self.slider.setValue(int(centre-self.x_width/2))
+        self.slider.blockSignals(True)
+        self.slider.setValue(int((centre-self.x_width/2)*self.zoom_factor))
+        self.slider.blockSignals(False)
         self.ax.set_xlim(centre-self.x_width/2, centre+self.x_width/2)
         self.ax.figure.canvas.draw()
+
+    def to_noisy_region(self, direction):
+        """
+        This function moves the graph to the next (or previous) window whose signal quality is poor,
+        moving to another segment if needed.
+
+        Args:
+            direction (int): 1 to move forwards, -1 to move backwards.
+        """
+        if len(self.noisy_windows) == 0:
+            return
+        window_seconds = self.quality_window/self.sr
+        origin = self.first_sample/self.sr
+        current = int((np.mean(self.ax.get_xlim()) - origin) // window_seconds)
+        if direction > 0:
+            position = np.searchsorted(self.noisy_windows, current, side='right')
+            candidates = self.noisy_windows[position:]
+        else:
+            position = np.searchsorted(self.noisy_windows, current, side='left')
+            candidates = self.noisy_windows[:position][::-1]
+        segments = self.analysis_segments()
+        for window in candidates:
+            centre = (window + 0.5)*window_seconds
+            segment_ids = p.label_segments(np.array([int(centre*self.sr)]), segments)
+            if segment_ids[0] < 0:
+                continue
+            if self.num_segments != 0 and segment_ids[0] != self.curr_segment_idx:
+                self.go_to_segment(int(segment_ids[0]))
+            self.centre_view(origin + centre)
+            return
+
+    def to_ranked_interval(self, kind):
+        """
+        This function moves the graph to the next of the largest (or smallest) intervals between R Peaks
+        in the whole recording, moving to another segment if needed. Repeated presses step through the 
+        anomaly.TOP_K most extreme intervals in order.
+
+        Args:
+            kind (int): anomaly.LARGEST or anomaly.SMALLEST
+        """
+        if self.interval_index is None:
+            self.interval_index = anomaly.IntervalIndex(self.r_peaks_list, self.analysis_segments(), self.sr)
+        step = self.interval_index.step(kind)
+        if step is None:
+            return
+        segment_idx, time, interval, rank = step
+        if self.num_segments != 0 and segment_idx != self.curr_segment_idx:
+            self.go_to_segment(segment_idx)
+        button, text = (self.max_interval_button, 'Max Interval (Q)') if kind == anomaly.LARGEST else (self.min_interval_button, 'Min Interval (W)')
+        button.setText(f"{text} {rank+1}/{len(self.interval_index.ranked[kind])}")
+        self.centre_view(self.first_sample/self.sr + time + interval/2)
         
     def next_button_clicked(self):
         """
         This function handles the case when there is a pulse and the user want to move
         """
-        self.prev_button.setEnabled(True) 
-        if self.curr_segment_idx == self.num_segments-2:
-            self.next_button.setEnabled(False)  
-        if self.plot2:
-            self.plot2.remove()
-            self.plot2 = None
-            self.ax.figure.canvas.draw()       
-        self.curr_segment_idx += 1
-        self.overlay_toggle_button.setChecked(False)
-        pul.chunk_from_segment(self)
-        self.handle_data_analysis_result()
+        self.go_to_segment(self.curr_segment_idx + 1)
     
     def prev_button_clicked(self):
         """
         This function handles the case when there is a pulse and the user want to move
         """
-        self.next_button.setEnabled(True) 
-        if self.curr_segment_idx == 1:
-            self.prev_button.setEnabled(False)  
+        self.go_to_segment(self.curr_segment_idx - 1)
+
+    def go_to_segment(self, segment_idx):
+        """
+        This function displays the segment with the given index when the data is divided by a pulse.
+
+        Args:
+            segment_idx (int): The index of the segment to display.
+        """
+        if self.num_segments == 0 or not 0 <= segment_idx < self.num_segments:
+            return
+        self.prev_button.setEnabled(segment_idx > 0)
+        self.next_button.setEnabled(segment_idx < self.num_segments-1)
         if self.plot2:
             self.plot2.remove()
             self.plot2 = None
-            self.ax.figure.canvas.draw()          
-        self.curr_segment_idx -= 1 
+            self.ax.figure.canvas.draw()
+        self.save_session()
+        self.curr_segment_idx = segment_idx
         self.overlay_toggle_button.setChecked(False)
         pul.chunk_from_segment(self)
         self.handle_data_analysis_result()
@@ -508,36 +1077,95 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self, "Invalid Directory", "You have not selected a valid directory. Please try again.")
             return
         try:
-            indices = np.argsort(self.curr_r_peaks_chunk[:,0])
-            self.curr_r_peaks_chunk = self.curr_r_peaks_chunk[indices] 
+            points = self.r_peak_points(self.curr_r_peaks_chunk)
             if self.num_segments != 0:
                 if is_r_peaks:
                     file_path = os.path.join(file_directory, f"{self.file_name}_R-Peaks_Segment_{self.curr_segment_idx+1}.txt")
-                    np.savetxt(file_path, self.curr_r_peaks_chunk, delimiter='\t')
+                    exporter.write_text(file_path, points)
                 else:
                     file_path = os.path.join(file_directory, f"{self.file_name}_R-R_Intervals_Segment_{self.curr_segment_idx+1}.txt")
-                    diffs = np.diff(self.curr_r_peaks_chunk[:, 0])
-                    np.savetxt(file_path, diffs, delimiter='\t')
+                    diffs = np.diff(points[:, 0])
+                    exporter.write_text(file_path, diffs)
             elif self.analyse_whole_dataset:
                 if is_r_peaks:
                     file_path = os.path.join(file_directory, f"{self.file_name}_R-Peaks.txt")
-                    np.savetxt(file_path, self.curr_r_peaks_chunk, delimiter='\t')
+                    exporter.write_text(file_path, points)
                 else:
                     file_path = os.path.join(file_directory, f"{self.file_name}_R-R_Intervals.txt")
-                    diffs = np.diff(self.curr_r_peaks_chunk[:, 0])
-                    np.savetxt(file_path, diffs, delimiter='\t')
+                    diffs = np.diff(points[:, 0])
+                    exporter.write_text(file_path, diffs)
             else:
                 if is_r_peaks:
                     file_path = os.path.join(file_directory, f"{self.file_name}_R-Peaks_{self.start_time}-{self.end_time}.txt")
-                    np.savetxt(file_path, self.curr_r_peaks_chunk, delimiter='\t')
+                    exporter.write_text(file_path, points)
                 else:
                     file_path = os.path.join(file_directory, f"{self.file_name}_R-R_Intervals_{self.start_time}-{self.end_time}.txt")
-                    diffs = np.diff(self.curr_r_peaks_chunk[:, 0])
-                    np.savetxt(file_path, diffs, delimiter='\t')
+                    diffs = np.diff(points[:, 0])
+                    exporter.write_text(file_path, diffs)
         except Exception as e:
             choice = gui.ErrorMessage(f"An error occurred while exporting the data: {e}", self.export_function,self.file_path)
             return choice
     
+    def analysis_segments(self):
+        """
+        This function returns the (start, end) sample indices of the segments being analysed: the pulse
+        segments, the whole dataset or the selected time range.
+        """
+        if self.num_segments != 0:
+            return self.segments
+        elif self.analyse_whole_dataset:
+            return [(0, len(self.primary_timeseries))]
+        else:
+            return [(int(self.start_time*self.sr*60) - self.first_sample, int(self.end_time*self.sr*60) - self.first_sample)]
+
+    def show_statistics(self):
+        """
+        This function opens the table of R-R interval statistics for every segment.
+        """
+        if self.segment_stats is None:
+            self.segment_stats = hrv.segment_statistics(self.r_peaks_list, self.analysis_segments(), self.sr, self.first_sample)
+        if self.stats_dialog is None:
+            self.stats_dialog = gui.StatisticsDialog(self)
+        self.stats_dialog.set_table(self.segment_stats)
+        self.stats_dialog.show()
+        self.stats_dialog.raise_()
+
+    def bulk_export_function(self):
+        """
+        This function exports the R Peaks and R-R Intervals of every segment, or of the whole file, 
+        in one pass on a background thread.
+        """
+        if self.export_worker is not None and self.export_worker.isRunning():
+            QMessageBox.information(self, "Export in Progress", "The previous export has not finished yet.")
+            return
+        dialog = gui.BulkExportDialog(self.num_segments != 0, self)
+        if dialog.exec_() != QDialog.Accepted:
+            return
+        formats, whole_file = dialog.get_values()
+        if not formats:
+            QMessageBox.warning(self, "No Format Selected", "Please select at least one format to export.")
+            return
+        file_directory = QFileDialog.getExistingDirectory(self, 'Save Files', self.desktop_path)
+        if not file_directory:
+            QMessageBox.warning(self, "Invalid Directory", "You have not selected a valid directory. Please try again.")
+            return
+
+        segments = [(0, len(self.primary_timeseries))] if whole_file else self.analysis_segments()
+
+        self.export_all_button.setEnabled(False)
+        self.export_worker = gui.ExportWorker(file_directory, self.file_name, self.r_peaks_list, self.primary_timeseries, segments, self.sr, formats)
+        self.export_worker.finished_export.connect(self.bulk_export_finished)
+        self.export_worker.failed.connect(self.bulk_export_failed)
+        self.export_worker.start()
+
+    def bulk_export_finished(self, written):
+        self.export_all_button.setEnabled(not self.showing_hist)
+        QMessageBox.information(self, "Export Complete", f"{len(written)} files were written.")
+
+    def bulk_export_failed(self, message):
+        self.export_all_button.setEnabled(not self.showing_hist)
+        QMessageBox.warning(self, "Export Failed", f"An error occurred while exporting the data: {message}")
+
     def reset_canvas(self):
         """
         This function resets the canvas to its default state.
@@ -547,10 +1175,12 @@ class MainWindow(QMainWindow):
         self.showing_hist = False
         self.set_zoom(1)
   
-app = QApplication(sys.argv)
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+
+    main = MainWindow()
+    main.show()
 
-main = MainWindow()
-main.show()
+    sys.exit(app.exec_())
 
-sys.exit(app.exec_())
 
@@ -0,0 +1,255 @@
+"""
+Batched R-peak detection across several ECG leads of one recording.
+
+All the leads are filtered with one 2-D FFT along the time axis. The two thresholds of
+find_r_peaks are then applied to the local maxima of every lead without looping over the windows:
+the maximum of every window comes from one block reduction of all the leads, and the mean height
+of the tall peaks of every window from a bincount. The peaks of each lead are merged as in
+find_r_peaks and fused into one consensus set, keeping the beats found in a majority of the leads.
+Which leads agree with a beat is looked up from the peaks of every lead rather than stored with
+the beat, so it stays correct after manual edits.
+"""
+import numpy as np
+import scipy.fft
+import scipy.signal
+import processor as p
+import instrumentation
+
+TOLERANCE_SECONDS = 0.05
+
+
+def parse_columns(text, file_width, exclude=()):
+    """
+    Reads a comma separated list of column numbers, such as "2, 3".
+
+    Args:
+        text (str): The column numbers
+        file_width (int): The number of columns in the file, including the time column
+        exclude (tuple, optional): Columns which are left out, such as the pulse column. Defaults to ().
+
+    Raises:
+        ValueError: If a column is not a number between 1 and file_width - 1.
+
+    Returns:
+        list: The column numbers in the order given, without duplicates
+    """
+    columns = []
+    for part in text.replace(" ", "").split(","):
+        if not part:
+            continue
+        column = int(part)
+        if not 1 <= column < file_width:
+            raise ValueError(f"Column {column} is not in the file.")
+        if column not in columns and column not in exclude:
+            columns.append(column)
+    return columns
+
+
+def filter_leads(leads, sr, low_cut=0.5, high_cut=15):
+    """
+    Removes the frequencies below low_cut and above high_cut from every lead with one 2-D FFT.
+    Each lead is filtered exactly as processor.filter filters one.
+
+    Args:
+        leads (np.array): The voltages of the leads, one lead per column
+        sr (int): The sampling rate of the data
+        low_cut (float, optional): Frequencies below this are removed. Defaults to 0.5.
+        high_cut (float, optional): Frequencies above this are removed. Defaults to 15.
+
+    Returns:
+        np.array: The filtered leads
+    """
+    with instrumentation.stage("filter leads", samples=leads.size):
+        n = len(leads)
+        sig_fft = scipy.fft.rfft(leads, axis=0)
+        sample_freq = scipy.fft.rfftfreq(n, d=1/sr)
+        sig_fft[(sample_freq < low_cut) | (sample_freq > high_cut)] = 0
+        return scipy.fft.irfft(sig_fft, n, axis=0)
+
+
+def detect_leads(times, leads, sr, sample_length_mult=1, step_length_mult=0.5):
+    """
+    Detects the R-peaks of every lead with the thresholds of processor.find_r_peaks: the local maxima
+    of each window above 80% of the mean of the maxima above 80% of the window's maximum.
+
+    Args:
+        times (np.array): The times of the samples
+        leads (np.array): The voltages of the leads, one lead per column
+        sr (int): The sampling rate of the data
+        sample_length_mult (int, optional): The length of each window in seconds. Defaults to 1.
+        step_length_mult (float, optional): The step between windows in seconds. The window length must
+        be a whole number of steps. Defaults to 0.5.
+
+    Raises:
+        ValueError: If the window length is not a whole number of steps.
+
+    Returns:
+        list: The sample indices of the R Peaks of each lead
+    """
+    sample_length = int(sr*sample_length_mult)
+    step_length = int(sr*step_length_mult)
+    if sample_length % step_length:
+        raise ValueError("The window length must be a whole number of steps.")
+    steps = sample_length // step_length
+    n, num_leads = leads.shape
+    with instrumentation.stage("detect leads", samples=leads.size) as stage:
+        num_windows = len(range(0, n - (sample_length - step_length), step_length))
+        num_blocks = -(-n // step_length)
+        padded = np.full((num_blocks*step_length, num_leads), -np.inf)
+        padded[:n] = leads
+        block_max = padded.reshape(num_blocks, step_length, num_leads).max(axis=1)
+        block_max = np.concatenate((block_max, np.full((steps - 1, num_leads), -np.inf)))
+        window_max = np.lib.stride_tricks.sliding_window_view(block_max, steps, axis=0).max(axis=-1)[:num_windows]
+
+        lead_peaks = []
+        for lead in range(num_leads):
+            volts = leads[:, lead]
+            candidates, _ = scipy.signal.find_peaks(volts)
+            heights = volts[candidates]
+            # Every candidate lies in the windows starting up to steps-1 blocks before its own block
+            windows = (candidates // step_length)[None, :] - np.arange(steps)[:, None]
+            valid = (windows >= 0) & (windows < num_windows)
+            clipped = np.where(valid, windows, 0)
+            tall = valid & (heights >= 0.8*window_max[clipped, lead])
+            counts = np.bincount(clipped[tall], minlength=num_windows)
+            sums = np.bincount(clipped[tall], weights=np.broadcast_to(heights, tall.shape)[tall], minlength=num_windows)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                threshold = 0.8*sums/counts
+            keep = (valid & (counts[clipped] > 0) & (heights >= threshold[clipped])).any(axis=0)
+            timeseries = np.column_stack((times, volts))
+            lead_peaks.append(p.merge_r_peaks(candidates[keep], timeseries, sr))
+        stage.count(peaks=sum(len(peaks) for peaks in lead_peaks))
+    return lead_peaks
+
+
+def fuse(lead_peaks, timeseries, sr, tolerance=TOLERANCE_SECONDS, min_leads=None):
+    """
+    Combines the R-peaks of every lead into one consensus set. Peaks of different leads within
+    tolerance of each other are the same beat, and a beat is kept if it is found in at least
+    min_leads leads. Each beat is placed at the highest sample of timeseries within tolerance of
+    the mean sample of its peaks.
+
+    Args:
+        lead_peaks (list): The sample indices of the R Peaks of each lead
+        timeseries (np.array): The timeseries the consensus R Peaks are placed on, usually the first lead
+        sr (int): The sampling rate of the data
+        tolerance (float, optional): The largest time in seconds between peaks of the same beat. Defaults to TOLERANCE_SECONDS.
+        min_leads (int, optional): The number of leads which must find a beat. Defaults to a majority of the leads.
+
+    Returns:
+        np.array: The sample indices of the consensus R Peaks
+    """
+    num_leads = len(lead_peaks)
+    if min_leads is None:
+        min_leads = num_leads // 2 + 1
+    window = max(1, int(round(tolerance*sr)))
+    samples = np.concatenate(lead_peaks)
+    lead_ids = np.concatenate([np.full(len(peaks), lead) for lead, peaks in enumerate(lead_peaks)])
+    if len(samples) == 0:
+        return samples.astype(p.sample_dtype(len(timeseries)))
+    order = np.argsort(samples, kind='stable')
+    samples, lead_ids = samples[order], lead_ids[order]
+    clusters = np.concatenate(([0], np.cumsum(np.diff(samples) > window)))
+    num_clusters = clusters[-1] + 1
+    votes = np.bincount(np.unique(clusters*num_leads + lead_ids) // num_leads, minlength=num_clusters)
+    centres = np.bincount(clusters, weights=samples, minlength=num_clusters) / np.bincount(clusters, minlength=num_clusters)
+    centres = np.ceil(centres[votes >= min_leads]).astype(np.int64)
+
+    offsets = np.clip(centres[:, None] + np.arange(-window, window + 1), 0, len(timeseries) - 1)
+    peaks = offsets[np.arange(len(offsets)), np.argmax(timeseries[offsets, 1], axis=1)]
+    return np.unique(peaks).astype(p.sample_dtype(len(timeseries)))
+
+
+def agreement(r_peaks_list, lead_peaks, sr, tolerance=TOLERANCE_SECONDS):
+    """
+    Finds which leads have an R-peak within tolerance of each R-peak.
+
+    Args:
+        r_peaks_list (np.array): The sorted sample indices of the R Peaks
+        lead_peaks (list): The sorted sample indices of the R Peaks of each lead
+        sr (int): The sampling rate of the data
+        tolerance (float, optional): The largest time in seconds between peaks of the same beat. Defaults to TOLERANCE_SECONDS.
+
+    Returns:
+        np.array: One row per R Peak and one column per lead, True where the lead agrees
+    """
+    window = max(1, int(round(tolerance*sr)))
+    samples = r_peaks_list.astype(np.int64)
+    agreed = np.zeros((len(samples), len(lead_peaks)), dtype=bool)
+    for lead, peaks in enumerate(lead_peaks):
+        if len(peaks) == 0:
+            continue
+        position = np.searchsorted(peaks, samples)
+        after = peaks[np.minimum(position, len(peaks) - 1)]
+        before = peaks[np.maximum(position - 1, 0)]
+        nearest = np.minimum(np.abs(after - samples), np.abs(before - samples))
+        agreed[:, lead] = nearest <= window
+    return agreed
+
+
+def pack(lead_peaks):
+    """
+    Packs the sample indices of the R Peaks of every lead into one array with a lead number column, for the analysis cache.
+    """
+    return np.column_stack((np.concatenate(lead_peaks),
+                            np.concatenate([np.full(len(peaks), lead) for lead, peaks in enumerate(lead_peaks)]))).reshape(-1, 2)
+
+
+def unpack(packed, num_leads):
+    """
+    Splits an array made by pack into the sample indices of the R Peaks of every lead.
+    """
+    return [packed[packed[:, 1] == lead, 0] for lead in range(num_leads)]
+
+
+def decimate_leads(times, leads, sr, analysis_rate=p.ANALYSIS_RATE):
+    """
+    Decimates every lead as processor.decimate decimates one, averaging each block of samples.
+
+    Args:
+        times (np.array): The times of the samples
+        leads (np.array): The voltages of the leads, one lead per column
+        sr (int): The sampling rate of the data
+        analysis_rate (int, optional): The lowest sample rate to decimate to. Defaults to processor.ANALYSIS_RATE.
+
+    Returns:
+        np.array: The times of the decimated samples
+        np.array: The decimated leads
+        float: The sample rate of the decimated leads
+    """
+    factor = int(sr // analysis_rate)
+    if factor < 2:
+        return times, leads, sr
+    with instrumentation.stage("decimate", samples=leads.size):
+        length = len(leads) // factor * factor
+        decimated = leads[:length].reshape(-1, factor, leads.shape[1]).sum(axis=1) / factor
+        decimated_times = times[:length:factor] + (factor - 1) / (2 * sr)
+    return decimated_times, decimated, sr/factor
+
+
+def find_r_peaks(times, leads, sr, tolerance=TOLERANCE_SECONDS, reduced_rate=False):
+    """
+    Detects the R-peaks of every lead and fuses them into the consensus R-peaks, placed on the first lead.
+
+    Args:
+        times (np.array): The times of the samples
+        leads (np.array): The voltages of the leads, one lead per column
+        sr (int): The sampling rate of the data
+        tolerance (float, optional): The largest time in seconds between peaks of the same beat. Defaults to TOLERANCE_SECONDS.
+        reduced_rate (bool, optional): Whether to detect the R Peaks of every lead at about processor.ANALYSIS_RATE
+        and refine them on the lead, as processor.find_r_peaks_multirate does. Defaults to False.
+
+    Returns:
+        np.array: The sample indices of the consensus R Peaks
+        list: The sample indices of the R Peaks of each lead
+    """
+    decimated_times, decimated, decimated_rate = decimate_leads(times, leads, sr) if reduced_rate else (times, leads, sr)
+    if decimated_rate == sr:
+        lead_peaks = detect_leads(times, leads, sr)
+    else:
+        factor = int(round(sr / decimated_rate))
+        lead_peaks = [p.refine_r_peaks(peaks, np.column_stack((times, leads[:, lead])), sr, factor)
+                      for lead, peaks in enumerate(detect_leads(decimated_times, decimated, decimated_rate))]
+    with instrumentation.stage("fuse leads", peaks=sum(len(peaks) for peaks in lead_peaks)):
+        r_peaks_list = fuse(lead_peaks, np.column_stack((times, leads[:, 0])), sr, tolerance)
+    return r_peaks_list, lead_peaks
@@ -4,6 +4,11 @@ from PyQt5.QtCore import Qt
 import processor as p 
 import numpy as np 
 import gui
+import instrumentation
+import cache
+import session
+import signal_quality as sq
+import multilead
 
 class NoPulseSettingsDialog(QDialog):
     """A QDialog that allows the user to enter settings for data analysis when 
@@ -56,6 +61,10 @@ class NoPulseSettingsDialog(QDialog):
         self.analyse_whole_dataset_checkbox.stateChanged.connect(self.analyse_whole_dataset_handler)
 
         self.need_filtering_checkbox = QCheckBox(self)
+        self.reduced_rate_checkbox = QCheckBox(self)
+        self.reduced_rate_checkbox.setEnabled(sr >= 2*p.ANALYSIS_RATE)
+        self.other_leads_edit = QLineEdit(self)
+        self.other_leads_edit.setPlaceholderText("e.g. 2, 3")
         
         self.ecg_column_dropdown = QComboBox()
         for i in range(1, file_width):
@@ -68,7 +77,9 @@ class NoPulseSettingsDialog(QDialog):
         form_layout.addRow("Analyse the whole dataset?", self.analyse_whole_dataset_checkbox)
 
         form_layout.addRow("Column with ECG Data", self.ecg_column_dropdown)
+        form_layout.addRow("Other ECG Columns (multi-lead)", self.other_leads_edit)
         form_layout.addRow("Filter this data", self.need_filtering_checkbox)
+        form_layout.addRow(f"Detect R Peaks at {p.ANALYSIS_RATE} Hz and refine them", self.reduced_rate_checkbox)
         
         button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
         button_box.accepted.connect(self.accept_check)
@@ -160,7 +171,9 @@ class NoPulseSettingsDialog(QDialog):
                 self.end_time_edit.text(),
                 self.need_filtering_checkbox.isChecked(),
                 self.ecg_column,
-                self.analyse_whole_dataset_checkbox.isChecked()
+                self.analyse_whole_dataset_checkbox.isChecked(),
+                self.reduced_rate_checkbox.isChecked(),
+                self.other_leads_edit.text()
             )
         else:
             return None
@@ -194,7 +207,7 @@ def no_pulse_settings_pane(self):
             if values is None:
                 raise ValueError("Invalid input")
             
-            start_time, end_time, selected_filtering, ecg_column, analyse_whole_dataset = values
+            start_time, end_time, selected_filtering, ecg_column, analyse_whole_dataset, reduced_rate_detection, other_leads = values
             
             if analyse_whole_dataset:
                 self.start_time = 0
@@ -207,23 +220,34 @@ def no_pulse_settings_pane(self):
                 self.end_time = float(end_time)
             
             self.selected_filtering = selected_filtering
+            self.reduced_rate_detection = reduced_rate_detection
 
             if ecg_column < 1:
                 raise ValueError("Invalid column selection.")
             self.ecg_column = ecg_column
+            self.lead_columns = [ecg_column] + multilead.parse_columns(other_leads, self.file_width, exclude=(ecg_column,))
             self.analyse_whole_dataset = analyse_whole_dataset
             self.overlay_toggle_button.setEnabled(True)
             if self.selected_filtering:
                 self.overlay_toggle_button.setText("Show Original Signal")
                 self.is_filtered = True
-                self.scrollable_window.canvas.figure.suptitle(f"File: {self.file_name}\nR Peaks Detected From a Fourier Transform of the Orignal Signal")
+                self.title = "R Peaks Detected From a Fourier Transform of the Orignal Signal"
+                self.scrollable_window.canvas.figure.suptitle(f"File: {self.file_name}\n{self.title}")
                 self.scrollable_window.canvas.draw()
             else:
                 self.overlay_toggle_button.setText("Show Filtered Signal")
                 self.is_filtered = False
-                self.scrollable_window.canvas.figure.suptitle(f"File: {self.file_name}\nR Peaks Detected from the Orignal Signal")
+                self.title = "R Peaks Detected from the Orignal Signal"
+                self.scrollable_window.canvas.figure.suptitle(f"File: {self.file_name}\n{self.title}")
                 self.scrollable_window.canvas.draw()
-            run_data_analysis(self)
+            if self.analyse_whole_dataset:
+                loaded = self.load_file_data()
+            else:
+                # Only the chosen range is read, with a margin so the edges are filtered as in the whole file
+                margin = int(p.RANGE_MARGIN_SECONDS*self.sr)
+                loaded = self.load_file_data(int(self.start_time*self.sr*60) - margin, int(self.end_time*self.sr*60) + margin)
+            if loaded:
+                run_data_analysis(self)
         except ValueError:
             QMessageBox.warning(self, "Invalid Input", "Please enter valid numbers for the sr, ecg column and pulse column.")
             no_pulse_settings_pane(self)
@@ -236,23 +260,53 @@ def no_pulse_settings_pane(self):
                 
 def run_data_analysis(self):
     """
-    Runs the data analysis on the selected file.
+    Runs the data analysis on the selected file. The R-peaks and SNR are loaded from the
+    analysis cache when the same data has been analysed with the same settings, and any saved
+    manual edits are applied to the R-peaks.
     """
     try:
-        self.raw_timeseries = np.column_stack((self.file_data[:,0], self.file_data[:,self.ecg_column]))
-        self.ts = 1/self.sr
-        self.filtered_timeseries = p.filter(self.raw_timeseries,self.sr) 
-        
-        if self.selected_filtering: 
-            self.r_peaks_list = p.find_r_peaks(self.filtered_timeseries,self.sr)
-            self.snr = p.signal_to_noise(self.filtered_timeseries,self.raw_timeseries)
-            self.primary_timeseries = self.filtered_timeseries
-        else:    
-            self.r_peaks_list = p.find_r_peaks(self.raw_timeseries,self.sr)       
-            self.snr = "N/A"
-            self.primary_timeseries = self.raw_timeseries
+        with instrumentation.stage("no pulse analysis", samples=len(self.file_data)) as stage:
+            self.raw_timeseries = np.column_stack((self.file_data[:,0], self.file_data[:,self.ecg_column]))
+            self.ts = 1/self.sr
+            if len(self.lead_columns) > 1:
+                leads = self.file_data[:,self.lead_columns]
+                filtered_leads = multilead.filter_leads(leads, self.sr)
+                self.filtered_timeseries = np.column_stack((self.file_data[:,0], filtered_leads[:,0]))
+                self.leads = filtered_leads if self.selected_filtering else leads
+            else:
+                self.filtered_timeseries = p.filter(self.raw_timeseries,self.sr) 
+                self.leads = None
+            self.primary_timeseries = self.filtered_timeseries if self.selected_filtering else self.raw_timeseries
+
+            other_leads = [self.file_data[:,column] for column in self.lead_columns[1:]]
+            key, content_key = cache.analysis_keys([self.raw_timeseries[:,1], *other_leads], mode="no pulse", sr=self.sr, filtering=self.selected_filtering,
+                                                    reduced_rate=self.reduced_rate_detection, leads=self.lead_columns)
+            cached = cache.load(key)
+            if cached is not None:
+                self.r_peaks_list = cached["r_peaks"]
+                signal_energy, noise_energy = cached["signal_energy"], cached["noise_energy"]
+                self.lead_peaks = multilead.unpack(cached["lead_peaks"], len(self.lead_columns)) if self.leads is not None else None
+            else:
+                self.lead_peaks = None
+                if self.leads is not None:
+                    self.r_peaks_list, self.lead_peaks = multilead.find_r_peaks(self.file_data[:,0], self.leads, self.sr, reduced_rate=self.reduced_rate_detection)
+                elif self.reduced_rate_detection:
+                    self.r_peaks_list = p.find_r_peaks_multirate(self.primary_timeseries, self.sr)
+                else:
+                    self.r_peaks_list = p.find_r_peaks(self.primary_timeseries,self.sr)
+                signal_energy, noise_energy = sq.window_energies(self.raw_timeseries[:,1], self.filtered_timeseries[:,1], int(self.sr*sq.WINDOW_SECONDS))
+                lead_arrays = {"lead_peaks": multilead.pack(self.lead_peaks)} if self.leads is not None else {}
+                cache.store(key, r_peaks=self.r_peaks_list, signal_energy=signal_energy, noise_energy=noise_energy, **lead_arrays)
+            self.set_quality_track(signal_energy, noise_energy)
+            self.session = session.Session(content_key)
+            self.r_peaks_list = self.session.restore(self.r_peaks_list)
+            self.segment_stats = None
+            self.interval_index = None
+            self.rr_histogram = None
+            stage.count(peaks=len(self.r_peaks_list))
         carve_timeseries(self)
         self.handle_data_analysis_result()
+        self.add_recording()
     except OSError:
         QMessageBox.warning(self, "Invalid File", "The selected file could not be opened. Please check the file path and try again.")
         
@@ -261,22 +315,18 @@ def carve_timeseries(self):
     if self.analyse_whole_dataset:
         self.curr_filtered_chunk = self.filtered_timeseries
         self.curr_raw_chunk = self.raw_timeseries
+        self.curr_chunk_start = 0
         self.curr_r_peaks_chunk = self.r_peaks_list
         self.curr_primary_chunk = self.curr_filtered_chunk if self.selected_filtering else self.curr_raw_chunk
     else:
-        start_point = int(self.start_time*self.sr*60)
-        end_point = int(self.end_time*self.sr*60)
+        start_point = int(self.start_time*self.sr*60) - self.first_sample
+        end_point = int(self.end_time*self.sr*60) - self.first_sample
 
         self.curr_raw_chunk = self.raw_timeseries[start_point:end_point]
         self.curr_filtered_chunk = self.filtered_timeseries[start_point:end_point]
         
         self.curr_primary_chunk = self.curr_filtered_chunk if self.selected_filtering else self.curr_raw_chunk
-
-        min_time = self.curr_primary_chunk[0, 0]
-        max_time = self.curr_primary_chunk[-1, 0]
-
-        time_filter = (self.r_peaks_list[:, 0] >= min_time) & (self.r_peaks_list[:, 0] <= max_time)
-
-        self.curr_r_peaks_chunk = self.r_peaks_list[time_filter]
+        self.curr_chunk_start = start_point
+        self.curr_r_peaks_chunk = p.peak_range(self.r_peaks_list, start_point, end_point)
 
     
@@ -0,0 +1,370 @@
+"""
+Out-of-core analysis of recordings which are too large to load into memory.
+
+The recording is streamed through generator stages in blocks of block_rows rows: parse_blocks
+reads the file, filter_blocks applies the band-pass filter and detect_blocks finds the R-peaks
+in the same one second chunks as processor.find_r_peaks, carrying the samples of chunks which
+cross a block boundary over to the next block. The primary signal and the pulse channel are
+spilled to temporary files as they pass, so dividing the pulse into segments (which needs its
+maximum) and searching long gaps for missed beats read them back through memory maps. Memory use
+therefore depends on block_rows rather than on the length of the file, apart from the list of
+R-peaks itself, which is small compared to the signal.
+
+When there is more than one CPU the stages also run concurrently, connected by queues of at most QUEUE_BLOCKS blocks
+so a fast stage waits for a slow one instead of filling memory. Text parsing holds the GIL, so it
+runs in a separate process (in_process); the filter spends its time in the FFT, which releases the
+GIL, so it runs on a thread (threaded); detection runs on the calling thread. The total time is
+then close to that of the slowest stage rather than the sum of all of them.
+
+Without filtering, the R-peaks and segments are identical to the in-memory analysis. Each block
+is filtered together with FILTER_MARGIN_SECONDS of signal either side of it, which closely
+approximates the whole-file Fourier filter of processor.filter but is not exactly the same, so
+R-peaks detected in the filtered signal can be a sample away from those of the in-memory analysis.
+An exact whole-file Fourier filter needs the whole recording at once.
+
+Usage:
+    python pipeline.py recording.txt --sr 1000 --ecg-column 1 --pulse-column 4 --filter --out results/
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+import scipy.fft
+import processor as p
+import exporter
+import instrumentation
+
+BLOCK_ROWS = 2**20
+FILTER_MARGIN_SECONDS = 60
+QUEUE_BLOCKS = 4
+
+
+def first_data_line(file_path):
+    """
+    Finds the first line of the file which only contains numbers, like processor.file_opener.
+    """
+    with p.open_data(file_path) as f:
+        for i, line in enumerate(f):
+            line = line.decode('iso-8859-1')
+            if all(c.isdigit() or c.isspace() or c == '.' or c == '-' for c in line.strip()):
+                return i
+    return 0
+
+
+def parse_blocks(file_path, sr, columns, block_rows=BLOCK_ROWS):
+    """
+    Reads the data of a file in blocks of rows. NaN values are changed to 0s and the time of
+    every row is calculated from the sampling rate, as in processor.file_opener. Compressed files
+    are decompressed on a separate thread while the blocks are parsed.
+
+    Args:
+        file_path (str): The path to the file to be read
+        sr (int): The sampling rate of the data
+        columns (list): The columns to read, numbered as in the output of processor.file_opener
+        block_rows (int, optional): The number of rows in each block. Defaults to BLOCK_ROWS.
+
+    Yields:
+        np.array: A block with the time in the first column followed by the selected columns
+    """
+    start = 0
+    skiprows = first_data_line(file_path)
+    with p.open_data(file_path) as f:
+        reader = pd.read_csv(f, sep="\t", header=None, skiprows=skiprows, chunksize=block_rows, encoding='iso-8859-1')
+        for df in reader:
+            data = df[columns].fillna(0).to_numpy().astype(float)
+            time_array = (start + np.arange(len(data))) * (1/sr)
+            start += len(data)
+            yield np.column_stack((time_array, data))
+
+
+def band_pass(volts, sr, low_cut=0.5, high_cut=15):
+    """
+    Removes the frequencies below low_cut and above high_cut with a Fourier Transform, like processor.filter.
+    """
+    n = scipy.fft.next_fast_len(len(volts), real=True)
+    spectrum = scipy.fft.rfft(volts, n)
+    sample_freq = scipy.fft.rfftfreq(n, d=1/sr)
+    spectrum[(sample_freq < low_cut) | (sample_freq > high_cut)] = 0
+    return scipy.fft.irfft(spectrum, n)[:len(volts)]
+
+
+def filter_blocks(blocks, sr, column=1, low_cut=0.5, high_cut=15, margin_seconds=FILTER_MARGIN_SECONDS):
+    """
+    Filters one column of a stream of blocks. Each block is filtered together with the margin
+    of samples either side of it, so a block is output once enough of the following blocks
+    have been read.
+
+    Args:
+        blocks (iterable): The blocks from parse_blocks
+        sr (int): The sampling rate of the data
+        column (int, optional): The column to filter. Defaults to 1.
+        low_cut (float, optional): Frequencies below this are removed. Defaults to 0.5.
+        high_cut (float, optional): Frequencies above this are removed. Defaults to 15.
+        margin_seconds (float, optional): The length of the margins. Defaults to FILTER_MARGIN_SECONDS.
+
+    Yields:
+        np.array: Each block with the filtered column added as its last column
+    """
+    margin = int(margin_seconds * sr)
+    before = np.empty(0)
+    pending = []
+    pending_rows = 0
+    blocks = iter(blocks)
+    exhausted = False
+    while not exhausted or pending:
+        block = next(blocks, None)
+        if block is None:
+            exhausted = True
+        else:
+            pending.append(block)
+            pending_rows += len(block)
+        # The oldest block is ready when the blocks after it cover the margin, or there are no more blocks
+        while pending and (exhausted or pending_rows - len(pending[0]) >= margin):
+            block = pending.pop(0)
+            pending_rows -= len(block)
+            after = np.concatenate([b[:, column] for b in pending] + [np.empty(0)])[:margin]
+            volts = band_pass(np.concatenate((before, block[:, column], after)), sr, low_cut, high_cut)
+            yield np.column_stack((block, volts[len(before):len(before) + len(block)]))
+            before = np.concatenate((before, block[:, column]))[-margin:] if margin else np.empty(0)
+
+
+def detect_blocks(blocks, sample_rate, column=1, sample_length_mult=1, step_length_mult=0.5):
+    """
+    Finds the R-peaks of each chunk of processor.find_r_peaks in a stream of blocks. The
+    samples of the chunks which are not complete at the end of a block are kept until the
+    next block, and the chunks which end after the last sample are processed at the end.
+
+    Args:
+        blocks (iterable): The blocks of the recording, with the time in the first column
+        sample_rate (int): The sample rate of the data
+        column (int, optional): The column to detect R Peaks in. Defaults to 1.
+        sample_length_mult (int, optional): As in processor.find_r_peaks. Defaults to 1.
+        step_length_mult (float, optional): As in processor.find_r_peaks. Defaults to 0.5.
+
+    Yields:
+        np.array: The sample indices of the R Peaks found in the chunks completed by each 
+        block, before they are merged with processor.merge_r_peaks
+    """
+    sample_length = int(sample_rate * sample_length_mult)
+    step_length = int(sample_rate * step_length_mult)
+    carried = np.empty(0)
+    carried_start = 0
+    next_chunk = 0
+    total = 0
+    for block in blocks:
+        carried = np.concatenate((carried, block[:, column]))
+        total += len(block)
+        found = []
+        while next_chunk + sample_length <= total:
+            idx = next_chunk - carried_start
+            found.append(next_chunk + p.window_r_peaks(carried[idx:idx+sample_length]))
+            next_chunk += step_length
+        carried = carried[next_chunk - carried_start:]
+        carried_start = next_chunk
+        yield np.concatenate(found + [np.empty(0, dtype=np.int64)])
+    found = []
+    while next_chunk < total - (sample_length - step_length):
+        idx = next_chunk - carried_start
+        found.append(next_chunk + p.window_r_peaks(carried[idx:idx+sample_length]))
+        next_chunk += step_length
+    yield np.concatenate(found + [np.empty(0, dtype=np.int64)])
+
+
+def _queued(get):
+    while True:
+        block = get()
+        if block is None:
+            return
+        if isinstance(block, BaseException):
+            raise block
+        yield block
+
+
+def threaded(blocks, maxsize=QUEUE_BLOCKS):
+    """
+    Runs a stage on its own thread, which works up to maxsize blocks ahead of the next stage.
+
+    Args:
+        blocks (iterable): The blocks output by the stage
+        maxsize (int, optional): The number of blocks the stage can work ahead. Defaults to QUEUE_BLOCKS.
+
+    Yields:
+        np.array: The same blocks
+    """
+    blocks_queue = queue.Queue(maxsize)
+    stopped = threading.Event()
+
+    def put(item):
+        # Gives up once the next stage has stopped, so the thread does not wait for a reader which has gone
+        while not stopped.is_set():
+            try:
+                blocks_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for block in blocks:
+                if not put(block):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+        finally:
+            # Closing the stage runs its cleanup, such as stopping the process of in_process
+            if hasattr(blocks, "close"):
+                blocks.close()
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        yield from _queued(blocks_queue.get)
+    finally:
+        stopped.set()
+
+
+def _produce(stage, args, blocks_queue):
+    try:
+        for block in stage(*args):
+            blocks_queue.put(block)
+        blocks_queue.put(None)
+    except Exception as e:
+        blocks_queue.put(e)
+
+
+def in_process(stage, args, maxsize=QUEUE_BLOCKS):
+    """
+    Runs a stage in its own process, which works up to maxsize blocks ahead of the next stage.
+
+    Args:
+        stage (function): A module-level generator function, such as parse_blocks
+        args (tuple): The arguments of the stage
+        maxsize (int, optional): The number of blocks the stage can work ahead. Defaults to QUEUE_BLOCKS.
+
+    Yields:
+        np.array: The blocks output by the stage
+    """
+    blocks_queue = multiprocessing.Queue(maxsize)
+    process = multiprocessing.Process(target=_produce, args=(stage, args, blocks_queue), daemon=True)
+    process.start()
+    try:
+        yield from _queued(blocks_queue.get)
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+
+def stream_blocks(file_path, sr, columns, filtering=False, block_rows=BLOCK_ROWS, concurrent=True):
+    """
+    Connects the parse stage and, if filtering, the filter stage, running them concurrently if requested.
+
+    Returns:
+        iterable: The blocks from parse_blocks, with the filtered ECG column added last if filtering
+    """
+    if concurrent:
+        blocks = in_process(parse_blocks, (file_path, sr, columns, block_rows))
+    else:
+        blocks = parse_blocks(file_path, sr, columns, block_rows)
+    if filtering:
+        blocks = filter_blocks(blocks, sr)
+        if concurrent:
+            blocks = threaded(blocks)
+    return blocks
+
+
+def run_analysis(file_path, sr, ecg_column, pulse_column=None, filtering=False, block_rows=BLOCK_ROWS,
+                 directory=None, formats=(exporter.TEXT_TABLES,), concurrent=None):
+    """
+    Detects the R-peaks of a recording, divides it into segments and optionally exports the
+    results, reading the file once.
+
+    Args:
+        file_path (str): The path to the recording
+        sr (int): The sampling rate of the data
+        ecg_column (int): The column with the ECG data
+        pulse_column (int, optional): The column with the pulse, or None to analyse the whole recording. Defaults to None.
+        filtering (bool, optional): Whether to detect the R Peaks in the filtered signal. Defaults to False.
+        block_rows (int, optional): The number of rows read at a time. Defaults to BLOCK_ROWS.
+        directory (str, optional): The folder to export to, or None to not export. Defaults to None.
+        formats (tuple, optional): The formats to export, as in exporter.bulk_export. Defaults to (exporter.TEXT_TABLES,).
+        concurrent (bool, optional): Whether to run the stages concurrently. Defaults to None, which runs
+        them concurrently when there is more than one CPU.
+
+    Returns:
+        np.array: The sample indices of the R Peaks
+        list: The (start, end) sample indices of each segment
+        list: The paths of the exported files
+    """
+    columns = [ecg_column] + ([pulse_column] if pulse_column is not None else [])
+    if concurrent is None:
+        concurrent = (os.cpu_count() or 1) > 1
+    with tempfile.TemporaryDirectory() as spill_directory:
+        primary_path = os.path.join(spill_directory, "primary.bin")
+        pulse_path = os.path.join(spill_directory, "pulse.bin")
+        primary_column = -1 if filtering else 1
+        spilled = {"rows": 0}
+
+        def spill(blocks, primary_file, pulse_file):
+            for block in blocks:
+                primary_file.write(np.ascontiguousarray(block[:, [0, primary_column]]).tobytes())
+                if pulse_column is not None:
+                    pulse_file.write(np.ascontiguousarray(block[:, 2]).tobytes())
+                spilled["rows"] += len(block)
+                yield block
+
+        with instrumentation.stage("stream detect") as stage:
+            with open(primary_path, "wb") as primary_file, open(pulse_path, "wb") as pulse_file:
+                blocks = stream_blocks(file_path, sr, columns, filtering, block_rows, concurrent)
+                found = list(detect_blocks(spill(blocks, primary_file, pulse_file), sr, primary_column))
+            found = np.concatenate(found)
+            rows = spilled["rows"]
+            primary = np.memmap(primary_path, dtype=np.float64, mode='r', shape=(rows, 2)) if rows else np.empty((0, 2))
+            r_peaks_list = p.merge_r_peaks(found, primary, sr)
+            stage.count(samples=rows, peaks=len(r_peaks_list))
+
+        with instrumentation.stage("stream segment", samples=rows) as stage:
+            if pulse_column is None:
+                segments = [(0, rows)]
+            else:
+                pulse = np.memmap(pulse_path, dtype=np.float64, mode='r', shape=(rows,)) if rows else np.empty(0)
+                segments = p.segments_from_edges(p.pulse_edges(pulse[:, None], 0, block_rows), rows, sr)
+                del pulse
+            stage.count(segments=len(segments))
+
+        written = []
+        if directory is not None:
+            file_name = os.path.splitext(os.path.basename(file_path))[0]
+            written = exporter.bulk_export(directory, file_name, r_peaks_list, primary, segments, sr, formats)
+        del primary
+    return r_peaks_list, segments, written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse a recording too large to load into memory.")
+    parser.add_argument("file_path")
+    parser.add_argument("--sr", type=int, required=True, help="the sampling rate of the recording")
+    parser.add_argument("--ecg-column", type=int, default=1)
+    parser.add_argument("--pulse-column", type=int, default=None, help="divide the recording into segments by this column")
+    parser.add_argument("--filter", action="store_true", help="detect R Peaks in the filtered signal")
+    parser.add_argument("--block-rows", type=int, default=BLOCK_ROWS, help="rows read at a time, which bounds memory use")
+    parser.add_argument("--out", default=None, help="the folder to export the R Peaks and R-R intervals to")
+    parser.add_argument("--sequential", action="store_true", help="run the stages one after another")
+    parser.add_argument("--formats", nargs="+", default=[exporter.TEXT_TABLES],
+                        choices=[exporter.TEXT_TABLES, exporter.SEGMENT_FILES, exporter.NPZ])
+    args = parser.parse_args()
+
+    r_peaks_list, segments, written = run_analysis(args.file_path, args.sr, args.ecg_column, args.pulse_column, args.filter,
+                                                   args.block_rows, args.out, args.formats, False if args.sequential else None)
+    print(f"{len(r_peaks_list)} R Peaks in {len(segments)} segments")
+    for path in written:
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,32 @@
 import numpy as np
 import scipy.fft
+import scipy.signal
 import pandas as pd
-from io import StringIO
+from io import BytesIO
+import io
+import bz2
+import gzip
+import lzma
+import mmap
+import multiprocessing
+import os
+import queue
+import threading
+import instrumentation
+
+ANALYSIS_RATE = 500
+REDETECT_MARGIN_SECONDS = 5
 
 def file_opener(file_path, sr):
     """
     Reads a file from the provided file path, processes the data into a pandas DataFrame and then a NumPy array.
 
+    The data is split into byte ranges of about PARSE_RANGE_BYTES which start and end on line 
+    boundaries. The ranges are parsed in parallel worker processes, and each worker writes its rows 
+    straight into one preallocated array shared with the other workers, at the row offset of its range.
+    Compressed files (.gz, .bz2 or .xz) cannot be split by byte offset, so they are decompressed on a
+    separate thread and parsed in blocks as they are decompressed.
+
     Args:
         file_path (string): The path to the file to be read
         sr (int): The sampling rate of the data
@@ -17,35 +37,386 @@ def file_opener(file_path, sr):
         int: The number of columns in the data
         int: The number of NaN values changed to 0s in the data
     """
-    with open(file_path, 'r', encoding='iso-8859-1') as f:
-        lines = f.readlines()
+    global _parse_output
+    if is_compressed(file_path):
+        return _open_compressed(file_path, sr)
+    with instrumentation.stage("parse") as stage:
+        body_start, num_columns = _data_body(file_path)
+        ranges = _line_ranges(file_path, body_start)
+        if not ranges:
+            raise pd.errors.EmptyDataError("No columns to parse from file")
+        workers = min(len(ranges), os.cpu_count() or 1)
+        if "fork" not in multiprocessing.get_all_start_methods():
+            workers = 1
+
+        # The number of lines in each range is an upper bound on its rows, as blank lines are skipped
+        jobs = [(file_path, start, end, end == ranges[-1][1]) for start, end in ranges]
+        max_rows = np.array(_map(_count_lines, jobs, workers), dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(max_rows)[:-1]))
+        size = int(max_rows.sum()) * num_columns
+        if workers > 1:
+            # Forked workers share the anonymous mapping, so their writes are visible here without copying
+            buffer = mmap.mmap(-1, max(size, 1) * 8)
+            _parse_output = np.frombuffer(buffer, dtype=float, count=size).reshape(-1, num_columns)
+        else:
+            _parse_output = np.empty((int(max_rows.sum()), num_columns))
+        try:
+            jobs = [(file_path, start, end, offset, num_columns) for (start, end), offset in zip(ranges, offsets.tolist())]
+            parsed = _map(_parse_range, jobs, workers)
+            data = _parse_output
+        finally:
+            _parse_output = None
+
+        # Close the gaps left by blank lines
+        num_rows = 0
+        for offset, (rows, _) in zip(offsets.tolist(), parsed):
+            if offset != num_rows:
+                data[num_rows:num_rows + rows] = data[offset:offset + rows]
+            num_rows += rows
+        data = data[:num_rows]
+        num_nan_values = sum(nans for _, nans in parsed)
+
+        data[:, 0] = np.arange(0, data.shape[0]/sr, 1/sr)
+        stage.count(samples=data.shape[0], columns=data.shape[1], workers=workers)
 
-    first_data_line = next((i for i, line in enumerate(lines) if all(c.isdigit() or c.isspace() or c=='.' or c=='-' for c in line.strip())), 0)
+    return data, data.shape[0], data.shape[1], num_nan_values
 
+PARSE_RANGE_BYTES = 64 * 2**20
+_parse_output = None
 
-    data_str = ''.join(lines[first_data_line:])
+def _data_body(file_path):
+    """
+    Finds the byte offset of the first line which only contains numbers, and the number of columns 
+    of the imported data, which has the time instead of the file's first column.
+    """
+    offset = 0
+    with open(file_path, 'rb') as f:
+        for line in f:
+            text = line.decode('iso-8859-1')
+            if all(c.isdigit() or c.isspace() or c=='.' or c=='-' for c in text.strip()):
+                return offset, len(text.rstrip('\r\n').split('\t'))
+            offset += len(line)
+    with open(file_path, 'rb') as f:
+        return 0, len(f.readline().decode('iso-8859-1').rstrip('\r\n').split('\t'))
+
+def _line_ranges(file_path, body_start):
+    """
+    Splits the data into byte ranges of about PARSE_RANGE_BYTES, moving each boundary to the start of the next line.
+    """
+    size = os.path.getsize(file_path)
+    num_ranges = max(1, -(-(size - body_start) // PARSE_RANGE_BYTES), min(os.cpu_count() or 1, (size - body_start) // 2**20))
+    bounds = [body_start]
+    with open(file_path, 'rb') as f:
+        for i in range(1, num_ranges):
+            f.seek(body_start + i*(size - body_start)//num_ranges - 1)
+            f.readline()
+            if f.tell() > bounds[-1]:
+                bounds.append(min(f.tell(), size))
+    if size > bounds[-1]:
+        bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _map(function, jobs, workers):
+    if workers == 1:
+        return [function(job) for job in jobs]
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+        return pool.map(function, jobs, chunksize=1)
+
+def _count_lines(job):
+    file_path, start, end, last = job
+    lines = 0
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(remaining, 16 * 2**20))
+            if not block:
+                break
+            lines += block.count(b'\n')
+            remaining -= len(block)
+            last_byte = block[-1:]
+    # A last line without a newline
+    if last and end > start and last_byte != b'\n':
+        lines += 1
+    return lines
+
+def _parse_range(job):
+    """
+    Parses the rows of one byte range into the shared array, returning the number of rows and NaN values.
+    """
+    file_path, start, end, offset, num_columns = job
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        body = f.read(end - start)
+    if not body.strip():
+        return 0, 0
+    values, num_nan_values = parse_lines(body, num_columns)
+    _parse_output[offset:offset + len(values), 1:] = values
+    return len(values), num_nan_values
+
+def parse_lines(body, num_columns):
+    """
+    Parses whole lines of data, returning every column but the first with NaN values changed to 0s, and the number of NaN values.
 
+    Args:
+        body (bytes): Whole tab-separated lines of numbers
+        num_columns (int): The number of columns in each line
 
-    df = pd.read_csv(StringIO(data_str), sep="\t", header=None)
+    Returns:
+        np.array: The values of columns 1 onwards, so column c of the array from file_opener is column c-1
+        int: The number of NaN values changed to 0s
+    """
+    df = pd.read_csv(BytesIO(body), sep="\t", header=None, names=range(num_columns), index_col=False, encoding='iso-8859-1')
+    df = df.drop(df.columns[0], axis=1)
+    num_nan_values = int(df.isna().sum().sum())
+    df.fillna(0, inplace=True)
+    return df.to_numpy().astype(float), num_nan_values
 
+COMPRESSED_OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+DECOMPRESS_BLOCK_BYTES = 2**20
+DECOMPRESS_QUEUE_BLOCKS = 8
+COMPRESSED_PARSE_BYTES = 16 * 2**20
 
-    df = df.drop(df.columns[0], axis=1)
-    
+def is_compressed(file_path):
+    return os.path.splitext(file_path)[1].lower() in COMPRESSED_OPENERS
 
-    num_nan_values = df.isna().sum().sum()
-    
-  
-    df.fillna(0, inplace=True)
-    
+class DecompressingReader(io.RawIOBase):
+    """
+    This class is a binary file which decompresses a .gz, .bz2 or .xz file on a separate thread while 
+    it is read. The thread works at most maxsize blocks ahead of the reader, so the memory used does not
+    depend on the size of the file, and no decompressed copy of the file is written. The decompressors
+    release the GIL, so decompression overlaps with parsing.
 
-    data = df.to_numpy().astype(float)
-    
-    time_array = np.arange(0, data.shape[0]/sr, 1/sr)
-    data = np.insert(data, 0, time_array, axis=1)
+    Args:
+        file_path (string): The path to the compressed file
+        block_bytes (int, optional): The decompressed bytes in each block. Defaults to DECOMPRESS_BLOCK_BYTES.
+        maxsize (int, optional): The number of blocks the thread can work ahead. Defaults to DECOMPRESS_QUEUE_BLOCKS.
+    """
+    def __init__(self, file_path, block_bytes=DECOMPRESS_BLOCK_BYTES, maxsize=DECOMPRESS_QUEUE_BLOCKS):
+        super().__init__()
+        self.blocks = queue.Queue(maxsize)
+        self.pending = memoryview(b"")
+        self.finished = False
+        self.stopped = threading.Event()
+        threading.Thread(target=self._decompress, args=(file_path, block_bytes), daemon=True).start()
+
+    def _decompress(self, file_path, block_bytes):
+        try:
+            with COMPRESSED_OPENERS[os.path.splitext(file_path)[1].lower()](file_path, 'rb') as f:
+                while not self.stopped.is_set():
+                    block = f.read(block_bytes)
+                    if not block:
+                        break
+                    self._put(block)
+            self._put(b"")
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        # Gives up once the reader is closed, so the thread does not wait for a reader which has gone
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.pending and not self.finished:
+            block = self.blocks.get()
+            if isinstance(block, BaseException):
+                self.finished = True
+                raise block
+            self.finished = not block
+            self.pending = memoryview(block)
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self):
+        self.stopped.set()
+        super().close()
+
+def open_data(file_path):
+    """
+    Opens a data file to read its bytes, decompressing it on a separate thread if it is a .gz, .bz2 or .xz file.
+    """
+    if is_compressed(file_path):
+        return io.BufferedReader(DecompressingReader(file_path), DECOMPRESS_BLOCK_BYTES)
+    return open(file_path, 'rb')
+
+def _open_compressed(file_path, sr):
+    """
+    Parses a compressed file in blocks of about COMPRESSED_PARSE_BYTES of whole lines while it is 
+    decompressed, returning the same as file_opener.
+    """
+    with instrumentation.stage("parse compressed") as stage:
+        parsed = []
+        num_nan_values = 0
+        with open_data(file_path) as f:
+            # The header lines are skipped as in _data_body
+            carry = b""
+            for line in f:
+                text = line.decode('iso-8859-1')
+                if all(c.isdigit() or c.isspace() or c=='.' or c=='-' for c in text.strip()):
+                    carry, num_columns = line, len(text.rstrip('\r\n').split('\t'))
+                    break
+            else:
+                raise pd.errors.EmptyDataError("No columns to parse from file")
+            while True:
+                block = f.read(COMPRESSED_PARSE_BYTES)
+                body = carry + block
+                if block:
+                    end = body.rfind(b"\n") + 1
+                    body, carry = body[:end], body[end:]
+                if body.strip():
+                    values, nans = parse_lines(body, num_columns)
+                    parsed.append(values)
+                    num_nan_values += nans
+                if not block:
+                    break
+        num_rows = sum(len(values) for values in parsed)
+        data = np.empty((num_rows, num_columns))
+        row = 0
+        for values in parsed:
+            data[row:row + len(values), 1:] = values
+            row += len(values)
+        data[:, 0] = np.arange(0, data.shape[0]/sr, 1/sr)
+        stage.count(samples=data.shape[0], columns=data.shape[1])
+    return data, data.shape[0], data.shape[1], num_nan_values
+
+ROW_INDEX_STRIDE = 10000
+ROW_INDEX_SUFFIX = ".rowindex.npz"
+RANGE_MARGIN_SECONDS = 10
+
+def build_row_index(file_path, stride=ROW_INDEX_STRIDE):
+    """
+    Builds a sparse index of the byte offsets of the data rows of a text file in one scan of its bytes,
+    without parsing it. The offset of every stride-th row is kept, so any range of rows can be read by
+    seeking to the nearest indexed row before it. Blank lines are skipped, as when the file is parsed.
+
+    Args:
+        file_path (string): The path to the file
+        stride (int, optional): The number of rows between indexed rows. Defaults to ROW_INDEX_STRIDE.
+
+    Returns:
+        dict: The number of rows and columns, the stride, the byte offsets of the indexed rows, and the
+        size and modification time of the file they belong to
+    """
+    with instrumentation.stage("index rows") as stage:
+        body_start, num_columns = _data_body(file_path)
+        stat = os.stat(file_path)
+        offsets = []
+        num_rows = 0
+        line_start = position = body_start
+        previous_byte = 10
+        with open(file_path, 'rb') as f:
+            f.seek(body_start)
+            while True:
+                block = f.read(16 * 2**20)
+                if not block:
+                    break
+                data = np.frombuffer(block, dtype=np.uint8)
+                ends = np.flatnonzero(data == 10) + position
+                starts = np.concatenate(([line_start], ends[:-1] + 1))
+                lengths = ends - starts
+                # A line holding only a carriage return is blank too
+                first_bytes = np.where(starts >= position, data[np.clip(starts - position, 0, len(data) - 1)], previous_byte)
+                rows = starts[(lengths > 1) | ((lengths == 1) & (first_bytes != 13))]
+                indexed = (-num_rows) % stride
+                offsets.append(rows[indexed::stride])
+                num_rows += len(rows)
+                if len(ends):
+                    line_start = ends[-1] + 1
+                position += len(block)
+                previous_byte = data[-1]
+        # A last line without a newline
+        if position > line_start and not (position - line_start == 1 and previous_byte == 13):
+            if num_rows % stride == 0:
+                offsets.append(np.array([line_start]))
+            num_rows += 1
+        stage.count(samples=num_rows)
+    return {"num_rows": num_rows, "num_columns": num_columns, "stride": stride,
+            "offsets": np.concatenate(offsets + [np.empty(0, dtype=np.int64)]).astype(np.int64),
+            "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def row_index(file_path, stride=ROW_INDEX_STRIDE):
+    """
+    Returns the row index of a text file, loading it from next to the file when it was built for the 
+    file as it is now. Otherwise the index is built and saved next to the file, if the folder can be written to.
 
+    Args:
+        file_path (string): The path to the file
+        stride (int, optional): The number of rows between indexed rows. Defaults to ROW_INDEX_STRIDE.
+
+    Returns:
+        dict: The index, as returned by build_row_index
+    """
+    index_path = file_path + ROW_INDEX_SUFFIX
+    stat = os.stat(file_path)
+    try:
+        with np.load(index_path) as saved:
+            index = {name: saved[name] for name in saved.files}
+        if int(index["size"]) == stat.st_size and int(index["mtime_ns"]) == stat.st_mtime_ns and int(index["stride"]) == stride:
+            return {name: (value if name == "offsets" else int(value)) for name, value in index.items()}
+    except (OSError, ValueError, KeyError):
+        pass
+    index = build_row_index(file_path, stride)
+    tmp_path = f"{index_path}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **index)
+        os.replace(tmp_path, index_path)
+    except OSError:
+        pass
+    return index
+
+def read_rows(file_path, sr, start_row, end_row, index=None):
+    """
+    Parses a range of rows of a text file, seeking to it with the row index rather than parsing the 
+    rows before it. The time column is the time of each row in the whole file, as in file_opener.
+
+    Args:
+        file_path (string): The path to the file
+        sr (int): The sampling rate of the data
+        start_row (int): The first row to read
+        end_row (int): The row after the last row to read
+        index (dict, optional): The row index of the file. Defaults to None, which loads or builds it.
+
+    Returns:
+        np.array: The imported rows
+        int: The number of rows read
+        int: The number of columns in the data
+        int: The number of NaN values changed to 0s in the rows
+    """
+    if index is None:
+        index = row_index(file_path)
+    stride, offsets, num_columns = index["stride"], index["offsets"], index["num_columns"]
+    start_row, end_row = max(0, start_row), min(end_row, index["num_rows"])
+    with instrumentation.stage("read rows", samples=max(0, end_row - start_row)) as stage:
+        if end_row <= start_row:
+            return np.empty((0, num_columns)), 0, num_columns, 0
+        first_block, last_block = start_row // stride, -(-end_row // stride)
+        start = int(offsets[first_block])
+        end = int(offsets[last_block]) if last_block < len(offsets) else index["size"]
+        with open(file_path, 'rb') as f:
+            f.seek(start)
+            body = f.read(end - start)
+        df = pd.read_csv(BytesIO(body), sep="\t", header=None, names=range(num_columns), index_col=False, encoding='iso-8859-1')
+        skip = start_row - first_block*stride
+        df = df.iloc[skip:skip + end_row - start_row, 1:]
+        num_nan_values = int(df.isna().sum().sum())
+        data = np.empty((len(df), num_columns))
+        data[:, 1:] = df.fillna(0).to_numpy().astype(float)
+        data[:, 0] = (start_row + np.arange(len(df))) * (1/sr)
+        stage.count(samples=len(data), columns=num_columns)
     return data, data.shape[0], data.shape[1], num_nan_values
 
-def filter(timeseries,sr):
+def filter(timeseries,sr, low_cut=0.5, high_cut=15):
     """
     Apples a Fourier Transform to the timeseries and removes frequencies 
     below 0.5Hz and above 15Hz. Then converts the data back to the time domain.
@@ -53,22 +424,25 @@ def filter(timeseries,sr):
     Args:
         timeseries (np.array): The timeseries data to be filtered
         sr (int): The sampling rate of the timeseries data
+        low_cut (float, optional): Frequencies below this are removed. Defaults to 0.5.
+        high_cut (float, optional): Frequencies above this are removed. Defaults to 15.
 
     Returns:
         np.array: The filtered timeseries data
     """
-    ts = 1/sr
-    time_sample = timeseries[:,0]
-    data_sample = timeseries[:,1]
-    sig_fft = scipy.fft.fft(data_sample)
-    sample_freq = scipy.fft.fftfreq(data_sample.size, d=ts)
-    # Filtering
-
-    mask = (np.abs(sample_freq) < 0.5) | (np.abs(sample_freq) > 15)
-    sig_fft[mask] = 0
-    filtered_signal = np.real(scipy.fft.ifft(sig_fft))
-
-    time_series = np.column_stack((time_sample, filtered_signal))
+    with instrumentation.stage("filter", samples=len(timeseries)):
+        ts = 1/sr
+        time_sample = timeseries[:,0]
+        data_sample = timeseries[:,1]
+        sig_fft = scipy.fft.fft(data_sample)
+        sample_freq = scipy.fft.fftfreq(data_sample.size, d=ts)
+        # Filtering
+
+        mask = (np.abs(sample_freq) < low_cut) | (np.abs(sample_freq) > high_cut)
+        sig_fft[mask] = 0
+        filtered_signal = np.real(scipy.fft.ifft(sig_fft))
+
+        time_series = np.column_stack((time_sample, filtered_signal))
     return time_series
 
 def signal_to_noise(clean_time_series, noisy_time_series):
@@ -82,11 +456,12 @@ def signal_to_noise(clean_time_series, noisy_time_series):
     Returns:
         int: the signal to noise ratio
     """
-    noise = noisy_time_series - clean_time_series
-    return 20 * np.log10(np.linalg.norm(clean_time_series) / np.linalg.norm(noise)) if np.any(noise) else float("inf") 
+    with instrumentation.stage("signal to noise", samples=len(clean_time_series)):
+        noise = noisy_time_series - clean_time_series
+        return 20 * np.log10(np.linalg.norm(clean_time_series) / np.linalg.norm(noise)) if np.any(noise) else float("inf") 
 
 
-def find_r_peaks(timeseries,sample_rate = 1000,sample_length_mult = 1, step_length_mult = 0.5):
+def find_r_peaks(timeseries,sample_rate = 1000,sample_length_mult = 1, step_length_mult = 0.5, max_mult=0.8, mean_mult=0.8):
     """
     Detects R-peaks in the filtered signal using a two-stage process based on threshold values. 
     R-peaks are specific points of interest in an ECG signal. 
@@ -97,81 +472,337 @@ def find_r_peaks(timeseries,sample_rate = 1000,sample_length_mult = 1, step_leng
         sample_rate (int, optional): The sample rate of the data. Defaults to 1000.
         sample_length_mult (int, optional): The factor of the sampling rate in each chunked portion (1 = 1 second per chunk). Defaults to 1.
         step_length_mult (float, optional): The factor of the sampling rate that is stepped through int he chunk. Defaults to 0.5.
+        max_mult (float, optional): The factor of each chunk's maximum that its tallest peaks must reach. Defaults to 0.8.
+        mean_mult (float, optional): The factor of the mean of the tallest peaks that an R Peak must reach. Defaults to 0.8.
 
     Returns:
-        np.array: The time-domain location and voltages of the R Peaks.
+        np.array: The sample indices of the R Peaks.
     """
-    time_sample = timeseries[:,0]
-    data_sample = timeseries[:,1]
+    with instrumentation.stage("detect", samples=len(timeseries)) as stage:
+        data_sample = timeseries[:,1]
 
-    sample_length = int(sample_rate * sample_length_mult)
-    step_length = int(sample_rate * step_length_mult)
+        sample_length = int(sample_rate * sample_length_mult)
+        step_length = int(sample_rate * step_length_mult)
 
-    all_times = []
-    all_volts = []
-    indices = np.arange(0,len(time_sample)-(sample_length-step_length),step_length)
-    for idx in indices:
-        time_chunk = time_sample[idx:idx+sample_length]
-        data_chunk = data_sample[idx:idx+sample_length]
-        
-        max_val = np.max(data_chunk)
-        peaks_1, _ = scipy.signal.find_peaks(data_chunk, height = max_val*0.8)
+        all_samples = []
+        indices = np.arange(0,len(data_sample)-(sample_length-step_length),step_length)
+        for idx in indices:
+            # Collect the results from this chunk
+            all_samples.append(idx + window_r_peaks(data_sample[idx:idx+sample_length], max_mult, mean_mult))
+        unique_rows = merge_r_peaks(np.concatenate(all_samples + [np.empty(0, dtype=np.int64)]), timeseries, sample_rate)
+        stage.count(peaks=len(unique_rows))
+    return unique_rows
 
-        if (len(data_chunk[peaks_1]) != 0):
-            mean_val = np.mean(data_chunk[peaks_1])
-            peaks, _ = scipy.signal.find_peaks(data_chunk, height = mean_val*0.8)
+def window_r_peaks(data_chunk, max_mult=0.8, mean_mult=0.8):
+    """
+    Finds the R-peaks in one chunk of find_r_peaks: the peaks above 80% of the mean of the 
+    peaks above 80% of the chunk's maximum.
 
-            times = time_chunk[peaks]
-            volts = data_chunk[peaks]
+    Args:
+        data_chunk (np.array): The voltages of the samples in the chunk
+        max_mult (float, optional): The factor of the chunk's maximum that its tallest peaks must reach. Defaults to 0.8.
+        mean_mult (float, optional): The factor of the mean of the tallest peaks that an R Peak must reach. Defaults to 0.8.
 
-            # Collect the results from this chunk
-            all_times.extend(times)
-            all_volts.extend(volts)
-    # Convert back to arrays for convenience
-    all_times = np.array(all_times)
-    all_volts = np.array(all_volts)
-    result = np.column_stack((all_times, all_volts))
-    _, idx = np.unique(result[:, 0], return_index=True)
-
-    # Use these indices to select rows with unique values in the first column
-    unique_rows = result[np.sort(idx)]
-    unique_rows = r_peaks_filter(unique_rows)
-    return unique_rows
+    Returns:
+        np.array: The indices of the R Peaks in the chunk
+    """
+    max_val = np.max(data_chunk)
+    peaks_1, _ = scipy.signal.find_peaks(data_chunk, height = max_val*max_mult)
+
+    if (len(data_chunk[peaks_1]) == 0):
+        return peaks_1
+    mean_val = np.mean(data_chunk[peaks_1])
+    peaks, _ = scipy.signal.find_peaks(data_chunk, height = mean_val*mean_mult)
+    return peaks
+
+def merge_r_peaks(all_samples, timeseries, sample_rate):
+    """
+    Combines the R-peaks found in the overlapping chunks of find_r_peaks into one sorted list 
+    without duplicates, removes peaks which are too close together and adds missed peaks.
+
+    Args:
+        all_samples (np.array): The sample indices of the R Peaks found in every chunk
+        timeseries (np.array): The timeseries the R Peaks were detected in
+        sample_rate (int): The sample rate of the data
+
+    Returns:
+        np.array: The sample indices of the R Peaks.
+    """
+    unique_rows = np.unique(all_samples).astype(sample_dtype(len(timeseries)))
+    unique_rows = r_peaks_filter(unique_rows, timeseries)
+    return insert_r_peaks(unique_rows, find_missed_r_peaks(unique_rows, timeseries, sample_rate))
+
+def sample_dtype(length):
+    """
+    Returns the smallest integer type which can index every sample of a recording of the given length.
+    """
+    return np.int32 if length <= np.iinfo(np.int32).max else np.int64
+
+def find_r_peaks_multirate(timeseries, sample_rate, analysis_rate=ANALYSIS_RATE, refine_seconds=0.01):
+    """
+    Detects R-peaks in a signal recorded at a high sampling rate by running find_r_peaks on a 
+    decimated copy of the signal and then moving each peak to the highest sample of the original 
+    signal within refine_seconds of it. This finds the same peaks as find_r_peaks on the original 
+    signal to within a sample, while detection only processes analysis_rate samples per second.
+
+    Args:
+        timeseries (np.array): The timeseries data to detect the R Peaks in
+        sample_rate (int): The sample rate of the data
+        analysis_rate (int, optional): The approximate sample rate detection is run at. Defaults to ANALYSIS_RATE.
+        refine_seconds (float, optional): How far either side of each detected peak the original signal is searched. Defaults to 0.01.
+
+    Returns:
+        np.array: The sample indices of the R Peaks.
+    """
+    decimated, decimated_rate = decimate(timeseries, sample_rate, analysis_rate)
+    if decimated_rate == sample_rate:
+        return find_r_peaks(timeseries, sample_rate)
+    factor = int(round(sample_rate / decimated_rate))
+    return refine_r_peaks(find_r_peaks(decimated, decimated_rate), timeseries, sample_rate, factor, refine_seconds)
+
+def refine_r_peaks(r_peaks_list, timeseries, sample_rate, factor, refine_seconds=0.01):
+    """
+    Moves R-peaks detected in a signal decimated by factor to the highest sample of the original 
+    signal within refine_seconds of them.
+
+    Args:
+        r_peaks_list (np.array): The sample indices of the R Peaks in the decimated signal
+        timeseries (np.array): The original timeseries
+        sample_rate (int): The sample rate of the original timeseries
+        factor (int): The decimation factor
+        refine_seconds (float, optional): How far either side of each peak the original signal is searched. Defaults to 0.01.
+
+    Returns:
+        np.array: The sorted sample indices of the R Peaks in the original signal
+    """
+    with instrumentation.stage("refine", peaks=len(r_peaks_list)):
+        window = max(1, int(round(refine_seconds*sample_rate)))
+        # The first original sample at or after the centre of each decimated block
+        centres = np.asarray(r_peaks_list, dtype=np.int64)*factor + factor//2
+        offsets = np.clip(centres[:, None] + np.arange(-window, window + 1), 0, len(timeseries) - 1)
+        peaks = offsets[np.arange(len(offsets)), np.argmax(timeseries[offsets, 1], axis=1)]
+        # Two decimated peaks can refine to the same sample
+        peaks = np.unique(peaks)
+    return peaks.astype(sample_dtype(len(timeseries)))
+
+def decimate(timeseries, sample_rate, analysis_rate=ANALYSIS_RATE):
+    """
+    Reduces the sample rate by a whole factor q, the largest that keeps it at or above analysis_rate, 
+    by averaging each block of q samples. The average is the anti-aliasing filter, and is much cheaper 
+    than a long FIR filter while keeping the QRS complexes, which are well below analysis_rate/2.
+    The samples after the last whole block are dropped.
+
+    Args:
+        timeseries (np.array): The timeseries data to decimate
+        sample_rate (int): The sample rate of the data
+        analysis_rate (int, optional): The lowest sample rate to decimate to. Defaults to ANALYSIS_RATE.
+
+    Returns:
+        np.array: The decimated timeseries
+        float: The sample rate of the decimated timeseries
+    """
+    factor = int(sample_rate // analysis_rate)
+    if factor < 2:
+        return timeseries, sample_rate
+    with instrumentation.stage("decimate", samples=len(timeseries)):
+        length = len(timeseries) // factor * factor
+        volts = timeseries[:length, 1].reshape(-1, factor).sum(axis=1) / factor
+        # Each average is centred half a block after the first sample of its block
+        times = timeseries[:length:factor, 0] + (factor - 1) / (2 * sample_rate)
+        decimated = np.column_stack((times, volts))
+    return decimated, sample_rate/factor
 
 # The above code is the filter for the r peaks. It takes a list of r peaks, and uses the time difference between each peak to determine if it needs to be removed or if there are any missing peaks.
 # If the time difference between two peaks is too small, the code looks at the voltage of the peaks and removes the one with the lower voltage.
-# If the time difference between two peaks is too large, the code looks for missing peaks in between the two peaks and adds them to the list of r peaks.
+# If the time difference between two peaks is too large, find_missed_r_peaks looks for missing peaks in between the two peaks and they are added to the list of r peaks.
 
-def r_peaks_filter(r_peaks_list):
+def r_peaks_filter(r_peaks_list, timeseries, lower_threshold=None):
     """
     Filters out R-peaks that are too close together in time, based on a threshold. 
     This is to ensure that the detected peaks are not artifacts or noise, but represent real heartbeats.
 
     Args:
-        r_peaks_list (np.array): The list of r peaks to be filtered
+        r_peaks_list (np.array): The sorted sample indices of the r peaks to be filtered
+        timeseries (np.array): The timeseries the R Peaks were detected in
+        lower_threshold (float, optional): The shortest interval in samples between two peaks. Defaults to 
+        None, the mean minus the standard deviation of the intervals between r_peaks_list.
     Returns:
-        np.array: The filtered list of r peaks
+        np.array: The filtered sample indices of the r peaks
     """
-    timestamps = r_peaks_list[:, 0]
-    voltages = r_peaks_list[:, 1]
+    timestamps = r_peaks_list
+    voltages = timeseries[r_peaks_list, 1]
     
-    time_diffs = np.diff(timestamps)
-    lower_threshold = np.mean(time_diffs) - np.std(time_diffs)
+    if lower_threshold is None:
+        time_diffs = np.diff(timestamps)
+        lower_threshold = np.mean(time_diffs) - np.std(time_diffs)
 
     i = 1
     while i < len(timestamps):
         if timestamps[i] - timestamps[i-1] < lower_threshold:
             if voltages[i] > voltages[i-1]:
-                r_peaks_list = np.delete(r_peaks_list, i-1, axis=0)
+                remove = i-1
             else:
-                r_peaks_list = np.delete(r_peaks_list, i, axis=0)
-
-            timestamps = r_peaks_list[:, 0]
-            voltages = r_peaks_list[:, 1]
+                remove = i
+            timestamps = np.delete(timestamps, remove)
+            voltages = np.delete(voltages, remove)
         else:
             i += 1  
 
-    return r_peaks_list
+    return timestamps
+
+def find_missed_r_peaks(r_peaks_list, timeseries, sample_rate=1000, gap_mult=1.5, height_mult=0.5, neighbours=8,
+                        start_sample=None, end_sample=None):
+    """
+    Searches for R-peaks missed by the detector inside R-R intervals that are much longer than the
+    intervals around them. Only the samples inside these gaps are searched, with a lower height 
+    threshold, so the cost depends on the number and length of the gaps rather than of the recording.
+
+    Args:
+        r_peaks_list (np.array): The sorted sample indices of the R Peaks
+        timeseries (np.array): The timeseries the R Peaks were detected in
+        sample_rate (int, optional): The sample rate of the data. Defaults to 1000.
+        gap_mult (float, optional): An interval is a gap if it is longer than this factor of the median 
+        of the surrounding intervals. Defaults to 1.5.
+        height_mult (float, optional): The factor of the smaller of the two R Peaks either side of a gap 
+        that a missed peak must reach. Defaults to 0.5.
+        neighbours (int, optional): The number of intervals either side used for the median. Defaults to 8.
+        start_sample (int, optional): Only search gaps which end at or after this sample. Defaults to None.
+        end_sample (int, optional): Only search gaps which start at or before this sample. Defaults to None.
+
+    Returns:
+        np.array: The sorted sample indices of the missed R Peaks
+    """
+    with instrumentation.stage("fill gaps", peaks=len(r_peaks_list)) as stage:
+        first, last = 0, len(r_peaks_list)
+        if start_sample is not None:
+            first = max(0, np.searchsorted(r_peaks_list, start_sample, side='left') - neighbours - 1)
+        if end_sample is not None:
+            last = min(last, np.searchsorted(r_peaks_list, end_sample, side='right') + neighbours + 1)
+        peaks = r_peaks_list[first:last]
+        if len(peaks) < 3:
+            return r_peaks_list[:0]
+
+        intervals = np.diff(peaks)
+        mode = 'reflect' if len(intervals) > neighbours else 'edge'
+        windows = np.lib.stride_tricks.sliding_window_view(np.pad(intervals, neighbours, mode=mode), 2*neighbours + 1)
+        expected = np.median(windows, axis=1)
+        gaps = np.flatnonzero(intervals > gap_mult*expected)
+        if start_sample is not None:
+            gaps = gaps[peaks[gaps + 1] >= start_sample]
+        if end_sample is not None:
+            gaps = gaps[peaks[gaps] <= end_sample]
+
+        found = []
+        for gap in gaps:
+            missing = int(round(intervals[gap]/expected[gap])) - 1
+            if missing < 1:
+                continue
+            # Beats closer than half an expected interval to the peaks either side are not searched
+            lo = peaks[gap] + int(np.ceil(expected[gap]/2))
+            hi = peaks[gap + 1] - int(np.floor(expected[gap]/2))
+            if hi <= lo:
+                continue
+            candidates, properties = scipy.signal.find_peaks(timeseries[lo:hi, 1], height=height_mult*min(timeseries[peaks[gap], 1], timeseries[peaks[gap + 1], 1]),
+                                                            distance=max(1, int(expected[gap]/2)))
+            tallest = np.sort(candidates[np.argsort(properties["peak_heights"])[::-1][:missing]])
+            found.append(lo + tallest)
+        missed = np.concatenate(found).astype(r_peaks_list.dtype) if found else r_peaks_list[:0]
+        stage.count(filled=len(missed))
+    return missed
+
+def insert_r_peaks(r_peaks_list, new_peaks):
+    """
+    Inserts R-peaks into a sorted list of R-peaks, keeping it sorted and without duplicates.
+
+    Args:
+        r_peaks_list (np.array): The sorted sample indices of the R Peaks
+        new_peaks (np.array): The sorted sample indices of the R Peaks to insert
+
+    Returns:
+        np.array: The R Peaks including the new ones
+    """
+    if len(new_peaks) == 0:
+        return r_peaks_list
+    positions = np.searchsorted(r_peaks_list, new_peaks)
+    present = r_peaks_list[np.minimum(positions, len(r_peaks_list) - 1)] == new_peaks if len(r_peaks_list) else np.zeros(len(new_peaks), dtype=bool)
+    return np.insert(r_peaks_list, positions[~present], new_peaks[~present])
+
+EDGE_DTYPE = np.dtype([('sample', '<i8'), ('level', 'i1')])
+PULSE_BLOCK_ROWS = 2**20
+
+def pulse_edges(data, column, block_rows=PULSE_BLOCK_ROWS):
+    """
+    Reduces a pulse channel to the samples where it crosses 0.9 of its maximum, reading it in blocks 
+    of rows so the channel is never copied as a whole. A sample equal to the threshold keeps the level
+    of the sample before it.
+
+    Args:
+        data (np.array): The data, read as data[rows, column] like the array returned by file_opener
+        column (int): The column with the pulse
+        block_rows (int, optional): The number of rows read at a time. Defaults to PULSE_BLOCK_ROWS.
+
+    Returns:
+        np.array: An array of EDGE_DTYPE with the sample of every change of level and the new level, 
+        1 above the threshold and 0 below it, sorted by sample
+    """
+    n = len(data)
+    with instrumentation.stage("pulse edges", samples=n) as stage:
+        starts = range(0, n, block_rows)
+        threshold = 0.9*max((np.max(data[start:start + block_rows, column]) for start in starts), default=0)
+        edges = [np.empty(0, dtype=EDGE_DTYPE)]
+        level = 0
+        for start in starts:
+            new_edges, level = block_edges(np.asarray(data[start:start + block_rows, column]), threshold, level, start)
+            edges.append(new_edges)
+        edges = np.concatenate(edges)
+        stage.count(edges=len(edges))
+    return edges
+
+def block_edges(block, threshold, level, start=0):
+    """
+    Finds the edges of the pulse in one block of it, continuing from the level at the end of the block before.
+
+    Args:
+        block (np.array): The pulse samples of the block
+        threshold (float): The level the pulse crosses at an edge
+        level (int): The level before the block, 1 above the threshold and 0 below it
+        start (int, optional): The sample index of the first sample of the block. Defaults to 0.
+
+    Returns:
+        np.array: The edges in the block, as in pulse_edges
+        int: The level at the end of the block
+    """
+    state = np.where(block > threshold, 1, np.where(block < threshold, 0, -1))
+    decided = np.maximum.accumulate(np.where(state >= 0, np.arange(len(block)), -1))
+    state = np.where(decided >= 0, state[np.maximum(decided, 0)], level)
+    changes = np.flatnonzero(state != np.concatenate(([level], state[:-1])))
+    edges = np.empty(len(changes), dtype=EDGE_DTYPE)
+    edges['sample'] = changes + start
+    edges['level'] = state[changes]
+    return edges, int(state[-1]) if len(state) else level
+
+def segments_from_edges(edges, length, sr, sr_multiple=5):
+    """
+    Divides a recording into segments at the edges of its pulse. A segment runs from one edge to 
+    the next when they are more than sr_multiple seconds apart, and the last segment runs from the 
+    last edge to the last sample.
+
+    Args:
+        edges (np.array): The edges of the pulse, from pulse_edges
+        length (int): The number of samples in the recording
+        sr (int): The sample rate of the data
+        sr_multiple (int, optional): The minimum length of a segment in seconds. Defaults to 5.
+
+    Returns:
+        list: The (start, end) sample indices of each segment
+    """
+    changes = edges['sample']
+    previous = np.concatenate(([0], changes[:-1]))
+    long_enough = (changes - previous) > int(sr * sr_multiple)
+    results = list(zip(previous[long_enough].tolist(), changes[long_enough].tolist()))
+    if length and (len(changes) == 0 or changes[-1] != length - 1):
+        results.append((int(changes[-1]) if len(changes) else 0, length - 1))
+    return results
 
 def divide_by_chunks(pulse_series, sr, sr_multiple=5):
     """
@@ -186,22 +817,83 @@ def divide_by_chunks(pulse_series, sr, sr_multiple=5):
     Returns:
         np.array: The indices of the start and end of each chunk. 
     """
-    thresh = int(sr * sr_multiple)
-    max_pulse = np.max(pulse_series)
-    results = []
-    curr_start = 0
-    in_pulse = False
-    for i in range(len(pulse_series)):
-        if pulse_series[i] > 0.9*max_pulse and in_pulse == False:
-            if (i - curr_start) > thresh:
-                results.append((curr_start,i))
-            curr_start = i
-            in_pulse = True 
-        elif pulse_series[i] < 0.9*max_pulse and in_pulse == True:
-            if (i - curr_start) > thresh:
-                results.append((curr_start,i))
-            curr_start = i
-            in_pulse = False
-        elif i == len(pulse_series) -1:
-            results.append((curr_start,i))
+    with instrumentation.stage("segment", samples=len(pulse_series)) as stage:
+        results = segments_from_edges(pulse_edges(pulse_series[:, None], 0), len(pulse_series), sr, sr_multiple)
+        stage.count(segments=len(results))
     return results 
+
+def replace_r_peaks(r_peaks_list, start, end, new_peaks):
+    """
+    Replaces the R-peaks in a range of samples with a new set of R-peaks.
+
+    Args:
+        r_peaks_list (np.array): The sorted sample indices of all R Peaks
+        start (int): The first sample of the replaced range
+        end (int): The sample after the end of the replaced range
+        new_peaks (np.array): The sample indices of the R Peaks to insert. These should lie within the range.
+
+    Returns:
+        np.array: The updated R Peaks, sorted
+    """
+    first, last = np.searchsorted(r_peaks_list, (start, end))
+    return np.concatenate((r_peaks_list[:first], np.sort(new_peaks).astype(r_peaks_list.dtype), r_peaks_list[last:]))
+
+def redetect_r_peaks(r_peaks_list, timeseries, start, end, sample_rate=1000, margin_seconds=REDETECT_MARGIN_SECONDS, **thresholds):
+    """
+    Runs find_r_peaks again over a range of samples, with its own thresholds, and replaces the R-peaks
+    in the range with the result. The detector is run over the range plus a margin either side, so the
+    chunks and gaps at the ends of the range are judged as they would be in the whole recording. The 
+    R-peaks outside the range, including manual edits, are kept.
+
+    Args:
+        r_peaks_list (np.array): The sorted sample indices of all R Peaks
+        timeseries (np.array): The timeseries the R Peaks are detected in
+        start (int): The first sample of the range
+        end (int): The sample after the end of the range
+        sample_rate (int, optional): The sample rate of the data. Defaults to 1000.
+        margin_seconds (float, optional): The time either side of the range which is also searched. Defaults to REDETECT_MARGIN_SECONDS.
+        **thresholds: The sample_length_mult, step_length_mult, max_mult and mean_mult of find_r_peaks
+
+    Returns:
+        np.array: The updated R Peaks, sorted
+        np.array: The sample indices of the R Peaks removed from the range
+        np.array: The sample indices of the R Peaks added to the range
+    """
+    margin = int(margin_seconds*sample_rate)
+    lo, hi = max(0, start - margin), min(len(timeseries), end + margin)
+    found = lo + find_r_peaks(timeseries[lo:hi], sample_rate, **thresholds).astype(np.int64)
+    found = found[(found >= start) & (found < end)]
+    old = peak_range(r_peaks_list, start, end)
+    removed, added = np.setdiff1d(old, found), np.setdiff1d(found, old)
+    return replace_r_peaks(r_peaks_list, start, end, found), removed, added
+
+def label_segments(r_peaks_list, segments):
+    """
+    Finds the segment containing each R-peak.
+
+    Args:
+        r_peaks_list (np.array): The sorted sample indices of the R Peaks
+        segments (list): The (start, end) sample indices of each segment, as returned by divide_by_chunks
+
+    Returns:
+        np.array: The index of the segment containing every R Peak, or -1 if it is in none
+    """
+    bounds = np.asarray(segments, dtype=np.int64).reshape(-1, 2)
+    segment_ids = np.searchsorted(bounds[:, 0], r_peaks_list, side='right') - 1
+    inside = (segment_ids >= 0) & (r_peaks_list < bounds[np.maximum(segment_ids, 0), 1])
+    return np.where(inside, segment_ids, -1)
+
+def peak_range(r_peaks_list, start, end):
+    """
+    Returns the R-peaks in a range of samples.
+
+    Args:
+        r_peaks_list (np.array): The sorted sample indices of the R Peaks
+        start (int): The first sample of the range
+        end (int): The sample after the end of the range
+
+    Returns:
+        np.array: A view of the R Peaks from start up to end
+    """
+    first, last = np.searchsorted(r_peaks_list, (start, end))
+    return r_peaks_list[first:last]
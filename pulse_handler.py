@@ -1,6 +1,11 @@
-from PyQt5.QtWidgets import QComboBox, QCheckBox, QDialogButtonBox, QFormLayout, QLabel, QVBoxLayout,  QDialog, QMessageBox, QPushButton, QApplication
+from PyQt5.QtWidgets import QComboBox, QCheckBox, QDialogButtonBox, QFormLayout, QLabel, QVBoxLayout,  QDialog, QMessageBox, QPushButton, QApplication, QLineEdit
 import processor as p 
 import numpy as np
+import instrumentation
+import cache
+import session
+import signal_quality as sq
+import multilead
 
 class PulseSettingsDialog(QDialog):
     """This class creates a QDialog that allows the user to specify various 
@@ -13,13 +18,17 @@ class PulseSettingsDialog(QDialog):
     Args:
         QDialog (PyQt Dialog): This class inherits from the PyQt QDialog class.
     """
-    def __init__(self, file_name=None, file_width=None, parent=None):
+    def __init__(self, file_name=None, file_width=None, sr=int(1000), parent=None):
         super(PulseSettingsDialog, self).__init__(parent)
         self.setWindowTitle("Settings")
         self.ecg_column = 1
         self.pulse_column = 4
         self.file_label = QLabel(f"File: {file_name}")
         self.need_filtering_checkbox = QCheckBox("Filter this data?", self)
+        self.reduced_rate_checkbox = QCheckBox(f"Detect R Peaks at {p.ANALYSIS_RATE} Hz and refine them?", self)
+        self.reduced_rate_checkbox.setEnabled(sr >= 2*p.ANALYSIS_RATE)
+        self.other_leads_edit = QLineEdit(self)
+        self.other_leads_edit.setPlaceholderText("e.g. 2, 3")
 
         if file_width is None or file_width < 1:
             raise ValueError("Invalid file width.")
@@ -37,7 +46,9 @@ class PulseSettingsDialog(QDialog):
         form_layout = QFormLayout()
         form_layout.addRow("Column with ECG Data", self.ECGColumnDropdown)
         form_layout.addRow("Column with Pulse", self.pulseColumnDropdown)
+        form_layout.addRow("Other ECG Columns (multi-lead)", self.other_leads_edit)
         form_layout.addRow(self.need_filtering_checkbox)
+        form_layout.addRow(self.reduced_rate_checkbox)
 
         button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
         button_box.accepted.connect(self.accept)
@@ -58,7 +69,9 @@ class PulseSettingsDialog(QDialog):
         return (
             self.need_filtering_checkbox.isChecked(),
             self.ecg_column,
-            self.pulse_column
+            self.pulse_column,
+            self.reduced_rate_checkbox.isChecked(),
+            self.other_leads_edit.text()
         )
 
     def ecg_index_changed(self, i):
@@ -97,19 +110,21 @@ def pulse_settings_pane(self):
         Calls run_data_analysis if all inputs are valid and accepted.
     """
     try:
-        dialog = PulseSettingsDialog(self.file_path, self.file_width, self)
+        dialog = PulseSettingsDialog(self.file_path, self.file_width, self.sr, self)
         result = dialog.exec()
     except Exception:
         QMessageBox.warning(self, "An Error Occured", "Please try again.")
         self.select_file()
     if result == QDialog.Accepted:
         try:
-            selected_filtering, ecg_column, pulse_column = dialog.get_values()
+            selected_filtering, ecg_column, pulse_column, reduced_rate_detection, other_leads = dialog.get_values()
             if ecg_column < 1 or pulse_column < 1:
                 raise ValueError("Invalid column selection.")
+            self.lead_columns = [ecg_column] + multilead.parse_columns(other_leads, self.file_width, exclude=(ecg_column, pulse_column))
             self.selected_filtering = selected_filtering
             self.ecg_column = ecg_column
             self.pulse_column = pulse_column
+            self.reduced_rate_detection = reduced_rate_detection
             self.overlay_toggle_button.setEnabled(True)
             if self.selected_filtering:
                 self.overlay_toggle_button.setText("Overlay Original Signal")
@@ -122,7 +137,8 @@ def pulse_settings_pane(self):
         
             self.scrollable_window.canvas.figure.suptitle(self.title)
             self.scrollable_window.canvas.draw()
-            run_data_analysis(self)
+            if self.load_file_data():
+                run_data_analysis(self)
         except ValueError:
             QMessageBox.warning(self, "Invalid Input", "Please enter valid numbers for the sr, ecg column and pulse column.")
             pulse_settings_pane(self)
@@ -136,67 +152,97 @@ def pulse_settings_pane(self):
 def run_data_analysis(self):
     """
     Perform data analysis on the selected file data by applying filters, 
-    dividing by chunks and finding r_peaks.
+    dividing by chunks and finding r_peaks. The segments, R-peaks and SNR are
+    loaded from the analysis cache when the same data has been analysed with the same settings,
+    and any saved manual edits are applied to the R-peaks.
     
     This function operates on the MainWindow class. It prepares raw and filtered 
-    time series from the file data, divides the pulse time series into segments,
+    time series from the file data, reduces the pulse channel to its edges and divides it into segments,
     detects R-peaks in the time series, and handles the results of data analysis.
 
     Args:
         self (MainWindow instance): A reference to the MainWindow object.
 
     Side effects:
-        Modifies raw_timeseries, filtered_timeseries, pulse_timeseries, segments,
-        num_segments, r_peaks_list, snr, and primary_timeseries attributes of the MainWindow instance.
+        Modifies raw_timeseries, filtered_timeseries, pulse_edges, segments,
+        num_segments, r_peaks_list, snr, signal quality and primary_timeseries attributes of the MainWindow instance.
         Calls chunk_from_segment and handle_data_analysis_result methods.
     """
-    self.raw_timeseries = np.column_stack((self.file_data[:,0], self.file_data[:,self.ecg_column]))
-    self.filtered_timeseries = p.filter(self.raw_timeseries,self.sr) 
-    self.pulse_timeseries = self.file_data[:,self.pulse_column]
-    self.segments = p.divide_by_chunks(self.pulse_timeseries,self.sr)
-    self.num_segments = len(self.segments)
-    
-    if self.selected_filtering: 
-        self.r_peaks_list = p.find_r_peaks(self.filtered_timeseries, self.sr)
-        self.snr = p.signal_to_noise(self.filtered_timeseries,self.raw_timeseries)
-        self.primary_timeseries = self.filtered_timeseries
-    else:    
-        self.r_peaks_list = p.find_r_peaks(self.raw_timeseries, self.sr)       
-        self.snr = "N/A"
-        self.primary_timeseries = self.raw_timeseries
+    with instrumentation.stage("pulse analysis", samples=len(self.file_data)) as stage:
+        self.raw_timeseries = np.column_stack((self.file_data[:,0], self.file_data[:,self.ecg_column]))
+        if len(self.lead_columns) > 1:
+            leads = self.file_data[:,self.lead_columns]
+            filtered_leads = multilead.filter_leads(leads, self.sr)
+            self.filtered_timeseries = np.column_stack((self.file_data[:,0], filtered_leads[:,0]))
+            self.leads = filtered_leads if self.selected_filtering else leads
+        else:
+            self.filtered_timeseries = p.filter(self.raw_timeseries,self.sr) 
+            self.leads = None
+        self.primary_timeseries = self.filtered_timeseries if self.selected_filtering else self.raw_timeseries
+
+        other_leads = [self.file_data[:,column] for column in self.lead_columns[1:]]
+        key, content_key = cache.analysis_keys([self.raw_timeseries[:,1], self.file_data[:,self.pulse_column], *other_leads], mode="pulse", sr=self.sr, filtering=self.selected_filtering,
+                                                reduced_rate=self.reduced_rate_detection, leads=self.lead_columns)
+        cached = cache.load(key)
+        if cached is not None:
+            self.segments = [tuple(segment) for segment in cached["segments"].tolist()]
+            self.pulse_edges = cached["pulse_edges"] if "pulse_edges" in cached else p.pulse_edges(self.file_data, self.pulse_column)
+            self.r_peaks_list = cached["r_peaks"]
+            signal_energy, noise_energy = cached["signal_energy"], cached["noise_energy"]
+            self.lead_peaks = multilead.unpack(cached["lead_peaks"], len(self.lead_columns)) if self.leads is not None else None
+        else:
+            # Only the edges of the pulse are kept, not a copy of the pulse channel
+            self.pulse_edges = p.pulse_edges(self.file_data, self.pulse_column)
+            self.segments = p.segments_from_edges(self.pulse_edges, len(self.file_data), self.sr)
+            self.lead_peaks = None
+            if self.leads is not None:
+                self.r_peaks_list, self.lead_peaks = multilead.find_r_peaks(self.file_data[:,0], self.leads, self.sr, reduced_rate=self.reduced_rate_detection)
+            elif self.reduced_rate_detection:
+                self.r_peaks_list = p.find_r_peaks_multirate(self.primary_timeseries, self.sr)
+            else:
+                self.r_peaks_list = p.find_r_peaks(self.primary_timeseries, self.sr)
+            signal_energy, noise_energy = sq.window_energies(self.raw_timeseries[:,1], self.filtered_timeseries[:,1], int(self.sr*sq.WINDOW_SECONDS))
+            lead_arrays = {"lead_peaks": multilead.pack(self.lead_peaks)} if self.leads is not None else {}
+            cache.store(key, segments=np.array(self.segments, dtype=np.int64).reshape(-1, 2), pulse_edges=self.pulse_edges, r_peaks=self.r_peaks_list,
+                        signal_energy=signal_energy, noise_energy=noise_energy, **lead_arrays)
+        self.num_segments = len(self.segments)
+        self.set_quality_track(signal_energy, noise_energy)
+        self.session = session.Session(content_key)
+        self.r_peaks_list = self.session.restore(self.r_peaks_list)
+        self.segment_stats = None
+        self.interval_index = None
+        self.rr_histogram = None
+        stage.count(peaks=len(self.r_peaks_list), segments=self.num_segments)
     chunk_from_segment(self)
     self.handle_data_analysis_result()
+    self.add_recording()
         
 def chunk_from_segment(self):
     """
     Filters a segment of the filtered and raw time series and sets the current chunk to this segment.
 
     This function operates on the MainWindow class. It extracts a segment from the 
-    filtered and raw time series and sets this as the current chunk. It also filters 
-    the R-peaks list based on the time values in the current chunk. Updates the title 
+    filtered and raw time series and sets this as the current chunk. It also selects 
+    the R-peaks whose samples are in the segment. Updates the title 
     of the plot to show the start and end times of the current chunk.
 
     Args:
         self (MainWindow instance): A reference to the MainWindow object.
 
     Side effects:
-        Modifies curr_filtered_chunk, curr_raw_chunk, curr_primary_chunk,
+        Modifies curr_filtered_chunk, curr_raw_chunk, curr_primary_chunk, curr_chunk_start and
         curr_r_peaks_chunk of the MainWindow instance. Updates the figure title in the 
         scrollable window canvas.
     """
-    segment = self.segments[self.curr_segment_idx]
-    self.curr_filtered_chunk = self.filtered_timeseries[segment[0]:segment[1]]
-    self.curr_raw_chunk = self.raw_timeseries[segment[0]:segment[1]]
-
-    self.curr_primary_chunk = self.curr_filtered_chunk if self.selected_filtering else self.curr_raw_chunk
-
-    min_time = self.curr_primary_chunk[0, 0]
-    max_time = self.curr_primary_chunk[-1, 0]
-
-    # Filter rows from self.r_peaks_list based on time values in the curr_primary_chunk
-    time_filter = (self.r_peaks_list[:, 0] >= min_time) & (self.r_peaks_list[:, 0] <= max_time)
-
-    self.curr_r_peaks_chunk = self.r_peaks_list[time_filter]
+    with instrumentation.stage("chunk from segment") as stage:
+        segment = self.segments[self.curr_segment_idx]
+        self.curr_filtered_chunk = self.filtered_timeseries[segment[0]:segment[1]]
+        self.curr_raw_chunk = self.raw_timeseries[segment[0]:segment[1]]
+
+        self.curr_primary_chunk = self.curr_filtered_chunk if self.selected_filtering else self.curr_raw_chunk
+        self.curr_chunk_start = segment[0]
+        self.curr_r_peaks_chunk = p.peak_range(self.r_peaks_list, segment[0], segment[1])
+        stage.count(samples=len(self.curr_primary_chunk), peaks=len(self.curr_r_peaks_chunk))
 
     minutes1, seconds1 = divmod(self.curr_primary_chunk[0, 0], 60)
     minutes2, seconds2 = divmod(self.curr_primary_chunk[-1, 0], 60)
@@ -0,0 +1,210 @@
+"""
+Local analysis service with a warm pool of worker processes.
+
+Scripts which need the R-peaks of a recording can send it to this service with service_client.py
+instead of starting Python and importing the analysis themselves. The workers import processor,
+pandas and SciPy and run a small analysis when the service starts, so a request only costs the
+analysis itself. Every request is answered in one of three ways:
+
+- cached: the analysis of the file with the same settings is in the analysis cache (see cache.py),
+  found by the path, size and modification time of the file without reading it.
+- batched: the same file is already being analysed with the same settings for another request, so
+  the request waits for that analysis instead of starting another.
+- analysed: the file is analysed by pipeline.run_analysis on a free worker.
+
+The service listens at ECG_SERVICE_ADDRESS, as in service_client.py. Usage:
+    python service.py --workers 4
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+import numpy as np
+import cache
+import processor as p
+import pipeline
+import service_client
+
+WARM_UP_SECONDS = 2
+
+
+def _warm_up():
+    """
+    Runs in every worker when it starts, so the first analysis in it does not pay for loading the
+    libraries and preparing the filter.
+    """
+    sr = 1000
+    times = np.arange(WARM_UP_SECONDS*sr) / sr
+    volts = np.sin(2*np.pi*times)**15
+    p.parse_lines(b"0\t1\n", 2)
+    p.find_r_peaks(np.column_stack((times, pipeline.band_pass(volts, sr))), sr)
+
+
+def _ready():
+    return os.getpid()
+
+
+def results(r_peaks_list, segments, sr):
+    """
+    Arranges an analysis as the arrays returned to clients. As in exporter.bulk_export, only the R Peaks
+    in a segment are returned, and R-R intervals are only calculated between peaks in the same segment.
+
+    Returns:
+        dict: The arrays described in service_client.Client.analyse
+    """
+    segment_ids = p.label_segments(r_peaks_list, segments)
+    keep = segment_ids >= 0
+    samples, segment_ids = np.asarray(r_peaks_list)[keep].astype(np.int64), segment_ids[keep]
+    same_segment = segment_ids[1:] == segment_ids[:-1]
+    return {"r_peaks": samples, "peak_segment": segment_ids + 1,
+            "segments": np.asarray(segments, dtype=np.int64).reshape(-1, 2),
+            "interval": np.diff(samples * (1/sr))[same_segment],
+            "interval_segment": segment_ids[1:][same_segment] + 1,
+            "interval_sample": samples[1:][same_segment]}
+
+
+def analyse(file_path, sr, ecg_column=1, pulse_column=None, filtering=False):
+    """
+    Analyses a recording in a worker.
+    """
+    r_peaks_list, segments, _ = pipeline.run_analysis(file_path, sr, ecg_column, pulse_column, filtering, concurrent=False)
+    return results(r_peaks_list, segments, sr)
+
+
+class AnalysisService:
+    """
+    This class runs analyses on a pool of warm worker processes, answering from the analysis cache and
+    batching requests for an analysis which is already running.
+
+    Args:
+        workers (int, optional): The number of worker processes. Defaults to None, one per CPU.
+    """
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=_warm_up)
+        self.lock = threading.Lock()
+        self.running = {}
+        self.counts = {"analysed": 0, "batched": 0, "cached": 0}
+        # Submitting a job to each worker starts them all now rather than at the first requests
+        for future in [self.pool.submit(_ready) for _ in range(self.workers)]:
+            future.result()
+
+    def submit(self, file_path, sr, ecg_column=1, pulse_column=None, filtering=False):
+        """
+        Starts or joins the analysis of a recording, or finds it in the cache.
+
+        Returns:
+            concurrent.futures.Future: The future of the arrays of results
+            str: "analysed", "batched" or "cached"
+        """
+        params = {"sr": sr, "ecg_column": ecg_column, "pulse_column": pulse_column, "filtering": filtering}
+        key = cache.file_key(file_path, mode="service", **params)
+        cached = cache.load(key)
+        started = False
+        with self.lock:
+            if cached is not None:
+                future, status = concurrent.futures.Future(), "cached"
+                future.set_result(cached)
+            elif key in self.running:
+                future, status = self.running[key], "batched"
+            else:
+                future, status = self.pool.submit(analyse, file_path, **params), "analysed"
+                self.running[key] = future
+                started = True
+            self.counts[status] += 1
+        if started:
+            # Added outside the lock, as the callback runs at once if the analysis has already finished
+            future.add_done_callback(lambda future: self._finished(key, future))
+        return future, status
+
+    def _finished(self, key, future):
+        # Stored before the analysis stops being running, so later requests find it in one or the other
+        if future.exception() is None:
+            cache.store(key, **future.result())
+        with self.lock:
+            self.running.pop(key, None)
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                future, status = self.server.service.submit(**json.loads(line))
+                response = {name: array.tolist() for name, array in future.result().items()}
+                response["status"] = status
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socket, "AF_UNIX"):
+    class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def create_server(service, address=None):
+    """
+    Creates the server which answers client connections with a service, each on its own thread.
+    Start it with serve_forever().
+
+    Args:
+        service (AnalysisService): The service which runs the analyses
+        address (str, optional): The address to listen at, as in service_client. Defaults to None, service_client.service_address.
+
+    Returns:
+        socketserver.BaseServer: The server, with the address clients connect to as its address attribute
+    """
+    family, server_address = service_client.parse_address(address or service_client.service_address)
+    if family == socket.AF_INET:
+        server = _TCPServer(server_address, _Handler)
+        host, port = server.server_address[:2]
+        server.address = f"{host}:{port}"
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(server_address)), exist_ok=True)
+        # A socket file left by a service which did not stop cleanly
+        if os.path.exists(server_address):
+            os.remove(server_address)
+        server = _UnixServer(server_address, _Handler)
+        server.address = server_address
+    server.service = service
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer analysis requests from service_client.py with a warm pool of workers.")
+    parser.add_argument("--address", default=None, help="a Unix socket path or host:port. Defaults to ECG_SERVICE_ADDRESS")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes. Defaults to one per CPU")
+    args = parser.parse_args()
+
+    # Stopping the service with SIGTERM shuts the workers down as Ctrl+C does, rather than leaving them running
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    service = AnalysisService(args.workers)
+    server = create_server(service, args.address)
+    print(f"Listening at {server.address} with {service.workers} workers", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        print(", ".join(f"{count} {status}" for status, count in service.counts.items()))
+        if server.socket.family != socket.AF_INET:
+            os.remove(server.address)
+
+
+if __name__ == "__main__":
+    main()
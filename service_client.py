@@ -0,0 +1,114 @@
+"""
+Client of the local analysis service in service.py.
+
+It only imports the standard library, so a script which uses it starts without importing NumPy,
+pandas or SciPy. The service is reached at ECG_SERVICE_ADDRESS, which is the path of a Unix socket
+or host:port for a TCP port on this computer, and is ~/.ecg_rr_detector/service.sock by default.
+Requests and responses are JSON objects, one per line.
+
+    import service_client
+    result = service_client.analyse("recording.txt", sr=1000, pulse_column=4)
+    result["r_peaks"], result["segments"], result["interval"]
+"""
+import json
+import os
+import socket
+
+DEFAULT_ADDRESS = (os.path.join(os.path.expanduser("~"), ".ecg_rr_detector", "service.sock")
+                   if hasattr(socket, "AF_UNIX") else "127.0.0.1:8765")
+
+service_address = os.environ.get("ECG_SERVICE_ADDRESS", DEFAULT_ADDRESS)
+
+
+class ServiceError(RuntimeError):
+    """
+    Raised when the service could not analyse a recording.
+    """
+
+
+def parse_address(address):
+    """
+    Splits an address into its socket family and the address passed to the socket. An address ending
+    in a colon and a port number is a TCP address, anything else is the path of a Unix socket.
+
+    Returns:
+        int: socket.AF_INET or socket.AF_UNIX
+        tuple or str: (host, port), or the path of the socket
+    """
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+class Client:
+    """
+    This class is a connection to the analysis service, which can be used for any number of requests.
+
+    Args:
+        address (str, optional): The address of the service. Defaults to None, service_address.
+        timeout (float, optional): Seconds to wait for a response, or None to wait as long as the analysis takes. Defaults to None.
+    """
+    def __init__(self, address=None, timeout=None):
+        family, address = parse_address(address or service_address)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        try:
+            self.socket.connect(address)
+        except OSError:
+            self.socket.close()
+            raise
+        self.file = self.socket.makefile("rwb")
+
+    def analyse(self, file_path, sr, ecg_column=1, pulse_column=None, filtering=False):
+        """
+        Detects the R Peaks of a recording and divides it into segments, as pipeline.py does.
+
+        Args:
+            file_path (str): The path to the recording, which the service must be able to read
+            sr (int): The sampling rate of the data
+            ecg_column (int, optional): The column with the ECG data. Defaults to 1.
+            pulse_column (int, optional): The column with the pulse, or None to analyse the whole recording. Defaults to None.
+            filtering (bool, optional): Whether to detect the R Peaks in the filtered signal. Defaults to False.
+
+        Raises:
+            ServiceError: If the service could not analyse the recording.
+
+        Returns:
+            dict: The sample indices of the R Peaks in a segment (r_peaks) and the segment of each (peak_segment),
+            the (start, end) samples of each segment (segments), the R-R intervals in seconds between peaks in the
+            same segment (interval) with the segment (interval_segment) and sample (interval_sample) of the peak
+            ending each, and how the request was answered (status): "analysed", "batched" with a running analysis
+            of the same file, or "cached"
+        """
+        return self.request({"file_path": os.path.abspath(file_path), "sr": sr, "ecg_column": ecg_column,
+                             "pulse_column": pulse_column, "filtering": filtering})
+
+    def request(self, request):
+        self.file.write(json.dumps(request).encode() + b"\n")
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("The analysis service closed the connection.")
+        response = json.loads(line)
+        if "error" in response:
+            raise ServiceError(response["error"])
+        return response
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def analyse(file_path, sr, address=None, **params):
+    """
+    Analyses one recording with a new connection to the service, as in Client.analyse.
+    """
+    with Client(address) as client:
+        return client.analyse(file_path, sr, **params)
@@ -0,0 +1,170 @@
+"""
+Per-recording store of manual R-peak edits.
+
+Every add or remove click is appended to a binary journal as soon as it is made. Each
+edited segment is also periodically snapshotted as a whole array, together with the length
+of the journal at that point, so reopening a recording only needs to load the snapshots and
+replay the few journal records made after them, without re-running detection.
+
+Sessions are kept in ~/.ecg_rr_detector/sessions/<content key> unless ECG_SESSION_DIR is
+set. Setting ECG_SESSION_DIR to an empty string keeps edits in memory only. The content key
+(from cache.analysis_keys) depends only on the recording and the analysis settings, not on the
+cache version or the defaults of the detector, so edits survive changes to either.
+"""
+import glob
+import os
+import numpy as np
+import processor as p
+
+SNAPSHOT_EVERY = 50
+
+ADD = 1
+REMOVE = -1
+
+JOURNAL_DTYPE = np.dtype([('op', 'i1'), ('sample', '<i8')])
+
+session_root = os.environ.get("ECG_SESSION_DIR", os.path.join(os.path.expanduser("~"), ".ecg_rr_detector", "sessions"))
+
+
+class Session:
+    """
+    This class holds the edit journal and segment snapshots of one analysed recording.
+
+    Args:
+        key (str): The content key of the recording, from cache.analysis_keys
+    """
+    def __init__(self, key):
+        self.path = os.path.join(session_root, key) if session_root else None
+        self.journal_length = 0
+        self.unsnapshotted = {}  # (start, end) samples of a segment -> edits since its last snapshot
+        if self.path:
+            try:
+                os.makedirs(self.path, exist_ok=True)
+            except OSError:
+                self.path = None
+
+    def _journal_path(self):
+        return os.path.join(self.path, "journal.bin")
+
+    def _snapshot_path(self, start, end):
+        return os.path.join(self.path, f"snapshot_{start}_{end}.npz")
+
+    def restore(self, r_peaks_list):
+        """
+        Applies the saved snapshots and the journal records made after them to the detected R-peaks.
+
+        Args:
+            r_peaks_list (np.array): The sorted sample indices of the R Peaks found by the detector
+
+        Returns:
+            np.array: The R Peaks including every saved manual edit
+        """
+        if not self.path:
+            return r_peaks_list
+        snapshots = []
+        for snapshot_path in glob.glob(os.path.join(self.path, "snapshot_*.npz")):
+            try:
+                with np.load(snapshot_path) as snapshot:
+                    snapshots.append((int(snapshot["journal_position"]), int(snapshot["start"]), int(snapshot["end"]), snapshot["peaks"]))
+            except (OSError, ValueError, KeyError):
+                continue
+        # Later snapshots take precedence where the segments of earlier ones overlap them
+        snapshots.sort(key=lambda snapshot: snapshot[0])
+        for _, start, end, peaks in snapshots:
+            r_peaks_list = p.replace_r_peaks(r_peaks_list, start, end, peaks)
+
+        journal_path = self._journal_path()
+        if not os.path.exists(journal_path):
+            return r_peaks_list
+        size = os.path.getsize(journal_path)
+        journal = np.fromfile(journal_path, dtype=JOURNAL_DTYPE, count=size // JOURNAL_DTYPE.itemsize)
+        self.journal_length = len(journal)
+
+        # A record is already part of a snapshot if it was made before a snapshot of its segment
+        covered = np.zeros(len(journal), dtype=np.int64)
+        for position, start, end, _ in snapshots:
+            in_segment = (journal['sample'] >= start) & (journal['sample'] < end)
+            covered[in_segment] = np.maximum(covered[in_segment], position)
+        pending = journal[np.arange(len(journal)) >= covered]
+        for record in pending:
+            idx = np.searchsorted(r_peaks_list, record['sample'])
+            present = idx < len(r_peaks_list) and r_peaks_list[idx] == record['sample']
+            if record['op'] == ADD and not present:
+                r_peaks_list = np.insert(r_peaks_list, idx, record['sample'])
+            elif record['op'] == REMOVE and present:
+                r_peaks_list = np.delete(r_peaks_list, idx)
+        return r_peaks_list
+
+    def record(self, op, sample, start, end):
+        """
+        Appends an edit to the journal.
+
+        Args:
+            op (int): session.ADD or session.REMOVE
+            sample (int): The sample index of the added or removed R Peak
+            start (int): The first sample of the segment the edit was made in
+            end (int): The sample after the end of the segment the edit was made in
+        """
+        segment = (start, end)
+        self.unsnapshotted[segment] = self.unsnapshotted.get(segment, 0) + 1
+        if not self.path:
+            return
+        entry = np.array([(op, sample)], dtype=JOURNAL_DTYPE)
+        try:
+            with open(self._journal_path(), "ab") as f:
+                f.write(entry.tobytes())
+            self.journal_length += 1
+        except OSError:
+            pass
+
+    def record_span(self, removed, added, start, end):
+        """
+        Appends the R-peaks removed and added by re-detecting part of a segment to the journal in one write.
+
+        Args:
+            removed (np.array): The sample indices of the removed R Peaks
+            added (np.array): The sample indices of the added R Peaks
+            start (int): The first sample of the segment the edits were made in
+            end (int): The sample after the end of the segment the edits were made in
+        """
+        entries = np.empty(len(removed) + len(added), dtype=JOURNAL_DTYPE)
+        entries['op'] = np.concatenate((np.full(len(removed), REMOVE), np.full(len(added), ADD)))
+        entries['sample'] = np.concatenate((removed, added))
+        if len(entries) == 0:
+            return
+        segment = (start, end)
+        self.unsnapshotted[segment] = self.unsnapshotted.get(segment, 0) + len(entries)
+        if not self.path:
+            return
+        try:
+            with open(self._journal_path(), "ab") as f:
+                f.write(entries.tobytes())
+            self.journal_length += len(entries)
+        except OSError:
+            pass
+
+    def snapshot(self, r_peaks_list, only_due=False):
+        """
+        Saves the R-peaks of edited segments as snapshots, so their journal records do not need replaying.
+
+        Args:
+            r_peaks_list (np.array): The sorted sample indices of the R Peaks including every edit
+            only_due (bool, optional): Only snapshot segments with at least SNAPSHOT_EVERY edits 
+            since their last snapshot. Defaults to False.
+        """
+        for segment, edits in list(self.unsnapshotted.items()):
+            if only_due and edits < SNAPSHOT_EVERY:
+                continue
+            del self.unsnapshotted[segment]
+            if not self.path:
+                continue
+            start, end = segment
+            snapshot_path = self._snapshot_path(start, end)
+            tmp_path = f"{snapshot_path}.tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    np.savez(f, start=start, end=end, peaks=p.peak_range(r_peaks_list, start, end),
+                             journal_position=self.journal_length)
+                os.replace(tmp_path, snapshot_path)
+            except OSError:
+                pass
@@ -0,0 +1,104 @@
+"""
+Windowed signal quality of a whole recording.
+
+The recording is split into fixed windows and the energy of the filtered signal and of the
+noise (the difference between the raw and filtered signals) is summed in each one with a
+single reshaped reduction. The windowed SNR is the quality track shown under the waveform,
+and the SNR of any range, such as a segment or the whole file, is calculated from the window
+energies plus the partial windows at its edges instead of from the full signals again. Only
+the voltage columns are used.
+"""
+import numpy as np
+import instrumentation
+
+WINDOW_SECONDS = 2
+NOISY_BELOW_MEDIAN_DB = 6
+
+
+def window_energies(raw_signal, filtered_signal, window):
+    """
+    Sums the signal and noise energy of every window of the recording.
+
+    Args:
+        raw_signal (np.array): The voltages of the raw signal
+        filtered_signal (np.array): The voltages of the filtered signal
+        window (int): The number of samples in each window. The last window may be shorter.
+
+    Returns:
+        np.array: The energy of the filtered signal in each window
+        np.array: The energy of the noise in each window
+    """
+    with instrumentation.stage("signal quality", samples=len(raw_signal)):
+        num_windows = -(-len(raw_signal) // window)
+        signal_energy = np.zeros(num_windows)
+        noise_energy = np.zeros(num_windows)
+        full = len(raw_signal) // window
+        # Reduce blocks of whole windows at a time to bound the size of the temporary noise array
+        block = max(1, 2**22 // window)
+        for start in range(0, full, block):
+            stop = min(full, start + block)
+            filtered = filtered_signal[start*window:stop*window].reshape(-1, window)
+            noise = raw_signal[start*window:stop*window].reshape(-1, window) - filtered
+            signal_energy[start:stop] = np.einsum('ij,ij->i', filtered, filtered)
+            noise_energy[start:stop] = np.einsum('ij,ij->i', noise, noise)
+        if full < num_windows:
+            filtered = filtered_signal[full*window:]
+            noise = raw_signal[full*window:] - filtered
+            signal_energy[full] = filtered @ filtered
+            noise_energy[full] = noise @ noise
+    return signal_energy, noise_energy
+
+
+def snr_db(signal_energy, noise_energy):
+    """
+    Converts energies to a signal-to-noise ratio in decibels. Works on scalars and arrays.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(noise_energy > 0, 10 * np.log10(signal_energy / noise_energy), np.inf)
+
+
+def range_snr(signal_energy, noise_energy, window, raw_signal, filtered_signal, start, end):
+    """
+    Calculates the signal-to-noise ratio between two samples from the window energies, only
+    reading the samples of the partial windows at either end.
+
+    Args:
+        signal_energy (np.array): The window signal energies from window_energies
+        noise_energy (np.array): The window noise energies from window_energies
+        window (int): The number of samples in each window
+        raw_signal (np.array): The voltages of the raw signal
+        filtered_signal (np.array): The voltages of the filtered signal
+        start (int): The first sample of the range
+        end (int): The sample after the end of the range
+
+    Returns:
+        float: The signal-to-noise ratio of the range in decibels
+    """
+    first_full = -(-start // window)
+    last_full = end // window
+    if first_full >= last_full:
+        edges = [(start, end)]
+        signal, noise = 0.0, 0.0
+    else:
+        edges = [(start, first_full*window), (last_full*window, end)]
+        signal = signal_energy[first_full:last_full].sum()
+        noise = noise_energy[first_full:last_full].sum()
+    for a, b in edges:
+        filtered = filtered_signal[a:b]
+        difference = raw_signal[a:b] - filtered
+        signal += filtered @ filtered
+        noise += difference @ difference
+    return float(snr_db(signal, noise))
+
+
+def noisy_windows(window_snr, below_median_db=NOISY_BELOW_MEDIAN_DB):
+    """
+    Finds the windows whose SNR is more than below_median_db decibels below the median window.
+
+    Returns:
+        np.array: The sorted indices of the noisy windows
+    """
+    finite = window_snr[np.isfinite(window_snr)]
+    if len(finite) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.flatnonzero(window_snr < np.median(finite) - below_median_db)
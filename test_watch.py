@@ -0,0 +1,75 @@
+"""
+Regression tests for watch.py: a recording analysed as it grows gives the same R Peaks and segments as the whole file.
+
+    python -m pytest test_watch.py
+"""
+import os
+import numpy as np
+import benchmark
+import pipeline
+import watch
+
+SR = 1000
+
+
+def write_recording(path, data):
+    np.savetxt(path, data, fmt="%.6f", delimiter="\t", header="Time\tECG\tPulse", comments="")
+
+
+def watch_growing(tmp_path, source, **settings):
+    """
+    Appends the source to a watched file in chunks of random sizes, polling after each, and returns its analysis.
+    """
+    contents = source.read_bytes()
+    folder = tmp_path / "watched"
+    folder.mkdir()
+    growing = folder / "recording.txt"
+    growing.write_bytes(b"")
+    watcher = watch.Watcher(str(folder), sr=SR, **settings)
+    rng = np.random.default_rng(0)
+    try:
+        position = 0
+        while position < len(contents):
+            size = int(rng.integers(1000, 200000))
+            with open(growing, "ab") as f:
+                f.write(contents[position:position + size])
+            position += size
+            watcher.poll()
+        watcher.poll(final=True)
+        return watcher.recordings[os.path.join(str(folder), "recording.txt")]
+    finally:
+        watcher.close()
+
+
+def test_growing_recording_matches_whole_file(tmp_path):
+    data = benchmark.synthetic_recording(3, SR)
+    data[:, 1] = pipeline.band_pass(data[:, 1], SR)
+    source = tmp_path / "source.txt"
+    write_recording(source, data)
+
+    analysis = watch_growing(tmp_path, source)
+    r_peaks_list, segments, _ = pipeline.run_analysis(str(source), SR, 1, concurrent=False)
+    assert analysis.rows == len(data)
+    np.testing.assert_array_equal(analysis.r_peaks_list, r_peaks_list)
+    assert analysis.segments == segments
+
+
+def test_growing_recording_with_pulse_matches_whole_file(tmp_path):
+    source = tmp_path / "source.txt"
+    write_recording(source, benchmark.synthetic_recording(3, SR))
+
+    analysis = watch_growing(tmp_path, source, pulse_column=2)
+    r_peaks_list, segments, _ = pipeline.run_analysis(str(source), SR, 1, 2, concurrent=False)
+    np.testing.assert_array_equal(analysis.r_peaks_list, r_peaks_list)
+    assert analysis.segments == segments
+
+
+def test_growing_recording_with_filtering_is_within_a_sample(tmp_path):
+    source = tmp_path / "source.txt"
+    write_recording(source, benchmark.synthetic_recording(3, SR))
+
+    analysis = watch_growing(tmp_path, source, pulse_column=2, filtering=True)
+    r_peaks_list, segments, _ = pipeline.run_analysis(str(source), SR, 1, 2, True, concurrent=False)
+    assert len(analysis.r_peaks_list) == len(r_peaks_list)
+    assert np.abs(analysis.r_peaks_list - r_peaks_list.astype(np.int64)).max() <= 1
+    assert analysis.segments == segments
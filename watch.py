@@ -0,0 +1,410 @@
+"""
+Analysis of recordings which are still being written, by watching a folder.
+
+A Watcher polls a folder for new or growing text exports. Each recording is analysed by an
+IncrementalAnalysis, which parses only the bytes appended since the last poll (a partly written
+last line is kept until the rest of it arrives), and extends the analysis with the state carried
+over from the previous poll, like the stages of pipeline.py carry state from block to block:
+
+- Filtering: each sample is filtered together with margin_seconds of signal either side of it, as
+  in pipeline.filter_blocks, once that much signal after it has arrived.
+- Detection: the one second chunks of processor.find_r_peaks are searched as soon as the signal
+  covers them. The R-peaks of the last revise_seconds are merged again at every poll, so the peaks
+  near the end of the recording can still be revised as more of it arrives; earlier peaks are final.
+  As in processor.merge_r_peaks, close peaks are filtered with a threshold from the intervals between
+  all of the candidates, which are totalled as they are found, and missed peaks are searched for in
+  the gaps between the filtered peaks, compared with the intervals either side of them.
+- Segments: the pulse is reduced to its edges a block at a time with processor.block_edges. A new
+  maximum of the pulse raises the threshold, so the edges are then found again from the pulse,
+  which is spilled to a temporary file as in pipeline.run_analysis.
+
+The cost of a poll therefore depends on the data appended since the last one rather than on the
+size of the file, apart from a new pulse maximum. The R-peaks are those of the whole file, except
+that the peaks which became final before the file was complete were filtered with the threshold of
+the intervals found until then, and that they can be a sample apart when filtering, as in pipeline.py.
+
+Usage:
+    python watch.py folder --sr 1000 --ecg-column 1 --pulse-column 4 --filter --out results/
+"""
+import argparse
+import inspect
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import processor as p
+import pipeline
+import exporter
+import instrumentation
+
+WATCHED_SUFFIXES = (".txt", ".rtf")
+READ_BYTES = 64 * 2**20
+REVISE_SECONDS = 30
+POLL_SECONDS = 2
+EXPORT_SECONDS = 30
+GAP_NEIGHBOURS = inspect.signature(p.find_missed_r_peaks).parameters["neighbours"].default
+
+
+class GrowingArray:
+    """
+    This class is an array of rows which is appended to. Its capacity is doubled when it is full,
+    so appending costs time in proportion to the rows appended.
+    """
+    def __init__(self, columns, dtype=float):
+        self.buffer = np.empty((1024, columns), dtype=dtype)
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, rows):
+        needed = self.length + len(rows)
+        if needed > len(self.buffer):
+            buffer = np.empty((max(needed, 2*len(self.buffer)), self.buffer.shape[1]), dtype=self.buffer.dtype)
+            buffer[:self.length] = self.buffer[:self.length]
+            self.buffer = buffer
+        self.buffer[self.length:needed] = rows
+        self.length = needed
+
+    @property
+    def array(self):
+        return self.buffer[:self.length]
+
+
+class IncrementalAnalysis:
+    """
+    This class analyses a recording which is still being written, one update at a time.
+
+    Args:
+        file_path (str): The path to the recording
+        sr (int): The sampling rate of the data
+        ecg_column (int, optional): The column with the ECG data, numbered as in processor.file_opener. Defaults to 1.
+        pulse_column (int, optional): The column with the pulse, or None to analyse the whole recording. Defaults to None.
+        filtering (bool, optional): Whether to detect the R Peaks in the filtered signal. Defaults to False.
+        margin_seconds (float, optional): The signal either side of a sample it is filtered with. Defaults to pipeline.FILTER_MARGIN_SECONDS.
+        revise_seconds (float, optional): How far before the last searched chunk R Peaks can still be revised. Defaults to REVISE_SECONDS.
+        spill_directory (str, optional): The folder the pulse is spilled to. Defaults to None, a new temporary folder.
+    """
+    def __init__(self, file_path, sr, ecg_column=1, pulse_column=None, filtering=False,
+                 margin_seconds=pipeline.FILTER_MARGIN_SECONDS, revise_seconds=REVISE_SECONDS, spill_directory=None):
+        self.file_path = file_path
+        self.sr = sr
+        self.ecg_column = ecg_column
+        self.pulse_column = pulse_column
+        self.filtering = filtering
+        self.margin = int(margin_seconds * sr)
+        self.revise_samples = int(revise_seconds * sr)
+        self.sample_length = int(sr)
+        self.step_length = int(sr * 0.5)
+        spill_directory = spill_directory or tempfile.mkdtemp(prefix="ecg_watch_")
+        self.pulse_path = os.path.join(spill_directory, f"{os.path.basename(file_path)}.pulse.bin")
+        self.pulse_file = None
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets everything read from the file, so it is analysed again from the start.
+        """
+        self.offset = 0
+        self.carry = b""
+        self.num_columns = None
+        self.rows = 0
+        self.num_nan_values = 0
+        self.finished = False
+        self.primary = GrowingArray(2)
+        self.raw_tail = np.empty(0)
+        self.raw_tail_start = 0
+        self.candidates = np.empty(0, dtype=np.int64)
+        self.next_chunk = 0
+        self.last_counted = None
+        self.interval_count = 0
+        self.interval_sum = 0.0
+        self.interval_squares = 0.0
+        self.filtered_peaks = np.empty(0, dtype=np.int64)
+        self.missed_peaks = np.empty(0, dtype=np.int64)
+        self.gaps_from = 0
+        self.r_peaks_list = np.empty(0, dtype=np.int64)
+        self.pulse_edges = np.empty(0, dtype=p.EDGE_DTYPE)
+        self.pulse_level = 0
+        self.max_pulse = -np.inf
+        self.segments = []
+        if self.pulse_file is not None:
+            self.pulse_file.close()
+        self.pulse_file = open(self.pulse_path, "wb") if self.pulse_column is not None else None
+
+    @property
+    def timeseries(self):
+        """
+        The times and voltages of the signal the R Peaks are detected in, which lags the rows read by
+        the filter margin when filtering.
+        """
+        return self.primary.array
+
+    def update(self, final=False):
+        """
+        Reads and analyses the rows appended to the file since the last update. The file is analysed
+        again from the start if it has become shorter, as it has then been replaced.
+
+        Args:
+            final (bool, optional): Whether the file is complete, so the last line, the end of the filter
+            and the last chunks are analysed too. The recording is not updated after this. Defaults to False.
+
+        Returns:
+            int: The number of rows read
+        """
+        if self.finished:
+            return 0
+        if os.path.getsize(self.file_path) < self.offset:
+            self.reset()
+        with instrumentation.stage("watch update") as stage:
+            new_rows = 0
+            with open(self.file_path, 'rb') as f:
+                f.seek(self.offset)
+                while True:
+                    data = f.read(READ_BYTES)
+                    if not data:
+                        break
+                    self.offset += len(data)
+                    new_rows += self._add_bytes(data)
+            if final and self.carry.strip():
+                new_rows += self._add_bytes(b"\n")
+            if new_rows or final:
+                self._filter(final)
+                self._detect(final)
+                self._merge(final)
+                if self.pulse_column is None:
+                    self.segments = [(0, self.rows)] if self.rows else []
+                else:
+                    self.segments = p.segments_from_edges(self.pulse_edges, self.rows, self.sr)
+            self.finished = final
+            stage.count(samples=new_rows, peaks=len(self.r_peaks_list), segments=len(self.segments))
+        return new_rows
+
+    def close(self):
+        if self.pulse_file is not None:
+            self.pulse_file.close()
+            self.pulse_file = None
+
+    def _add_bytes(self, data):
+        body = self.carry + data
+        end = body.rfind(b"\n") + 1
+        body, self.carry = body[:end], body[end:]
+        if self.num_columns is None:
+            body = self._skip_header(body)
+        if self.num_columns is None or not body.strip():
+            return 0
+        values, num_nan_values = p.parse_lines(body, self.num_columns)
+        self.num_nan_values += num_nan_values
+        return self._add_rows(values)
+
+    def _skip_header(self, body):
+        # The header lines are skipped as in processor.file_opener
+        position = 0
+        while position < len(body):
+            end = body.index(b"\n", position) + 1
+            text = body[position:end].decode('iso-8859-1')
+            if text.strip() and all(c.isdigit() or c.isspace() or c == '.' or c == '-' for c in text.strip()):
+                self.num_columns = len(text.rstrip('\r\n').split('\t'))
+                return body[position:]
+            position = end
+        return b""
+
+    def _add_rows(self, values):
+        start, n = self.rows, len(values)
+        ecg = values[:, self.ecg_column - 1]
+        if self.filtering:
+            self.raw_tail = np.concatenate((self.raw_tail, ecg))
+        else:
+            self.primary.append(np.column_stack(((start + np.arange(n)) * (1/self.sr), ecg)))
+        if self.pulse_column is not None:
+            self._add_pulse(values[:, self.pulse_column - 1], start)
+        self.rows += n
+        return n
+
+    def _add_pulse(self, pulse, start):
+        self.pulse_file.write(np.ascontiguousarray(pulse, dtype=np.float64).tobytes())
+        block_max = pulse.max(initial=-np.inf)
+        if block_max > self.max_pulse:
+            # The threshold has risen, so the edges before this block can move
+            self.max_pulse = block_max
+            self.pulse_file.flush()
+            spilled = np.memmap(self.pulse_path, dtype=np.float64, mode='r', shape=(start + len(pulse), 1))
+            self.pulse_edges = p.pulse_edges(spilled, 0)
+            self.pulse_level = int(self.pulse_edges['level'][-1]) if len(self.pulse_edges) else 0
+            del spilled
+        else:
+            edges, self.pulse_level = p.block_edges(pulse, 0.9*self.max_pulse, self.pulse_level, start)
+            self.pulse_edges = np.concatenate((self.pulse_edges, edges))
+
+    def _filter(self, final):
+        if not self.filtering:
+            return
+        filtered = len(self.primary)
+        ready = self.rows if final else self.rows - self.margin
+        # Waiting for a margin of new samples keeps the signal filtered with each sample in proportion to the new samples
+        if ready - filtered < (1 if final else max(self.margin, 1)):
+            return
+        low, high = max(0, filtered - self.margin), min(self.rows, ready + self.margin)
+        volts = pipeline.band_pass(self.raw_tail[low - self.raw_tail_start:high - self.raw_tail_start], self.sr)
+        times = (filtered + np.arange(ready - filtered)) * (1/self.sr)
+        self.primary.append(np.column_stack((times, volts[filtered - low:ready - low])))
+        keep_from = max(0, ready - self.margin)
+        self.raw_tail = self.raw_tail[keep_from - self.raw_tail_start:]
+        self.raw_tail_start = keep_from
+
+    def _detect(self, final):
+        volts = self.primary.array[:, 1]
+        total = len(volts)
+        found = [self.candidates]
+        # Only whole chunks are searched until the file is complete, as in pipeline.detect_blocks
+        while self.next_chunk + self.sample_length <= total:
+            found.append(self.next_chunk + p.window_r_peaks(volts[self.next_chunk:self.next_chunk + self.sample_length]))
+            self.next_chunk += self.step_length
+        if final:
+            while self.next_chunk < total - (self.sample_length - self.step_length):
+                found.append(self.next_chunk + p.window_r_peaks(volts[self.next_chunk:self.next_chunk + self.sample_length]))
+                self.next_chunk += self.step_length
+        self.candidates = np.concatenate(found).astype(np.int64)
+        self._count_intervals(final)
+
+    def _count_intervals(self, final):
+        # No later chunk can find a candidate before the next one to be searched, so the intervals between
+        # those candidates are final and are added to the totals the whole file is filtered with
+        complete = self.candidates if final else self.candidates[self.candidates < self.next_chunk]
+        if self.last_counted is not None:
+            complete = np.append(complete[complete > self.last_counted], self.last_counted)
+        complete = np.unique(complete)
+        if len(complete):
+            intervals = np.diff(complete).astype(float)
+            self.interval_count += len(intervals)
+            self.interval_sum += intervals.sum()
+            self.interval_squares += (intervals**2).sum()
+            self.last_counted = int(complete[-1])
+
+    @property
+    def lower_threshold(self):
+        """
+        The threshold of processor.r_peaks_filter from the intervals between every candidate found so far,
+        which is the threshold of the whole file once it is complete.
+        """
+        if not self.interval_count:
+            return np.nan
+        mean = self.interval_sum / self.interval_count
+        return mean - np.sqrt(max(self.interval_squares / self.interval_count - mean**2, 0))
+
+    def _merge(self, final):
+        # The R Peaks are merged as in processor.merge_r_peaks, but only from the last final peak on
+        frontier = len(self.primary) if final else self.next_chunk
+        final_peaks = np.searchsorted(self.filtered_peaks, frontier - self.revise_samples)
+        anchor = int(self.filtered_peaks[final_peaks - 1]) if final_peaks else -1
+        self.candidates = self.candidates[self.candidates > anchor]
+        # The filter compares each peak with the last one it kept, so the candidates are filtered from the
+        # last final peak on, with the threshold from every interval found so far
+        region = np.unique(np.concatenate((self.filtered_peaks[max(final_peaks - 1, 0):final_peaks], self.candidates)))
+        filtered = p.r_peaks_filter(region, self.primary.array, self.lower_threshold)
+        self.filtered_peaks = np.concatenate((self.filtered_peaks[:final_peaks], filtered[filtered > anchor])).astype(np.int64)
+
+        # A gap is compared with the intervals either side of it, so the gaps are searched again from the
+        # first one which was compared with an interval that could still change
+        start = self.gaps_from
+        if start + 1 < len(self.filtered_peaks):
+            missed = p.find_missed_r_peaks(self.filtered_peaks, self.primary.array, self.sr,
+                                           start_sample=self.filtered_peaks[start + 1])
+        else:
+            missed = self.missed_peaks[:0]
+        if len(self.filtered_peaks):
+            self.missed_peaks = np.concatenate((self.missed_peaks[self.missed_peaks < self.filtered_peaks[start]], missed))
+        self.gaps_from = max(final_peaks - 1 - GAP_NEIGHBOURS, 0)
+        self.r_peaks_list = p.insert_r_peaks(self.filtered_peaks, self.missed_peaks)
+
+class Watcher:
+    """
+    This class polls a folder for new or growing text exports, and analyses the rows appended to each
+    one since the last poll.
+
+    Args:
+        folder (str): The folder to watch
+        on_update (function, optional): Called with the file path and its IncrementalAnalysis after every
+        update which read rows, and after the final update. Defaults to None.
+        **settings: The settings of every IncrementalAnalysis, such as sr, ecg_column, pulse_column and filtering
+    """
+    def __init__(self, folder, on_update=None, **settings):
+        self.folder = folder
+        self.on_update = on_update
+        self.settings = settings
+        self.recordings = {}
+        self.spill_directory = tempfile.mkdtemp(prefix="ecg_watch_")
+
+    def poll(self, final=False):
+        """
+        Updates every recording in the folder which is new or has grown.
+
+        Args:
+            final (bool, optional): Whether the recordings are complete, as in IncrementalAnalysis.update. Defaults to False.
+
+        Returns:
+            list: The paths of the recordings which were updated
+        """
+        updated = []
+        for entry in sorted(os.scandir(self.folder), key=lambda entry: entry.name):
+            if not entry.is_file() or not entry.name.lower().endswith(WATCHED_SUFFIXES):
+                continue
+            analysis = self.recordings.get(entry.path)
+            if analysis is None:
+                analysis = self.recordings[entry.path] = IncrementalAnalysis(entry.path, spill_directory=self.spill_directory, **self.settings)
+            if analysis.finished or (entry.stat().st_size == analysis.offset and not final):
+                continue
+            if analysis.update(final) or final:
+                updated.append(entry.path)
+                if self.on_update is not None:
+                    self.on_update(entry.path, analysis)
+        return updated
+
+    def close(self):
+        for analysis in self.recordings.values():
+            analysis.close()
+        shutil.rmtree(self.spill_directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse the recordings in a folder while they are being written.")
+    parser.add_argument("folder")
+    parser.add_argument("--sr", type=int, required=True, help="the sampling rate of the recordings")
+    parser.add_argument("--ecg-column", type=int, default=1)
+    parser.add_argument("--pulse-column", type=int, default=None, help="divide the recordings into segments by this column")
+    parser.add_argument("--filter", action="store_true", help="detect R Peaks in the filtered signal")
+    parser.add_argument("--out", default=None, help="the folder to export the R Peaks and R-R intervals to")
+    parser.add_argument("--formats", nargs="+", default=[exporter.TEXT_TABLES],
+                        choices=[exporter.TEXT_TABLES, exporter.SEGMENT_FILES, exporter.NPZ])
+    parser.add_argument("--interval", type=float, default=POLL_SECONDS, help="seconds between polls of the folder")
+    parser.add_argument("--export-every", type=float, default=EXPORT_SECONDS, help="the fewest seconds between exports of a recording")
+    parser.add_argument("--once", action="store_true", help="analyse the recordings as they are now and stop")
+    args = parser.parse_args()
+
+    exported = {}
+
+    def on_update(file_path, analysis):
+        file_name = os.path.splitext(os.path.basename(file_path))[0]
+        print(f"{file_name}: {analysis.rows} rows, {len(analysis.r_peaks_list)} R Peaks in {len(analysis.segments)} segments")
+        if args.out is not None and (analysis.finished or time.monotonic() - exported.get(file_path, -np.inf) >= args.export_every):
+            os.makedirs(args.out, exist_ok=True)
+            exporter.bulk_export(args.out, file_name, analysis.r_peaks_list, analysis.timeseries, analysis.segments, args.sr, args.formats)
+            exported[file_path] = time.monotonic()
+
+    watcher = Watcher(args.folder, on_update, sr=args.sr, ecg_column=args.ecg_column, pulse_column=args.pulse_column,
+                      filtering=args.filter)
+    try:
+        if not args.once:
+            while True:
+                watcher.poll()
+                time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.poll(final=True)
+        watcher.close()
+
+
+if __name__ == "__main__":
+    main()
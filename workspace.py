@@ -0,0 +1,152 @@
+"""
+Workspace of the recordings opened in one run of the program.
+
+Every analysed recording is kept with its data, analysis results, edit session and view, so
+switching back to it does not parse or analyse the file again. The recordings are kept in least
+recently used order, and when the signal arrays of the recordings exceed the memory budget the
+least recently used ones are written to .npy files and replaced by copy-on-write memory maps of
+them, so they stay usable without being held in memory. The recording being displayed is never
+spilled.
+
+The memory budget is 2 GB unless ECG_WORKSPACE_MAX_BYTES is set. Spilled files are written to a
+temporary folder which is removed when the program closes.
+"""
+import itertools
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+DEFAULT_MAX_BYTES = 2 * 2**30
+
+max_bytes = int(os.environ.get("ECG_WORKSPACE_MAX_BYTES", DEFAULT_MAX_BYTES))
+
+# The MainWindow attributes which make up an analysed recording. The primary and pulse series
+# and the displayed chunks are views of these and are derived again when a recording is restored.
+RECORDING_ATTRIBUTES = [
+    "file_path", "file_name", "file_data", "file_length", "file_width", "row_index", "first_sample", "sr", "ecg_column", "pulse_column",
+    "selected_filtering", "reduced_rate_detection", "is_filtered", "title", "analyse_whole_dataset",
+    "start_time", "end_time", "raw_timeseries", "filtered_timeseries", "r_peaks_list", "snr", "session",
+    "pulse_edges", "segments", "num_segments", "curr_segment_idx", "quality_window", "quality_signal_energy",
+    "quality_noise_energy", "quality_snr", "noisy_windows", "chunk_snr", "segment_stats", "interval_index",
+    "rr_histogram", "lead_columns", "leads", "lead_peaks",
+]
+
+SPILLED_ARRAYS = ["file_data", "raw_timeseries", "filtered_timeseries", "leads"]
+
+
+class Workspace:
+    """
+    This class holds the opened recordings in least recently used order.
+
+    Args:
+        max_bytes (int, optional): The memory budget of the signal arrays. Defaults to max_bytes.
+    """
+    def __init__(self, max_bytes=max_bytes):
+        self.max_bytes = max_bytes
+        self.recordings = OrderedDict()
+        self.spill_directory = None
+        self.spill_ids = itertools.count()
+
+    def __contains__(self, key):
+        return key in self.recordings
+
+    def __len__(self):
+        return len(self.recordings)
+
+    def keys(self):
+        return list(self.recordings)
+
+    def store(self, key, window):
+        """
+        Saves the recording displayed in a window, with its view, as the most recently used recording,
+        and spills the least recently used recordings while the budget is exceeded.
+
+        Args:
+            key (str): The name of the recording, such as its file path
+            window (MainWindow): The window displaying the recording
+        """
+        recording = {name: getattr(window, name, None) for name in RECORDING_ATTRIBUTES}
+        recording["view"] = {
+            "xlim": tuple(window.ax.get_xlim()),
+            "zoom_factor": window.zoom_factor,
+            "showing_hist": window.showing_hist,
+            "overlay_text": window.overlay_toggle_button.text(),
+        }
+        self._discard_spilled(self.recordings.pop(key, None), recording)
+        self.recordings[key] = recording
+        self._enforce_budget(key)
+
+    def restore(self, key, window):
+        """
+        Sets the attributes of a window to those of a stored recording and makes it the most recently used.
+
+        Args:
+            key (str): The name of the recording
+            window (MainWindow): The window to display the recording in
+
+        Returns:
+            dict: The view of the recording when it was stored, with its xlim, zoom_factor, showing_hist and overlay_text
+        """
+        recording = self.recordings[key]
+        self.recordings.move_to_end(key)
+        for name in RECORDING_ATTRIBUTES:
+            setattr(window, name, recording[name])
+        return recording["view"]
+
+    def remove(self, key):
+        self._discard_spilled(self.recordings.pop(key, None))
+
+    def memory_bytes(self):
+        """
+        Returns the bytes of the signal arrays which are held in memory rather than spilled.
+        """
+        return sum(self._recording_bytes(recording) for recording in self.recordings.values())
+
+    def _recording_bytes(self, recording):
+        return sum(recording[name].nbytes for name in SPILLED_ARRAYS
+                   if isinstance(recording[name], np.ndarray) and not isinstance(recording[name], np.memmap))
+
+    def _enforce_budget(self, current_key):
+        total = self.memory_bytes()
+        for key, recording in self.recordings.items():
+            if total <= self.max_bytes:
+                break
+            if key == current_key:
+                continue
+            total -= self._spill(recording)
+
+    def _spill(self, recording):
+        if self.spill_directory is None:
+            self.spill_directory = tempfile.mkdtemp(prefix="ecg_workspace_")
+        spilled = 0
+        for name in SPILLED_ARRAYS:
+            array = recording[name]
+            if not isinstance(array, np.ndarray) or isinstance(array, np.memmap):
+                continue
+            path = os.path.join(self.spill_directory, f"{next(self.spill_ids)}_{name}.npy")
+            try:
+                np.save(path, array)
+            except OSError:
+                continue
+            recording[name] = np.load(path, mmap_mode='c')
+            spilled += array.nbytes
+        return spilled
+
+    def _discard_spilled(self, recording, replacement=None):
+        if recording is None:
+            return
+        for name in SPILLED_ARRAYS:
+            array = recording[name]
+            if isinstance(array, np.memmap) and (replacement is None or replacement[name] is not array):
+                try:
+                    os.remove(array.filename)
+                except (OSError, TypeError):
+                    pass
+
+    def clear(self):
+        self.recordings.clear()
+        if self.spill_directory is not None:
+            shutil.rmtree(self.spill_directory, ignore_errors=True)
+            self.spill_directory = None